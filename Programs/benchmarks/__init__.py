@@ -0,0 +1,8 @@
+"""
+Benchmarks of the game engine, the hand evaluators, the replay memories and the networks
+
+    python -m benchmarks [-k pattern] [-o results.json] [--baseline benchmarks/baseline.json] [--save_baseline]
+
+The results are saved as JSON. When a baseline is given (or saved from a previous run), the rates are compared to it
+and the command fails if one of them dropped by more than the tolerance.
+"""
@@ -0,0 +1,47 @@
+import argparse
+import os
+import sys
+
+from benchmarks import harness
+# registers the benchmarks
+from benchmarks import suite
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='run the benchmarks and compare them to a baseline')
+    parser.add_argument('-k', '--pattern', default=None, type=str, dest='pattern',
+                        help='only run the benchmarks whose name contains this pattern')
+    parser.add_argument('-t', '--min_time', default=0.5, type=float, dest='min_time',
+                        help='minimum duration (seconds) of each of the 3 measures of a benchmark')
+    parser.add_argument('-o', '--output', default=None, type=str, dest='output',
+                        help='save the results to this JSON file')
+    parser.add_argument('-b', '--baseline', default=DEFAULT_BASELINE, type=str, dest='baseline',
+                        help='compare the results to this JSON file (if it exists)')
+    parser.add_argument('--save_baseline', action='store_true', dest='save_baseline',
+                        help='save the results as the new baseline')
+    parser.add_argument('--tolerance', default=0.2, type=float, dest='tolerance',
+                        help='relative drop of a rate reported as a regression')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    results = harness.run(args.pattern, args.min_time)
+    if args.output is not None:
+        harness.save(results, args.output)
+
+    has_regressions = False
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        comparison = harness.compare(results, harness.load(args.baseline), args.tolerance)
+        print(harness.format_comparison(comparison))
+        has_regressions = any(is_regression for *_, is_regression in comparison)
+    if args.save_baseline:
+        harness.save(results, args.baseline)
+        print('baseline saved to', args.baseline)
+    return 1 if has_regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
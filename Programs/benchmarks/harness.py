@@ -0,0 +1,102 @@
+"""
+Registration, timing and comparison of the benchmarks
+
+A benchmark is a function registered with `@benchmark(name, unit)`. It receives the minimum time of a measure and
+returns a rate (units per second), usually with `measure`. The results of a run are a JSON document
+{'meta': {...}, 'results': {name: {'rate': ..., 'unit': ...}}} that can be saved and used as the baseline of the
+next runs: a benchmark whose rate dropped by more than the tolerance is a regression.
+"""
+from collections import OrderedDict
+import json
+import platform
+import time
+
+import numpy as np
+import torch as t
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name, unit):
+    def register(f):
+        BENCHMARKS[name] = (f, unit)
+        return f
+    return register
+
+
+def measure(f, units_per_call=1, min_time=0.5, repeat=3):
+    """
+    :param f: function without arguments
+    :param units_per_call: number of units (hands, states, ...) processed by a call of f. If None, f returns the
+    number of units it processed (e.g the episodes of a number of games)
+    :return: the best rate (units per second) of `repeat` measures, each of them calling f for at least min_time
+    """
+    f()  # warm up (caches, lazy initializations)
+    best = 0.
+    for _ in range(repeat):
+        n_units = 0
+        start = time.perf_counter()
+        while True:
+            units = f()
+            n_units += units_per_call if units_per_call is not None else units
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        best = max(best, n_units / elapsed)
+    return best
+
+
+def run(pattern=None, min_time=0.5, verbose=True):
+    """
+    :param pattern: only run the benchmarks whose name contains it
+    :return: the results (see the module docstring)
+    """
+    results = OrderedDict()
+    for name, (f, unit) in BENCHMARKS.items():
+        if pattern is not None and pattern not in name:
+            continue
+        rate = f(min_time)
+        results[name] = {'rate': rate, 'unit': unit}
+        if verbose:
+            print('{:<40} {:>14.1f} {}/sec'.format(name, rate, unit))
+    meta = {'time': time.strftime('%y%m%d_%H%M%S', time.gmtime()),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'torch': t.__version__,
+            'machine': platform.platform(),
+            'torch_threads': t.get_num_threads(),
+            'min_time': min_time}
+    return {'meta': meta, 'results': results}
+
+
+def save(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    :param tolerance: relative drop of a rate that is tolerated (timings are noisy)
+    :return: a list of (name, rate, baseline rate, ratio, is_regression), for the benchmarks present in both
+    """
+    comparison = []
+    for name, result in results['results'].items():
+        if name not in baseline['results']:
+            continue
+        base_rate = baseline['results'][name]['rate']
+        ratio = result['rate'] / base_rate if base_rate > 0 else float('inf')
+        comparison.append((name, result['rate'], base_rate, ratio, ratio < 1 - tolerance))
+    return comparison
+
+
+def format_comparison(comparison):
+    lines = ['{:<40} {:>14} {:>14} {:>7}'.format('benchmark', 'rate', 'baseline', 'ratio')]
+    for name, rate, base_rate, ratio, is_regression in comparison:
+        lines.append('{:<40} {:>14.1f} {:>14.1f} {:>7.2f}{}'.format(name, rate, base_rate, ratio,
+                                                                    '  REGRESSION' if is_regression else ''))
+    return '\n'.join(lines)
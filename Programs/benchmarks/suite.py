@@ -0,0 +1,227 @@
+"""
+The benchmarks of the game engine, the hand evaluators, the replay memories and the networks
+"""
+import numpy as np
+import torch as t
+
+from benchmarks.harness import benchmark, measure
+from constant import NUM_ACTIONS, NUM_HIDDEN_LAYERS, SAVED_FEATURIZER_PATH
+from experience_replay.experience_replay import ReplayBufferManager
+from experience_replay.rank_based import RankExperienceReplay
+from game.game_utils import Action, Deck, CARDS, actions_to_array, deal, pack_action_mask
+from game.runtime import RuntimeConfig
+from game.state import build_state, EpisodeState
+from game.utils import variable
+from models.featurizer import FeaturizerManager
+from models.q_network import QNetwork, PiNetwork
+from odds import holdem_functions
+from odds.evaluation import evaluate_hand, evaluate_hands_batch
+from players.player import Player
+from players.strategies import strategy_random
+
+SEED = 0
+N_HANDS = 1000
+REPLAY_CAPACITIES = [2 ** 10, 2 ** 14, 2 ** 17]
+REPLAY_BATCH_SIZE = 32
+FORWARD_BATCH_SIZES = [1, 512]
+
+
+def random_hands(n, rng):
+    """:return: n x 7 card indexes (see game_utils.CARDS)"""
+    return np.array([rng.choice(52, 7, replace=False) for _ in range(n)])
+
+
+@benchmark('evaluate_hand', 'hands')
+def bench_evaluate_hand(min_time):
+    hands = [[CARDS[i] for i in hand] for hand in random_hands(N_HANDS, np.random.default_rng(SEED))]
+    return measure(lambda: [evaluate_hand(hand) for hand in hands], N_HANDS, min_time)
+
+
+@benchmark('evaluate_hands_batch', 'hands')
+def bench_evaluate_hands_batch(min_time):
+    hands = random_hands(10 * N_HANDS, np.random.default_rng(SEED))
+    return measure(lambda: evaluate_hands_batch(hands // 4 + 1, hands % 4), len(hands), min_time)
+
+
+@benchmark('detect_hand', 'hands')
+def bench_detect_hand(min_time):
+    # the cards of the odds package are strings such as 'As' or 'Tc'
+    ranks, suits = '23456789TJQKA', 'hcsd'
+    hands = [[holdem_functions.Card(ranks[i // 4] + suits[i % 4]) for i in hand]
+             for hand in random_hands(N_HANDS, np.random.default_rng(SEED))]
+
+    def detect_hands():
+        for hand in hands:
+            board = hand[2:]
+            suit_histogram, histogram, max_suit = holdem_functions.preprocess_board(board)
+            holdem_functions.detect_hand(hand[:2], board, suit_histogram, histogram, max_suit)
+    return measure(detect_hands, N_HANDS, min_time)
+
+
+def river_situation():
+    """the players, the board and the actions of an episode that reached the river"""
+    players = [Player(0, strategy_random, 100, name='SB'), Player(1, strategy_random, 100, name='DH')]
+    players[0].is_dealer = True
+    deck = Deck()
+    deck.shuffle(np.random.default_rng(SEED))
+    board = []
+    for b_round in range(4):
+        deal(deck, players, board, b_round)
+    actions = {-1: {0: 1, 1: 2},
+               0: {0: [Action('call', 1), Action('call', 4)], 1: [Action('raise', 4, total=4)]},
+               1: {0: [Action('check'), Action('call', 6)], 1: [Action('bet', 6)]},
+               2: {0: [Action('check')], 1: [Action('check')]},
+               3: {0: [Action('bet', 10)], 1: []}}
+    return players, board, actions
+
+
+@benchmark('build_state', 'states')
+def bench_build_state(min_time):
+    players, board, actions = river_situation()
+    return measure(lambda: build_state(players[1], board, 36, actions, 80, 2), 1, min_time)
+
+
+@benchmark('actions_to_array', 'states')
+def bench_actions_to_array(min_time):
+    _, _, actions = river_situation()
+    return measure(lambda: actions_to_array(actions), 1, min_time)
+
+
+@benchmark('episode_state.snapshot', 'states')
+def bench_snapshot(min_time):
+    players, board, _ = river_situation()
+    state = EpisodeState()
+    state.deal(players, board)
+    return measure(lambda: state.snapshot(players[1], 36, 80, 2), 1, min_time)
+
+
+def rl_experience(state, rng):
+    """an experience as stored in M_RL (see ReplayBufferManager.make_exp_tuple)"""
+    legal_mask = pack_action_mask(np.ones(NUM_ACTIONS, dtype=bool))
+    return (state, np.zeros(6), float(rng.normal()), state, 0, int(rng.integers(NUM_ACTIONS)), legal_mask)
+
+
+def filled_rank_replay(capacity, rng):
+    """the cost of the operations of the memory doesn't depend on the states of the experiences: they are None"""
+    conf = {'size': capacity, 'learn_start': capacity, 'partition_num': 16, 'batch_size': REPLAY_BATCH_SIZE,
+            'steps': 10 ** 9}
+    replay = RankExperienceReplay(conf, rng=rng)
+    for _ in range(capacity):
+        replay.store(rl_experience(None, rng))
+    return replay
+
+
+def register_rank_replay_benchmarks(capacity):
+    def bench_store(min_time):
+        rng = np.random.default_rng(SEED)
+        replay = filled_rank_replay(capacity, rng)
+        # it is full: each experience replaces the oldest one
+        return measure(lambda: [replay.store(rl_experience(None, rng)) for _ in range(100)], 100, min_time)
+
+    def bench_sample(min_time):
+        rng = np.random.default_rng(SEED)
+        replay = filled_rank_replay(capacity, rng)
+        return measure(lambda: replay.sample(capacity + 1), 1, min_time)
+
+    def bench_update_priority(min_time):
+        rng = np.random.default_rng(SEED)
+        replay = filled_rank_replay(capacity, rng)
+        _, _, ids = replay.sample(capacity + 1)
+        return measure(lambda: replay.update_priority(ids, rng.random(len(ids))), 1, min_time)
+
+    benchmark('rank_replay.store[{}]'.format(capacity), 'experiences')(bench_store)
+    benchmark('rank_replay.sample[{}]'.format(capacity), 'minibatches')(bench_sample)
+    benchmark('rank_replay.update_priority[{}]'.format(capacity), 'minibatches')(bench_update_priority)
+
+
+for replay_capacity in REPLAY_CAPACITIES:
+    register_rank_replay_benchmarks(replay_capacity)
+
+
+@benchmark('replay._batch_stack', 'minibatches')
+def bench_batch_stack(min_time):
+    rng = np.random.default_rng(SEED)
+    players, board, actions = river_situation()
+    memory = ReplayBufferManager('rl', {'size': 256, 'partition_num': 16, 'batch_size': REPLAY_BATCH_SIZE}, 128)
+    state = build_state(players[1], board, 36, actions, 80, 2)
+    exps = [rl_experience(state, rng) for _ in range(REPLAY_BATCH_SIZE)]
+    return measure(lambda: memory._batch_stack(exps), 1, min_time)
+
+
+def networks():
+    featurizer = FeaturizerManager.load_model(SAVED_FEATURIZER_PATH)
+    Q = QNetwork(n_actions=NUM_ACTIONS, hidden_dim=NUM_HIDDEN_LAYERS, featurizer=featurizer, game_info={},
+                 player_id=0, learning_rate=1e-3, optimizer='adam', use_entropy_loss=False, grad_clip=None)
+    pi = PiNetwork(n_actions=NUM_ACTIONS, hidden_dim=NUM_HIDDEN_LAYERS, featurizer=featurizer, game_info={},
+                   player_id=0, learning_rate=1e-4, optimizer='adam', q_network=Q)
+    return Q, pi
+
+
+def register_forward_benchmarks(batch_size):
+    def bench_forward(network_idx, min_time):
+        network = networks()[network_idx]
+        players, board, actions = river_situation()
+        state = build_state(players[1], board, 36, actions, 80, 2)
+        state = [variable(np.repeat(s, batch_size, axis=0)) for s in state]
+        with t.no_grad():
+            return measure(lambda: network.forward(*state), batch_size, min_time)
+
+    benchmark('Q.forward[{}]'.format(batch_size), 'states')(lambda min_time: bench_forward(0, min_time))
+    benchmark('pi.forward[{}]'.format(batch_size), 'states')(lambda min_time: bench_forward(1, min_time))
+
+
+for forward_batch_size in FORWARD_BATCH_SIZES:
+    register_forward_benchmarks(forward_batch_size)
+
+
+def simulator(strategy_p1, strategy_p2, **kwargs):
+    # imported here: it loads the featurizer and creates the networks
+    from game.simulator import Simulator
+    return Simulator(log_freq=10 ** 9, learn_start=128, eta_p1=.1, eta_p2=.1, eps=.1, gamma=.95,
+                     learning_rate_rl=1e-3, learning_rate_sl=1e-4, learning_freq=1, target_Q_update_freq=100,
+                     use_batch_norm=False, optimizer='adam', experiment_id='benchmark',
+                     strategy_p1=strategy_p1, strategy_p2=strategy_p2,
+                     load_model_p1=False, load_model_p2=False, use_entropy_loss=False,
+                     memory_rl_config={'size': 256, 'partition_num': 16, 'batch_size': REPLAY_BATCH_SIZE},
+                     memory_sl_config={'size': 256, 'batch_size': REPLAY_BATCH_SIZE},
+                     runtime_config=RuntimeConfig(num_threads_act=1), seed=SEED, **kwargs)
+
+
+def measure_episodes(sim, min_time, warmup_games=0, games_per_call=5):
+    """
+    episodes per second of sim (best of the measures of `measure`), after warmup_games games (e.g to fill the
+    memories). sim is closed afterwards
+    """
+    def play_games():
+        episodes = sim.games['#episodes']
+        sim.start(sim.games['n'] + games_per_call)
+        return sim.games['#episodes'] - episodes
+
+    try:
+        if warmup_games > 0:
+            sim.start(sim.games['n'] + warmup_games)
+        return measure(play_games, units_per_call=None, min_time=min_time)
+    finally:
+        sim.close()
+
+
+@benchmark('simulator.random_vs_random', 'episodes')
+def bench_simulator_baselines(min_time):
+    return measure_episodes(simulator('random', 'random'), min_time)
+
+
+@benchmark('simulator.random_vs_random.fast', 'episodes')
+def bench_simulator_baselines_fast(min_time):
+    # enough games to fill the tables of VectorizedEngine
+    return measure_episodes(simulator('random', 'random', fast_baselines=True), min_time, games_per_call=4096)
+
+
+@benchmark('simulator.random_vs_mirror.fast', 'episodes')
+def bench_simulator_mirror_fast(min_time):
+    return measure_episodes(simulator('random', 'mirror', fast_baselines=True), min_time, games_per_call=4096)
+
+
+@benchmark('simulator.nfsp_vs_nfsp', 'episodes')
+def bench_simulator_nfsp(min_time):
+    # the warmup fills the memories: the episodes include the learning steps
+    return measure_episodes(simulator('NFSP', 'NFSP'), min_time, warmup_games=20)
@@ -0,0 +1,266 @@
+'''
+Periodic evaluation of the networks against the baselines, in a separate process
+
+Every N episodes, the Simulator takes a snapshot (a copy of the weights) of Q and pi of its NFSP players and submits it
+to an EvaluationWorker without waiting for it. If the weights of a player are stored in a flat buffer (see
+models.flat_parameters), the snapshot is a single copy to a buffer in shared memory (WeightBroadcaster) that the
+worker reads, and is only taken when the weights changed. Otherwise the state dicts are copied and pickled to the
+worker. The worker process loads the snapshot in its own copy of the networks,
+with the learning disabled (eval mode, no gradient, no replay memory), plays a fixed number of hands against each
+baseline (BaselineEngine with the cards dealt first), and sends back the win rates in mbb/hand with their confidence
+intervals, which the Simulator collects with `poll` between two episodes. Optionally, the worker also measures the
+exploitability of pi on a reduced game (see evaluation.exploitability).
+The worker uses one thread, and the number of snapshots waiting to be evaluated is bounded (see max_pending): when the
+worker is late, the new snapshots are dropped rather than queued, so that the evaluation never slows the training down.
+'''
+import multiprocessing as mp
+import queue
+import traceback
+
+import torch as t
+
+from constant import NUM_ACTIONS, NUM_HIDDEN_LAYERS, SAVED_FEATURIZER_PATH
+from evaluation.exploitability import PreflopGame, NetworkPolicy
+from evaluation.hand_history_analysis import to_mbb, confidence_interval
+from game.fast_engine import BaselineEngine
+from game.rng import RNGStreams
+from game.statistics import RunningMoments
+from models.featurizer import FeaturizerManager
+from models.flat_parameters import FlatParameters, WeightBroadcaster
+from models.q_network import QNetwork, QNetworkBN, PiNetwork, PiNetworkBN
+from players.strategies import strategy_pi, strategy_RL, strategy_random, strategy_mirror
+
+OPPONENTS = {'random': strategy_random, 'mirror': strategy_mirror}
+# pi: the average policy (what NFSP converges with), Q: the greedy policy of Q
+POLICIES = ('pi', 'Q')
+
+
+def build_networks(featurizer_path=SAVED_FEATURIZER_PATH, use_batch_norm=False):
+    '''
+    :return: (Q, pi) sharing their layers as in the Simulator, in eval mode, to load the snapshots in
+    '''
+    featurizer = FeaturizerManager.load_model(featurizer_path)
+    # the optimizers are never used
+    kwargs = dict(n_actions=NUM_ACTIONS, hidden_dim=NUM_HIDDEN_LAYERS, featurizer=featurizer, game_info={},
+                  player_id=0, learning_rate=0., optimizer='sgd')
+    if use_batch_norm:
+        Q = QNetworkBN(**kwargs)
+        pi = PiNetworkBN(q_network=Q, **kwargs)
+    else:
+        Q = QNetwork(use_entropy_loss=False, grad_clip=None, **kwargs)
+        pi = PiNetwork(q_network=Q, **kwargs)
+    Q.eval()
+    pi.eval()
+    return Q, pi
+
+
+def snapshot(module):
+    '''
+    :return: a copy of the state dict of module as numpy arrays (pickled as they are to the worker process)
+    '''
+    return {k: v.detach().cpu().numpy().copy() for k, v in module.state_dict().items()}
+
+
+def load_snapshot(module, state):
+    module.load_state_dict({k: t.from_numpy(v) for k, v in state.items()})
+
+
+def opponent_seeds(rng_streams, n_opponents):
+    '''
+    :return: the SeedSequences of the games against each opponent
+    '''
+    return [streams.seed_sequence for streams in rng_streams.spawn(n_opponents)]
+
+
+def evaluate_strategy(strategy, opponents=('random', 'mirror'), n_hands=2000, n_tables=64, rng_streams=None,
+                      seeds=None):
+    '''
+    play n_hands against each opponent (the evaluated strategy is the first player)
+    :param strategy: strategy function (see players.strategies)
+    :param seeds: SeedSequences of the games against each opponent (see opponent_seeds), spawned from rng_streams if
+    not given. Strategies evaluated with the same seeds play the same cards
+    :return: {opponent: {'n_hands', 'mbb_per_hand', 'ci95'}}
+    '''
+    if seeds is None:
+        seeds = opponent_seeds(rng_streams if rng_streams is not None else RNGStreams(), len(opponents))
+    results = {}
+    for opponent, seed in zip(opponents, seeds):
+        # new streams for each strategy: the generators start from the seed
+        engine = BaselineEngine(strategy, OPPONENTS[opponent], n_tables=min(n_tables, n_hands),
+                                rng_streams=RNGStreams(seed), deal_first=True)
+        win_rate = RunningMoments()
+        win_rate.add(to_mbb(engine.run_episodes(n_hands)[:, 0]))
+        results[opponent] = {'n_hands': win_rate.count,
+                             'mbb_per_hand': win_rate.mean,
+                             'ci95': confidence_interval(win_rate)}
+    return results
+
+
+def evaluate_networks(Q, pi, policies=('pi',), opponents=('random', 'mirror'), n_hands=2000, n_tables=64,
+                      rng_streams=None):
+    '''
+    :return: {policy: {opponent: result}} (see evaluate_strategy). Each policy plays the same cards
+    '''
+    strategies = {'pi': strategy_pi(pi), 'Q': strategy_RL(Q, True)}
+    seeds = opponent_seeds(rng_streams if rng_streams is not None else RNGStreams(), len(opponents))
+    with t.no_grad():
+        return {policy: evaluate_strategy(strategies[policy], opponents, n_hands, n_tables, seeds=seeds)
+                for policy in policies}
+
+
+def _worker_loop(jobs, results, config):
+    try:
+        t.set_num_threads(config['n_threads'])
+        Q, pi = build_networks(config['featurizer_path'], config['use_batch_norm'])
+        # same layout as the FlatParameters of the players, for the weights broadcast in shared memory
+        replica = FlatParameters([Q, pi])
+        broadcasters = {}
+        replica_version = None
+        # the tree and the showdown probabilities are built once, for all the snapshots
+        game = PreflopGame(config['exploitability_stack']) if config['exploitability_stack'] is not None else None
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            if 'broadcaster' in job:
+                # sent once for each player
+                broadcasters[job['player']] = job['broadcaster']
+            if 'version' in job:
+                weights = (job['player'], job['version'])
+                if weights != replica_version:
+                    broadcasters[job['player']].pull(replica)
+                    replica_version = weights
+            else:
+                load_snapshot(Q, job['Q'])
+                load_snapshot(pi, job['pi'])
+                replica_version = None
+            evaluation = evaluate_networks(Q, pi, config['policies'], config['opponents'], config['n_hands'],
+                                           config['n_tables'], job['rng_streams'])
+            result = {'episode': job['episode'], 'player': job['player'], 'results': evaluation}
+            if game is not None:
+                result['exploitability'] = game.exploitability(NetworkPolicy(pi))
+            results.put(result)
+    except Exception:
+        results.put({'error': traceback.format_exc()})
+
+
+class EvaluationWorker:
+    def __init__(self, featurizer_path=SAVED_FEATURIZER_PATH, use_batch_norm=False, n_hands=2000,
+                 opponents=('random', 'mirror'), policies=('pi',), n_tables=64, max_pending=2, n_threads=1,
+                 exploitability_stack=None):
+        '''
+        :param n_hands: number of hands played against each opponent
+        :param opponents: names of the baselines (see OPPONENTS)
+        :param policies: policies of the snapshots that are evaluated (see POLICIES)
+        :param max_pending: number of snapshots submitted and not evaluated yet above which the new ones are dropped
+        :param n_threads: number of threads of the worker process
+        :param exploitability_stack: if given, measure the exploitability of pi on the preflop game with stacks of
+        that many chips (see evaluation.exploitability.PreflopGame)
+        '''
+        for opponent in opponents:
+            if opponent not in OPPONENTS:
+                raise ValueError('unknown opponent: {}'.format(opponent))
+        for policy in policies:
+            if policy not in POLICIES:
+                raise ValueError('unknown policy: {}'.format(policy))
+        self.max_pending = max_pending
+        self.n_pending = 0
+        self.n_dropped = 0
+        # {player id: WeightBroadcaster} of the players whose weights are stored in a flat buffer
+        self._broadcasters = {}
+        config = {'featurizer_path': featurizer_path, 'use_batch_norm': use_batch_norm, 'n_hands': n_hands,
+                  'opponents': tuple(opponents), 'policies': tuple(policies), 'n_tables': n_tables,
+                  'n_threads': n_threads, 'exploitability_stack': exploitability_stack}
+        # the worker does not inherit the threads (and locks) of the training process
+        context = mp.get_context('spawn')
+        self._jobs = context.Queue()
+        self._results = context.Queue()
+        self._process = context.Process(target=_worker_loop, args=(self._jobs, self._results, config),
+                                        name='EvaluationWorker', daemon=True)
+        self._process.start()
+
+    def submit(self, episode, player_id, Q, pi, rng_streams=None, flat_parameters=None):
+        '''
+        snapshot the weights of Q and pi and send them to the worker
+        :param rng_streams: RNGStreams of the evaluation (e.g `simulator.rng_streams.evaluation(episode)`)
+        :param flat_parameters: FlatParameters holding the weights of Q and pi (laid out as FlatParameters([Q, pi])),
+        if any. Their weights are then broadcast in shared memory instead of being pickled. The networks must not have
+        buffers (e.g batch norm statistics), which are not part of it
+        :return: False if the snapshot was dropped (max_pending snapshots are waiting, or the worker didn't read the
+                 weights broadcast last yet)
+        '''
+        if self.n_pending >= self.max_pending:
+            self.n_dropped += 1
+            return False
+        job = {'episode': episode, 'player': player_id,
+               'rng_streams': rng_streams if rng_streams is not None else RNGStreams()}
+        if flat_parameters is not None:
+            broadcaster = self._broadcasters.get(player_id)
+            if broadcaster is None:
+                broadcaster = self._broadcasters[player_id] = WeightBroadcaster(flat_parameters)
+                job['broadcaster'] = broadcaster
+            elif not broadcaster.is_pulled():
+                # publishing would replace weights that are waiting to be evaluated
+                self.n_dropped += 1
+                return False
+            job['version'] = broadcaster.publish()
+        else:
+            job['Q'] = snapshot(Q)
+            job['pi'] = snapshot(pi)
+        self._jobs.put(job)
+        self.n_pending += 1
+        return True
+
+    def poll(self, timeout=None):
+        '''
+        :param timeout: seconds to wait for the first result (None: do not wait)
+        :return: the list of the evaluations received, {'episode', 'player', 'results'} (see evaluate_networks), and
+                 'exploitability' (see PreflopGame.exploitability) if it is measured
+        '''
+        received = []
+        while self.n_pending > 0:
+            try:
+                if timeout is not None and len(received) == 0:
+                    result = self._results.get(timeout=timeout)
+                else:
+                    result = self._results.get_nowait()
+            except queue.Empty:
+                break
+            if 'error' in result:
+                raise RuntimeError('the evaluation worker failed:\n' + result['error'])
+            self.n_pending -= 1
+            received.append(result)
+        return received
+
+    def close(self, wait=True):
+        '''
+        stop the worker
+        :param wait: wait for the snapshots already submitted to be evaluated
+        :return: the evaluations received (see poll)
+        '''
+        received = []
+        if wait:
+            while self.n_pending > 0 and self._process.is_alive():
+                received.extend(self.poll(timeout=1.))
+        self._jobs.put(None)
+        self._process.join(timeout=None if wait else 1.)
+        if self._process.is_alive():
+            self._process.terminate()
+        return received
+
+
+def format_evaluation(evaluation):
+    '''
+    :param evaluation: an evaluation received from the worker (see EvaluationWorker.poll)
+    '''
+    lines = []
+    for policy, by_opponent in evaluation['results'].items():
+        for opponent, result in by_opponent.items():
+            low, high = result['ci95']
+            lines.append('episode {}: p{} {} vs {}: {:.1f} mbb/hand (95% CI [{:.1f}, {:.1f}], {} hands)'.format(
+                evaluation['episode'], evaluation['player'] + 1, policy, opponent, result['mbb_per_hand'], low, high,
+                result['n_hands']))
+    if 'exploitability' in evaluation:
+        lines.append('episode {}: p{} pi exploitability (preflop game): {:.1f} mbb/hand'.format(
+            evaluation['episode'], evaluation['player'] + 1, evaluation['exploitability']['exploitability']))
+    return '\n'.join(lines)
@@ -0,0 +1,307 @@
+'''
+Exploitability of the average policy on a reduced heads-up game
+
+The reduced game is one episode of the Simulator with short stacks, stopped after the preflop: the preflop betting
+follows the rules of the Simulator (blinds, action buckets of `authorized_actions_buckets` and `bucket_to_action`,
+all-ins, the betting state machine), and if nobody folded the board is run out and the hands are shown down.
+The flop and the next streets are not played: they would multiply the tree by the chance nodes of the board.
+
+The betting tree of each dealer is built once (see PreflopGame), as well as the chance of each pair of hands and the
+probabilities that one beats the other at the showdown (estimated on n_boards sampled boards). A best response is then
+computed by traversing the tree once, for all the 1326 hands at once: the values of a subtree are vectors over the
+hands of the best-responding player, the reach probabilities vectors over the hands of the opponent, and the values of
+the terminal nodes are products of the cached chance/showdown matrices with the reach of the opponent. The policy is
+queried once per decision node, for all the hands in one batch (see NetworkPolicy).
+
+The exploitability of a pair of policies is the mean of the values of the best responses to each of them, averaged
+over the two dealers: it is 0 for a Nash equilibrium of the reduced game, and measured in mbb/hand.
+'''
+import copy
+from itertools import combinations
+
+import numpy as np
+import torch as t
+
+from constant import NUM_ACTIONS
+from evaluation.hand_history_analysis import to_mbb
+from game import betting
+from game.config import BLINDS
+from game.game_utils import Action, N_CARDS, blinds, bucket_to_action, idx_to_bucket, deal_card_indexes
+from game.rng import get_rng
+from game.state import build_state
+from game.utils import variable
+from odds.evaluation import evaluate_hands_batch
+from players.player import Player
+from players.strategies import legal_actions_mask
+
+# the 1326 hands, as pairs of card indexes (see game_utils.CARDS)
+HANDS = np.array(list(combinations(range(N_CARDS), 2)), dtype=np.int64)
+N_HANDS = len(HANDS)
+
+
+def hand_arrays(hands=HANDS):
+    '''
+    :return: array n x 13 x 4 of the hands, as in build_state (see cards_to_array)
+    '''
+    arrays = np.zeros((len(hands), 13, 4))
+    rows = np.arange(len(hands))
+    for k in range(2):
+        arrays[rows, hands[:, k] // 4, hands[:, k] % 4] = 1
+    return arrays
+
+
+def showdown_probabilities(n_boards=200, rng=None, hands=HANDS):
+    '''
+    :return: (p_win, p_lose) arrays n_hands x n_hands: the probabilities that hand i beats (loses against) hand j,
+             estimated on n_boards sampled boards (those that share a card with one of the hands are ignored)
+    '''
+    boards = deal_card_indexes(n_boards, n_cards=5, rng=get_rng(rng))
+    wins = np.zeros((len(hands), len(hands)), dtype=np.int32)
+    losses = np.zeros_like(wins)
+    counts = np.zeros_like(wins)
+    for board in boards:
+        valid = ~np.isin(hands, board).any(axis=1)
+        cards = np.concatenate([hands, np.tile(board, (len(hands), 1))], axis=1)
+        scores = evaluate_hands_batch(cards // 4 + 1, cards % 4)
+        both_valid = valid[:, None] & valid[None, :]
+        wins += both_valid & (scores[:, None] > scores[None, :])
+        losses += both_valid & (scores[:, None] < scores[None, :])
+        counts += both_valid
+    counts = np.maximum(counts, 1)
+    return wins / counts, losses / counts
+
+
+class Node:
+    def __init__(self, player=None, state=None, legal_mask=None, payoffs=None, showdown=False):
+        '''
+        :param player: id of the player to act, None at the terminal nodes
+        :param state: the state of the player to act, without its hand (see build_state)
+        :param legal_mask: the actions it can choose from (see legal_actions_mask)
+        :param payoffs: profit of player 0 if (player 0 wins, player 1 wins)
+        :param showdown: if the winner is decided by a showdown (by a fold otherwise: both payoffs are the same)
+        '''
+        self.player = player
+        self.state = state
+        self.legal_mask = legal_mask
+        self.payoffs = payoffs
+        self.showdown = showdown
+        # index of the action (see idx_to_bucket) -> Node
+        self.children = {}
+
+    @property
+    def is_terminal(self):
+        return self.player is None
+
+    def nodes(self):
+        '''
+        :return: the list of the nodes of the subtree (depth first)
+        '''
+        nodes = [self]
+        for child in self.children.values():
+            nodes.extend(child.nodes())
+        return nodes
+
+
+def _payoffs(players, pot, stack):
+    '''
+    :return: the profit of player 0 if it wins the pot, and if player 1 wins it (see _Table.settle)
+    '''
+    payoffs = []
+    for winner in range(2):
+        stacks = [p.stack for p in players]
+        s_pot = players[winner].side_pot
+        if s_pot * 2 >= pot:
+            stacks[winner] += pot
+        else:
+            stacks[winner] += 2 * s_pot
+            stacks[1 - winner] += pot - 2 * s_pot
+        payoffs.append(stacks[0] - stack)
+    return tuple(payoffs)
+
+
+def _copy_actions(actions):
+    return {b_round: {p_id: list(a) if isinstance(a, list) else a for p_id, a in by_player.items()}
+            for b_round, by_player in actions.items()}
+
+
+def _build(players, actions, pot, betting_state, to_play, all_in, n_null, stack):
+    player, opponent = players[to_play], players[1 - to_play]
+    if player.is_all_in:
+        # the player does nothing (see Player.play)
+        if n_null + 1 >= 2:
+            return Node(payoffs=_payoffs(players, pot, stack), showdown=True)
+        return _build(players, actions, pot, betting_state, 1 - to_play, all_in, n_null + 1, stack)
+
+    # the state of the betting round is tracked here as in _Table (the legal actions are keyed on it)
+    player.betting_state = betting_state
+    node = Node(player=player.id,
+                state=build_state(player, [], pot, actions, opponent.stack, BLINDS[1]),
+                legal_mask=legal_actions_mask(player, actions, 0, opponent.side_pot))
+    for idx in np.flatnonzero(node.legal_mask):
+        child_players = [copy.copy(p) for p in players]
+        p, o = child_players[to_play], child_players[1 - to_play]
+        child_actions = _copy_actions(actions)
+        # the betting of _Table._play_round
+        action = bucket_to_action(idx_to_bucket(idx), child_actions, 0, p, o.side_pot)
+        if p.stack - action.value <= 0:
+            p.is_all_in = True
+            action = Action('all in', value=p.stack)
+        p.side_pot += action.total
+        p.stack -= action.total
+        child_actions[0][p.id].append(action)
+        position = betting.SB if p.is_dealer else betting.BB
+        child_state = betting.step(betting_state, position, betting.TYPE_TO_IDX[action.type])
+        child_all_in = all_in
+        if action.type == 'all in':
+            child_all_in += 1
+            if p.side_pot <= o.side_pot:
+                child_all_in += 1
+        elif action.type == 'call' and all_in == 1:
+            child_all_in += 1
+
+        if action.type == 'fold':
+            payoff = _payoffs(child_players, pot + action.total, stack)[o.id]
+            node.children[idx] = Node(payoffs=(payoff, payoff))
+        elif betting.is_over(child_state) or child_all_in == 2:
+            node.children[idx] = Node(payoffs=_payoffs(child_players, pot + action.total, stack), showdown=True)
+        else:
+            node.children[idx] = _build(child_players, child_actions, pot + action.total, child_state, 1 - to_play,
+                                        child_all_in, n_null, stack)
+    return node
+
+
+def build_tree(stack, dealer):
+    '''
+    :param stack: the stack of each player before the blinds (more than a big blind)
+    :return: the root of the preflop betting tree
+    '''
+    players = [Player(p_id, None, stack) for p_id in range(2)]
+    players[dealer].is_dealer = True
+    pot = blinds(players)
+    actions = {b_round: {p_id: [] for p_id in range(2)} for b_round in range(-1, 4)}
+    actions[-1][0] = players[0].side_pot
+    actions[-1][1] = players[1].side_pot
+    # preflop, the dealer plays first
+    return _build(players, actions, pot, betting.initial_state(0), dealer, 0, 0, stack)
+
+
+def uniform_policy(node):
+    '''
+    :return: the same weight for every action (the authorized ones are selected by the traversal)
+    '''
+    return np.ones(NUM_ACTIONS)
+
+
+class NetworkPolicy:
+    '''probabilities of the actions of a pi network at a decision node, for all the hands in one batch'''
+
+    def __init__(self, pi, hands=HANDS, cuda=False):
+        self.pi = pi
+        self.hand_arrays = hand_arrays(hands)
+        self.cuda = cuda
+
+    def __call__(self, node):
+        n = len(self.hand_arrays)
+        state = [self.hand_arrays] + [np.repeat(s, n, axis=0) for s in node.state[1:]]
+        with t.no_grad():
+            probabilities = self.pi.forward(*[variable(s, cuda=self.cuda) for s in state])
+        return probabilities.data.cpu().numpy()
+
+
+class PreflopGame:
+    def __init__(self, stack=20, n_boards=200, seed=0):
+        '''
+        :param stack: stack of each player at the beginning of the episode
+        :param n_boards: number of boards sampled to estimate the showdown probabilities
+        '''
+        self.stack = stack
+        self.trees = [build_tree(stack, dealer) for dealer in range(2)]
+        # probability of each pair (hand of player 0, hand of player 1): they can't share a card
+        disjoint = ~(HANDS[:, None, :, None] == HANDS[None, :, None, :]).any(axis=(2, 3))
+        chance = disjoint / disjoint.sum()
+        p_win, p_lose = showdown_probabilities(n_boards, np.random.default_rng(seed))
+        # terminal values of player 0 = sum over the winners of payoff * (matrix @ reach of player 1), and the
+        # transposed matrices for player 1
+        self._fold = ((chance,), (np.ascontiguousarray(chance.T),))
+        self._showdown = ((chance * p_win, chance * p_lose),
+                          (np.ascontiguousarray((chance * p_win).T), np.ascontiguousarray((chance * p_lose).T)))
+        # the nodes of each tree, parents first, and its terminal nodes by kind (see _best_response)
+        self._nodes = [tree.nodes() for tree in self.trees]
+        self._terminals = [{showdown: [node for node in nodes if node.is_terminal and node.showdown == showdown]
+                            for showdown in (False, True)} for nodes in self._nodes]
+
+    def __len__(self):
+        return sum(len(nodes) for nodes in self._nodes)
+
+    def _best_response(self, dealer, player, probabilities):
+        '''
+        :return: the values of the best response of player at the root of the tree of dealer, for each of its hands
+                 (weighted by the chance of the hands)
+        '''
+        nodes = self._nodes[dealer]
+        # top-down: probabilities that the opponent reaches each node with each of its hands
+        reach = {nodes[0]: np.ones(N_HANDS)}
+        for node in nodes:
+            for idx, child in node.children.items():
+                reach[child] = reach[node] if node.player == player else reach[node] * probabilities[node][:, idx]
+
+        # the values of the terminal nodes are linear in the reach of the opponent: all of them are computed with
+        # one matrix product per matrix of the game
+        values = {}
+        sign = 1 if player == 0 else -1
+        for showdown, matrices in ((False, self._fold[player]), (True, self._showdown[player])):
+            terminals = self._terminals[dealer][showdown]
+            if len(terminals) == 0:
+                continue
+            reaches = np.stack([reach[node] for node in terminals], axis=1)
+            payoffs = sign * np.array([node.payoffs for node in terminals], dtype=np.float64)
+            terminal_values = sum((matrix @ reaches) * payoffs[:, k] for k, matrix in enumerate(matrices))
+            for k, node in enumerate(terminals):
+                values[node] = terminal_values[:, k]
+
+        # bottom-up: the best responder picks the best action for each of its hands, the reach of the opponent
+        # already weighs its actions
+        for node in reversed(nodes):
+            if node.is_terminal:
+                continue
+            children = np.array([values[child] for child in node.children.values()])
+            values[node] = children.max(axis=0) if node.player == player else children.sum(axis=0)
+        return values[nodes[0]]
+
+    def _policy_probabilities(self, policies):
+        '''
+        :param policies: the policy of each player (see uniform_policy and NetworkPolicy)
+        :return: {decision node: array n_hands x NUM_ACTIONS of the probabilities of the actions}
+        '''
+        probabilities = {}
+        for nodes in self._nodes:
+            for node in nodes:
+                if node.is_terminal:
+                    continue
+                weights = np.broadcast_to(policies[node.player](node), (N_HANDS, NUM_ACTIONS))
+                weights = np.where(node.legal_mask, weights, 0.)
+                totals = weights.sum(axis=1, keepdims=True)
+                # as in sample_masked_action, the authorized actions are uniform if they all have a weight of 0
+                probabilities[node] = np.where(totals > 0, weights / np.where(totals > 0, totals, 1.),
+                                               node.legal_mask / node.legal_mask.sum())
+        return probabilities
+
+    def best_response_values(self, policies):
+        '''
+        :param policies: the policy of each player, or one policy for both
+        :return: array dealer x player of the values (in chips) of the best response of player to the policy of its
+                 opponent
+        '''
+        if callable(policies):
+            policies = (policies, policies)
+        probabilities = self._policy_probabilities(policies)
+        return np.array([[self._best_response(dealer, player, probabilities).sum() for player in range(2)]
+                         for dealer in range(2)])
+
+    def exploitability(self, policies):
+        '''
+        :return: {'exploitability': mbb/hand, 'best_response': mbb/hand of the best response of each player, averaged
+                 over the dealers}
+        '''
+        values = self.best_response_values(policies).mean(axis=0)
+        return {'exploitability': float(to_mbb(values.mean())), 'best_response': to_mbb(values)}
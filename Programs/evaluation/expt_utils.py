@@ -17,10 +17,11 @@ from game.config import BLINDS
 import matplotlib.pyplot as plt
 from random import randint
 import numpy as np
+from evaluation.hand_history_analysis import moving_average
 
 
 def moving_avg(x, pid, window):
-    return [np.mean(x[k:k + window, pid]) for k in range(len(x) - window)]
+    return list(moving_average(x[:, pid], window)[:len(x) - window])
 
 
 def conduct_games(p1_strategy,
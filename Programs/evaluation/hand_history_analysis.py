@@ -0,0 +1,142 @@
+'''
+Win rates and action frequencies of a hand history (see game.hand_history), computed chunk by chunk
+
+Win rates are measured in mbb/hand (thousandths of a big blind per episode). All the statistics are updated
+incrementally with NumPy operations on the chunks, so the memory used does not depend on the number of hands: the
+moving average is only kept every `stride` hands.
+'''
+import numpy as np
+
+from game.config import BLINDS
+from game.hand_history import HandHistoryReader, ACTION_TYPES
+from game.statistics import RunningMoments
+
+STREETS = ('preflop', 'flop', 'turn', 'river')
+# two-sided 95% confidence
+Z_95 = 1.96
+
+
+def to_mbb(rewards, big_blind=BLINDS[1]):
+    return 1000. * np.asarray(rewards, dtype=np.float64) / big_blind
+
+
+def moving_average(x, window):
+    '''
+    :return: the means of the len(x) - window + 1 windows of x, with cumulative sums (O(len(x)))
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    if len(x) < window:
+        return np.zeros(0)
+    cumsum = np.concatenate([[0.], np.cumsum(x)])
+    return (cumsum[window:] - cumsum[:-window]) / window
+
+
+class StreamingMovingAverage:
+    '''moving average of a stream of values, given chunk by chunk, kept every `stride` values'''
+
+    def __init__(self, window, stride=1):
+        self.window = window
+        self.stride = stride
+        # the last window - 1 values of the previous chunks
+        self._tail = np.zeros(0)
+        self._n = 0  # number of values seen
+        self.positions = []
+        self.values = []
+
+    def add(self, x):
+        x = np.concatenate([self._tail, np.asarray(x, dtype=np.float64)])
+        averages = moving_average(x, self.window)
+        # position (number of values seen) at the end of each window
+        ends = self._n - len(self._tail) + self.window + np.arange(len(averages))
+        kept = ends % self.stride == 0
+        self.positions.append(ends[kept])
+        self.values.append(averages[kept])
+        self._n += len(x) - len(self._tail)
+        self._tail = x[len(x) - min(len(x), self.window - 1):]
+
+    def result(self):
+        '''
+        :return: (positions, averages): the average of the window ending at each position
+        '''
+        if len(self.positions) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        return np.concatenate(self.positions), np.concatenate(self.values)
+
+
+def confidence_interval(moments, z=Z_95):
+    '''
+    :param moments: RunningMoments of the samples
+    :return: (low, high) interval of the mean (normal approximation)
+    '''
+    if moments.count < 2:
+        return -np.inf, np.inf
+    half_width = z * np.sqrt(moments.m2 / (moments.count - 1) / moments.count)
+    return moments.mean - half_width, moments.mean + half_width
+
+
+class HandHistoryAnalyzer:
+    def __init__(self, player=0, window=1000, stride=None, big_blind=BLINDS[1]):
+        '''
+        :param player: id of the player whose win rate is measured
+        :param window: number of hands of the moving average of the win rate
+        :param stride: keep the moving average every `stride` hands (default: window)
+        '''
+        self.player = player
+        self.big_blind = big_blind
+        self.win_rate = RunningMoments()
+        self.moving_average = StreamingMovingAverage(window, stride or window)
+        # number of actions of each player, by street and type
+        self.action_counts = np.zeros((2, len(STREETS), len(ACTION_TYPES)), dtype=np.int64)
+        self.n_showdowns = 0
+
+    def update(self, episodes, actions):
+        '''
+        :param episodes, actions: the records of a chunk (see HandHistoryReader.chunks)
+        '''
+        mbb = to_mbb(episodes['rewards'][:, self.player], self.big_blind)
+        self.win_rate.add(mbb)
+        self.moving_average.add(mbb)
+        self.n_showdowns += int(episodes['showdown'].sum())
+        keys = (actions['player'].astype(np.int64) * len(STREETS) + actions['street']) * len(ACTION_TYPES) + \
+            actions['type']
+        self.action_counts += np.bincount(keys, minlength=self.action_counts.size).reshape(self.action_counts.shape)
+
+    def action_frequencies(self):
+        '''
+        :return: array (player, street, action type) of the frequency of each type among the actions of the street
+        '''
+        totals = self.action_counts.sum(axis=2, keepdims=True)
+        return self.action_counts / np.maximum(totals, 1)
+
+    def report(self):
+        positions, averages = self.moving_average.result()
+        return {'n_hands': self.win_rate.count,
+                'mbb_per_hand': self.win_rate.mean,
+                'mbb_per_hand_std': np.sqrt(self.win_rate.variance),
+                'ci95': confidence_interval(self.win_rate),
+                'showdown_rate': self.n_showdowns / max(self.win_rate.count, 1),
+                'moving_average': (positions, averages),
+                'action_frequencies': self.action_frequencies()}
+
+
+def analyze(path, player=0, window=1000, stride=None, big_blind=BLINDS[1]):
+    '''
+    :param path: directory of a hand history
+    :return: the report of a HandHistoryAnalyzer fed with all its chunks
+    '''
+    analyzer = HandHistoryAnalyzer(player, window, stride, big_blind)
+    for episodes, actions in HandHistoryReader(path).chunks():
+        analyzer.update(episodes, actions)
+    return analyzer.report()
+
+
+def format_report(report, player=0):
+    low, high = report['ci95']
+    lines = ['{} hands, p{} win rate: {:.1f} mbb/hand (95% CI [{:.1f}, {:.1f}]), showdowns: {:.1%}'.format(
+        report['n_hands'], player + 1, report['mbb_per_hand'], low, high, report['showdown_rate'])]
+    frequencies = report['action_frequencies']
+    for p in range(frequencies.shape[0]):
+        for s, street in enumerate(STREETS):
+            lines.append('p{} {:<8} '.format(p + 1, street) + ' '.join(
+                '{}: {:.2f}'.format(a, f) for a, f in zip(ACTION_TYPES, frequencies[p, s])))
+    return '\n'.join(lines)
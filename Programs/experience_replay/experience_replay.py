@@ -3,10 +3,27 @@ from experience_replay.rank_based import RankExperienceReplay
 from experience_replay.reservoir import ReservoirExperienceReplay
 import numpy as np
 import math
+import pickle
+import threading
 import pprint as pp
+
+from game.profiling import NULL_PROFILER
 #import xxhash
 
 
+def _arrays_nbytes(obj, seen):
+    if isinstance(obj, np.ndarray):
+        if id(obj) in seen:
+            return 0
+        seen.add(id(obj))
+        return obj.nbytes
+    if isinstance(obj, (tuple, list)):
+        return sum(_arrays_nbytes(o, seen) for o in obj)
+    if isinstance(obj, dict):
+        return sum(_arrays_nbytes(o, seen) for o in obj.values())
+    return 0
+
+
 class ReplayBufferManager:
     '''
     use only rank based type for now.
@@ -14,8 +31,13 @@ class ReplayBufferManager:
     see this example
     https://github.com/Damcy/cascadeLSTMDRL/blob/a6c502bc93197adb36adc8313cc925fdb12c08ee/agent/src/QLearner.py
     '''
+    # times the sampling (see game.profiling)
+    profiler = NULL_PROFILER
 
-    def __init__(self, target, config, learn_start, verbose=False):
+    def __init__(self, target, config, learn_start, verbose=False, rng=None):
+        '''
+        rng: numpy Generator used to sample the minibatches (see game.rng)
+        '''
         if not target in ['rl', 'sl']:
             raise Exception('Unsupported Memory Type', target)
 
@@ -46,7 +68,7 @@ class ReplayBufferManager:
                 having partition_num samples"
             if verbose:
                 print('target: RL ', config)
-            self._buffer = RankExperienceReplay(self.config)
+            self._buffer = RankExperienceReplay(self.config, rng=rng)
         elif self.target == 'sl':
             self.config = {'size': config.get('size', 2 ** 15),
                            'learn_start': learn_start,
@@ -54,7 +76,7 @@ class ReplayBufferManager:
                            }
             if verbose:
                 print('target: SL ', config)
-            self._buffer = ReservoirExperienceReplay(self.config)
+            self._buffer = ReservoirExperienceReplay(self.config, rng=rng)
         else:
             raise Exception('Experience Replay target not supported')
 
@@ -64,6 +86,11 @@ class ReplayBufferManager:
 
         self.batch_size = config.get('batch_size', 64)
         self._last_step_buffer = None
+        # the buffers can be sampled and updated from a background thread (see ReplayPrefetcher)
+        self._lock = threading.RLock()
+        # to measure how many times each transition is replayed
+        self.n_stored = 0
+        self.n_sampled = 0
        # self.h = xxhash.xxh32()
 
     @staticmethod
@@ -73,7 +100,9 @@ class ReplayBufferManager:
                 experience['a'],
                 experience['r'],
                 experience['next_s'],
-                experience['t'])
+                experience['t'],
+                experience['a_idx'],
+                experience['next_legal_mask'])
 
     def store_experience(self, experience):
         if self.target == 'sl':
@@ -87,6 +116,8 @@ class ReplayBufferManager:
         if not self.is_last_step_buffer_empty:
             # update T_{t-1}
             self._last_step_buffer['next_s'] = experience['s']
+            # packed mask of the actions authorized in next_s (0 if next_s is terminal)
+            self._last_step_buffer['next_legal_mask'] = experience['legal_mask']
             if experience['is_terminal']:
                 self._last_step_buffer['r'] += experience['final_reward']
             # store T_{t-1} in a real buffer
@@ -104,33 +135,87 @@ class ReplayBufferManager:
     def size(self):
         return self._buffer.record_size
 
+    @property
+    def nbytes(self):
+        '''
+        bytes of the numpy arrays of the stored experiences (an array shared by several experiences, e.g the next
+        state of a transition and the state of the following one, is counted once)
+        '''
+        with self._lock:
+            experiences = self._buffer._experience.values() if self.target == 'rl' else self._buffer.buffer
+            seen = set()
+            return sum(_arrays_nbytes(exp, seen) for exp in experiences)
+
     @property
     def is_last_step_buffer_empty(self):
         return self._last_step_buffer == None
 
     def store(self, exp_tuple):
-        res = self._buffer.store(exp_tuple)
+        with self._lock:
+            res = self._buffer.store(exp_tuple)
+            self.n_stored += 1
         if not res:
             raise Exception('failed to store', exp_tuple)
 
-    def sample(self, global_step):
+    def sample(self, global_step, n_batches=1):
         '''
         params:
             global step: required to anneal the bias (beta)
+            n_batches: number of minibatches to sample. They are stacked together (one after the other)
+                       so that stacking them is done once
         returns:
-            exps: numpy array of (s, a, r, next_s, t)
-                  whose dimension is batch_size x 5
+            exps: batched (s, a, r, next_s, t, a_idx, next_legal_mask) (see _batch_stack)
             weights: importance weights to adjust for sampling bias
             exp_ids: experience ids required for updates later
         '''
+        # stacking the experiences doesn't need the lock: they are never modified once stored
         if self.target == 'rl':
-            exps, imp_weights, exp_ids = self._buffer.sample(global_step)
-            if exps == False:
-                raise Exception('check learn start vs.')
-            return self._batch_stack(exps), imp_weights, exp_ids
+            exps, imp_weights, exp_ids = [], [], []
+            with self.profiler.phase('sample'), self._lock:
+                for _ in range(n_batches):
+                    batch_exps, batch_imp_weights, batch_exp_ids = self._buffer.sample(global_step)
+                    if batch_exps == False:
+                        raise Exception('check learn start vs.')
+                    exps += batch_exps
+                    imp_weights.append(batch_imp_weights)
+                    exp_ids += batch_exp_ids
+                self.n_sampled += len(exps)
+            with self.profiler.phase('batch_stack'):
+                return self._batch_stack(exps), np.concatenate(imp_weights), exp_ids
         else:
-            exps = self._buffer.sample()
-            return self._batch_stack(exps)
+            exps = []
+            with self.profiler.phase('sample'), self._lock:
+                for _ in range(n_batches):
+                    exps += self._buffer.sample()
+                self.n_sampled += len(exps)
+            with self.profiler.phase('batch_stack'):
+                return self._batch_stack(exps)
+
+    @property
+    def replay_ratio(self):
+        '''
+        average number of times each stored transition was sampled
+        '''
+        return self.n_sampled / max(self.n_stored, 1)
+
+    def state_dict(self):
+        '''
+        the stored experiences and the sampling state, pickled (the random generator is not included, see game.rng)
+        '''
+        with self._lock:
+            buffer = {k: v for k, v in vars(self._buffer).items() if k != 'rng'}
+            return pickle.dumps({'buffer': buffer,
+                                 'last_step_buffer': self._last_step_buffer,
+                                 'n_stored': self.n_stored,
+                                 'n_sampled': self.n_sampled}, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load_state_dict(self, state):
+        state = pickle.loads(state)
+        with self._lock:
+            vars(self._buffer).update(state['buffer'])
+            self._last_step_buffer = state['last_step_buffer']
+            self.n_stored = state['n_stored']
+            self.n_sampled = state['n_sampled']
 
     def update(self, exp_ids, deltas):
         '''
@@ -139,81 +224,37 @@ class ReplayBufferManager:
             deltas: list of absolute td errors
         '''
         if self.target == 'rl':
-            self._buffer.update_priority(exp_ids, deltas)
+            with self._lock:
+                self._buffer.update_priority(exp_ids, deltas)
 
     def _batch_stack(self, exps):
         '''
-        fix this...
+        stack a list of experiences into batched numpy arrays
+        rl: [state features, actions, rewards, next state features, time steps, action indexes, next legal masks]
+        sl: [state features, actions, action indexes]
+        action indexes are the Q/pi outputs of the actions (computed once when the experience was stored)
         '''
-        exps_batch = []
-        num_features = 11
-        # suboptimal performance
-        # let's refactor later
         if self.target == 'rl':
-            # TODO: refactor this
-            states = exps[:, 0]
-            actions = np.stack(exps[:, 1])
-            rewards = exps[:, 2]
-            next_states = exps[:, 3]
-            time_steps = exps[:, 4]
-#            state_hashes = []
-
-            state_batch = [[] for _ in range(num_features)]
-            for s in states:
-                # store hahes of states for debugging
-                # hash hand, board, pot, stack, opponent stack
-                # big blind dealer
-#                self.h.update(s[0])
-#                self.h.update(s[1])
-#                self.h.update(s[2])
-#                self.h.update(s[3])
-#                self.h.update(s[4])
-#                self.h.update(s[5])
-#                self.h.update(s[6])
-#                d = self.h.intdigest()
-#                state_hashes.append(d)
-#                self.h.reset()
-                for i, feature in enumerate(s):
-                    state_batch[i].append(feature)
-            state_batch = [np.concatenate(s) for s in state_batch]
-
-            next_state_batch = [[] for _ in range(num_features)]
-            for s in next_states:
-                for i, feature in enumerate(s):
-                    next_state_batch[i].append(feature)
-            next_state_batch = [np.concatenate(s) for s in next_state_batch]
-
-            exps_batch.append(state_batch)
-            exps_batch.append(actions)
-            exps_batch.append(rewards)
-            exps_batch.append(next_state_batch)
-            exps_batch.append(time_steps)
-            #exps_batch.append(state_hashes)
-
+            states, actions, rewards, next_states, time_steps, action_idxs, next_legal_masks = zip(*exps)
+            return [self._stack_states(states),
+                    np.stack(actions),
+                    np.array(rewards),
+                    self._stack_states(next_states),
+                    np.array(time_steps),
+                    np.array(action_idxs, dtype=np.int64),
+                    np.array(next_legal_masks, dtype=np.int64)]
         elif self.target == 'sl':
-            states = [e[0] for e in exps]
-            actions = [e[1] for e in exps]
-#            state_hashes = []
-
-            state_batch = [[] for _ in range(num_features)]
-            for s in states:
-                # store hahes of states for debugging
-#                self.h.update(s[0])
-#                self.h.update(s[1])
-#                self.h.update(s[2])
-#                self.h.update(s[3])
-#                self.h.update(s[4])
-#                self.h.update(s[5])
-#                self.h.update(s[6])
-#                d = self.h.intdigest()
-#                state_hashes.append(d)
-#                self.h.reset()
-                for i, feature in enumerate(s):
-                    state_batch[i].append(feature)
-            state_batch = [np.concatenate(s) for s in state_batch]
-            exps_batch.append(state_batch)
-            exps_batch.append(actions)
-            #exps_batch.append(state_hashes)
+            states, actions, action_idxs = list(zip(*exps))[:3]
+            return [self._stack_states(states),
+                    list(actions),
+                    np.array(action_idxs, dtype=np.int64)]
         else:
             raise Exception('Unsuported Experience Replay Target')
-        return exps_batch
+
+    @staticmethod
+    def _stack_states(states):
+        '''
+        states: list of states, each of them a list of 11 features of shape 1 x ...
+        returns a list of 11 features of shape batch_size x ...
+        '''
+        return [np.concatenate(feature) for feature in zip(*states)]
@@ -0,0 +1,99 @@
+import queue
+import threading
+
+
+class ReplayPrefetcher:
+    '''
+    Keeps `n_batches` minibatches ready to be used, sampled from a ReplayBufferManager by a background thread.
+    The priority updates of the learner are queued and applied by the same thread, so that the optimization step
+    never waits for the memory.
+
+    Note that a prefetched minibatch was sampled with the priorities known when it was sampled (at most
+    `n_batches` updates ago), and that its experiences may have been replaced in the memory before its priorities
+    are updated. This is the usual trade-off of asynchronous prioritized replay.
+
+    When there is nothing to do (the minibatches are ready, or the memory is not ready to be sampled), the thread
+    sleeps until it is woken up by `get`, `update` or `notify` (to call when experiences are stored in the memory).
+    '''
+
+    def __init__(self, memory, n_batches, is_ready, transform=None, minibatches_per_sample=1):
+        '''
+        params:
+            memory: ReplayBufferManager to sample from
+            n_batches: number of samples to keep ready
+            is_ready: function telling whether the memory contains enough experiences to be sampled
+            transform: function applied to each sample in the background thread (e.g conversion to variables)
+            minibatches_per_sample: number of minibatches sampled together (see ReplayBufferManager.sample)
+        '''
+        self.memory = memory
+        self.is_ready = is_ready
+        self.transform = transform
+        self.minibatches_per_sample = minibatches_per_sample
+        self.global_step = 0
+
+        self.n_batches = n_batches
+        # not bounded by the queue itself: an error is queued even when n_batches minibatches are ready
+        self._batches = queue.Queue()
+        self._updates = queue.Queue()
+        self._stop = threading.Event()
+        self._wake_up = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='{}_prefetcher'.format(memory.target))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def get(self, global_step):
+        '''
+        params:
+            global_step: the sampling of the next minibatches uses it to anneal the bias
+        returns:
+            a minibatch, as returned by memory.sample (and transformed)
+        '''
+        self.global_step = global_step
+        batch = self._batches.get()
+        self._wake_up.set()
+        if isinstance(batch, Exception):
+            raise batch
+        return batch
+
+    def update(self, exp_ids, deltas):
+        '''
+        queue a priority update (see ReplayBufferManager.update)
+        '''
+        self._updates.put((exp_ids, deltas))
+        self._wake_up.set()
+
+    def notify(self):
+        '''
+        tell the thread that the memory changed (it may be ready to be sampled now)
+        '''
+        self._wake_up.set()
+
+    def close(self):
+        self._stop.set()
+        self._wake_up.set()
+        self._thread.join()
+
+    def _apply_updates(self):
+        while True:
+            try:
+                exp_ids, deltas = self._updates.get_nowait()
+            except queue.Empty:
+                return
+            self.memory.update(exp_ids, deltas)
+
+    def _run(self):
+        while not self._stop.is_set():
+            # cleared before checking, so that a wake up during the checks is not missed
+            self._wake_up.clear()
+            try:
+                self._apply_updates()
+                if self._batches.qsize() >= self.n_batches or not self.is_ready():
+                    self._wake_up.wait()
+                    continue
+                batch = self.memory.sample(self.global_step, n_batches=self.minibatches_per_sample)
+                if self.transform is not None:
+                    batch = self.transform(batch)
+            except Exception as e:
+                # let the learner raise it (errors of the sampling and of the priority updates)
+                batch = e
+            self._batches.put(batch)
@@ -6,16 +6,17 @@
 
 import sys
 import math
-import random
 import numpy as np
 
 from experience_replay import binary_heap
+from game.rng import get_rng
 
 
 class RankExperienceReplay(object):
     # TODO: save the experience in a pickle?
-    def __init__(self, conf):
+    def __init__(self, conf, rng=None):
         self.size = conf['size']
+        self.rng = get_rng(rng)
         self.replace_flag = conf['replace_old'] if 'replace_old' in conf else True
         self.priority_size = conf['priority_size'] if 'priority_size' in conf else self.size
 
@@ -175,8 +176,8 @@ class RankExperienceReplay(object):
         for n in range(1, self.batch_size + 1):
             # TODO: fix this hack
             try:
-                index = random.randint(distribution['strata_ends'][n] + 1,
-                                       distribution['strata_ends'][n + 1])
+                index = int(self.rng.integers(distribution['strata_ends'][n] + 1,
+                                              distribution['strata_ends'][n + 1] + 1))
             except ValueError:
                 index = distribution['strata_ends'][n] + 1
             rank_list.append(index)
@@ -193,5 +194,5 @@ class RankExperienceReplay(object):
         # convert to experience id
         rank_e_id = self.priority_queue.priority_to_experience(rank_list)
         # get experience id according rank_e_id
-        experience = np.array(self.retrieve(rank_e_id))
+        experience = self.retrieve(rank_e_id)
         return experience, w, rank_e_id
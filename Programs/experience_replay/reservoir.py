@@ -1,9 +1,10 @@
 import sys
 import math
-import random
 from collections import deque
 import pickle
 
+from game.rng import get_rng
+
 RESERVOIR_ER = ''
 
 class ExperienceReplayStoreError(Exception):
@@ -11,9 +12,10 @@ class ExperienceReplayStoreError(Exception):
 
 class ReservoirExperienceReplay():
     # TODO: save the experience in a pickle
-    def __init__(self, conf):
+    def __init__(self, conf, rng=None):
         self.size = conf['size']
         self.batch_size = conf['batch_size']
+        self.rng = get_rng(rng)
         self._buffer = deque(maxlen=self.size)
 
     @property
@@ -54,7 +56,8 @@ class ReservoirExperienceReplay():
         '''
         '''
         try:
-            return random.sample(self.buffer, self.batch_size)
+            idxs = self.rng.choice(len(self.buffer), self.batch_size, replace=False)
+            return [self.buffer[i] for i in idxs]
         except ValueError:
             print('Not enough data to sample from the buffer')
             return None
@@ -0,0 +1,113 @@
+"""
+Heads-up betting round as a state machine
+
+The state of a betting round is a single integer encoding
+    - the phase: after preflop, preflop while nobody played twice (the SB/BB special case), or later preflop
+    - the type of the last action of the small blind (dealer) and of the big blind ('none' if they didn't play yet)
+This is all `agreement` needs to know whether the round is over. The transitions and the end of the rounds are
+precomputed in tables, so that they can also be applied to arrays of states (one per table).
+"""
+import numpy as np
+
+
+ACTION_TYPES = ['none', 'check', 'bet', 'call', 'raise', 'all in', 'fold']
+TYPE_TO_IDX = {action_type: i for i, action_type in enumerate(ACTION_TYPES)}
+N_TYPES = len(ACTION_TYPES)
+
+# phases
+POSTFLOP, PREFLOP_FIRST, PREFLOP = range(3)
+N_PHASES = 3
+N_STATES = N_PHASES * N_TYPES * N_TYPES
+
+# positions
+SB, BB = 0, 1
+
+
+def encode(phase, last_sb, last_bb):
+    return (phase * N_TYPES + last_sb) * N_TYPES + last_bb
+
+
+def decode(state):
+    """
+    :return: phase, type index of the last action of the SB, type index of the last action of the BB
+    """
+    return state // (N_TYPES * N_TYPES), (state // N_TYPES) % N_TYPES, state % N_TYPES
+
+
+def _is_over(phase, last_sb, last_bb):
+    """the rules of the end of a betting round (historically implemented in `agreement`)"""
+    if last_sb == 0 or last_bb == 0:
+        # somebody didn't play yet
+        return False
+    last_sb, last_bb = ACTION_TYPES[last_sb], ACTION_TYPES[last_bb]
+    pair = {last_sb, last_bb}
+    if phase == PREFLOP_FIRST:
+        # if the SB called and the BB raised, it continues playing. If the SB raised and the BB called, it ends
+        if last_sb == 'raise' and last_bb == 'call':
+            return True
+    elif pair == {'raise', 'call'}:
+        return True
+    if 'fold' in pair:
+        return True
+    # 2 checks, check/call, bet/call, all-in/call, 2 all-ins
+    return pair in ({'check'}, {'check', 'call'}, {'bet', 'call'}, {'all in', 'call'}, {'all in'})
+
+
+def _transition(state, position, action_type):
+    phase, last_sb, last_bb = decode(state)
+    lasts = [last_sb, last_bb]
+    if phase == PREFLOP_FIRST and lasts[position] != 0:
+        # somebody plays for the 2nd time: the special case of the first actions is over
+        phase = PREFLOP
+    lasts[position] = action_type
+    return encode(phase, *lasts)
+
+
+# TRANSITIONS[state, position, action type] -> next state
+TRANSITIONS = np.array([[[_transition(s, p, a) for a in range(N_TYPES)] for p in range(2)] for s in range(N_STATES)])
+IS_OVER = np.array([_is_over(*decode(s)) for s in range(N_STATES)])
+
+
+def initial_state(b_round):
+    return encode(POSTFLOP if b_round > 0 else PREFLOP_FIRST, 0, 0)
+
+
+def step(states, positions, type_idxs):
+    """
+    :param states: a state or an array of states
+    :param positions: SB (the dealer) or BB, the position of the player who acted (or an array of positions)
+    :param type_idxs: the index of the type of the action in ACTION_TYPES (or an array of indexes)
+    :return: the next state(s)
+    """
+    return TRANSITIONS[states, positions, type_idxs]
+
+
+def is_over(states):
+    """True if the betting round is over (works on arrays of states)"""
+    return IS_OVER[states]
+
+
+def last_action_type(state, position):
+    """:return: the type of the last action of the player at position in this round ('none' if it didn't play)"""
+    return ACTION_TYPES[decode(state)[1 + position]]
+
+
+def get_dealer(actions):
+    """the dealer posted the small blind (see `blinds`)"""
+    return 0 if actions[-1][0] == 1 else 1
+
+
+def state_from_actions(actions, b_round, dealer=None):
+    """
+    :param actions: a dict {b_round: {player_id: [actions]}} (-1 is for the blinds)
+    :param dealer: id of the dealer, read from the blinds if not given
+    :return: the state of the betting round b_round
+    """
+    dealer = dealer if dealer is not None else get_dealer(actions)
+    plays = actions[b_round][dealer], actions[b_round][1 - dealer]
+    if b_round > 0:
+        phase = POSTFLOP
+    else:
+        phase = PREFLOP_FIRST if max(len(plays[SB]), len(plays[BB])) <= 1 else PREFLOP
+    lasts = [TYPE_TO_IDX[p[-1].type] if len(p) > 0 else 0 for p in plays]
+    return encode(phase, *lasts)
@@ -0,0 +1,185 @@
+"""
+Checkpoints of the whole training state of a Simulator, to resume a run where it stopped
+
+A checkpoint holds, for each NFSP player, the weights of Q, pi and the target network, the states of their optimizers,
+eps and eta (and optionally the replay memories), and for the simulator the episode and game counters, the global
+step, the stacks, the dealer, the order of the deck and the states of all the random generators (see game.rng).
+It is taken between two episodes: the state is snapshot (copied) in the game loop, and serialized and written to disk
+in a background thread while the training goes on. The file is written under a temporary name and renamed once it is
+complete, so that the latest checkpoint of a directory is always a complete one.
+
+A resumed run is the same as the run that was not stopped only without replay prefetching (prefetch_batches=0, see
+experience_replay.prefetch). The prefetcher threads sample the memories ahead of the learner: their batches and the
+priority updates not applied yet are not part of the checkpoint, and the generators of the memories were already
+advanced by the samples being prefetched.
+"""
+import copy
+import glob
+import os
+import random
+import threading
+
+import numpy as np
+import torch as t
+
+CHECKPOINT_FILENAME = 'checkpoint_{:012d}.pt'
+
+
+def latest_checkpoint(path):
+    """
+    :return: the path of the checkpoint of path with the most episodes, None if there is none
+    """
+    checkpoints = sorted(glob.glob(os.path.join(path, CHECKPOINT_FILENAME.replace('{:012d}', '*'))))
+    return checkpoints[-1] if len(checkpoints) > 0 else None
+
+
+def _snapshot(state_dict):
+    return {k: v.detach().clone() for k, v in state_dict.items()}
+
+
+def training_state(simulator, include_memories=False):
+    """
+    :return: a copy of the training state of the simulator, that is not modified when the training goes on
+    """
+    players = {}
+    for p in simulator.players:
+        if p.player_type != 'nfsp':
+            continue
+        strategy = p.strategy
+        players[p.id] = {'Q': _snapshot(strategy._Q.state_dict()),
+                         'pi': _snapshot(strategy._pi.state_dict()),
+                         'target_Q': _snapshot(strategy._target_Q.network.state_dict()),
+                         'Q_optim': copy.deepcopy(strategy._Q.optim.state_dict()),
+                         'pi_optim': copy.deepcopy(strategy._pi.optim.state_dict()),
+                         'eps': strategy.eps,
+                         'eta': strategy.eta}
+        if include_memories:
+            players[p.id]['memory_rl'] = p.memory_rl.state_dict()
+            players[p.id]['memory_sl'] = p.memory_sl.state_dict()
+    return {'players': players,
+            'games': {'n': simulator.games['n'], '#episodes': simulator.games['#episodes']},
+            'global_step': simulator.global_step,
+            'new_game': simulator.new_game,
+            'dealer': simulator.dealer,
+            # the deck is reused from an episode to the next (see game_utils.Deck)
+            'deck_order': list(simulator.deck.order),
+            'stacks': [p.stack for p in simulator.players],
+            'runtime_counts': dict(simulator.runtime.counts),
+            'seed': simulator.seed,
+            'rng_streams': simulator.rng_streams.state_dict(),
+            'global_rngs': {'random': random.getstate(),
+                            'numpy': np.random.get_state(),
+                            'torch': t.get_rng_state()}}
+
+
+def restore_training_state(simulator, state):
+    for p in simulator.players:
+        if p.player_type != 'nfsp' or p.id not in state['players']:
+            continue
+        player_state = state['players'][p.id]
+        strategy = p.strategy
+        strategy._Q.load_state_dict(player_state['Q'])
+        strategy._pi.load_state_dict(player_state['pi'])
+        strategy._target_Q.network.load_state_dict(player_state['target_Q'])
+        strategy._Q.optim.load_state_dict(player_state['Q_optim'])
+        strategy._pi.optim.load_state_dict(player_state['pi_optim'])
+        strategy.eps = player_state['eps']
+        strategy.eta = player_state['eta']
+        if 'memory_rl' in player_state:
+            p.memory_rl.load_state_dict(player_state['memory_rl'])
+            p.memory_sl.load_state_dict(player_state['memory_sl'])
+        if p.flat_parameters is not None:
+            # the copies of the networks must pull the restored weights (see WeightBroadcaster)
+            p.flat_parameters.bump()
+    simulator.games['n'] = state['games']['n']
+    simulator.games['#episodes'] = state['games']['#episodes']
+    simulator.global_step = state['global_step']
+    simulator.new_game = state['new_game']
+    simulator.dealer = state['dealer']
+    simulator.deck.order = list(state['deck_order'])
+    for p, stack in zip(simulator.players, state['stacks']):
+        p.stack = stack
+        p.is_dealer = p.id == simulator.dealer
+    simulator.runtime.counts.update(state['runtime_counts'])
+    simulator.rng_streams.load_state_dict(state['rng_streams'])
+    random.setstate(state['global_rngs']['random'])
+    np.random.set_state(state['global_rngs']['numpy'])
+    t.set_rng_state(state['global_rngs']['torch'])
+
+
+class Checkpointer:
+    def __init__(self, path, keep=2, background=True, include_memories=False):
+        """
+        :param path: directory of the checkpoints
+        :param keep: number of checkpoints kept (the older ones are deleted)
+        :param background: write the checkpoints in a background thread
+        :param include_memories: include the replay memories (they can be much larger than the networks, and are
+        pickled in the game loop)
+        """
+        self.path = path
+        self.keep = keep
+        self.background = background
+        self.include_memories = include_memories
+        os.makedirs(path, exist_ok=True)
+        self._thread = None
+        self._error = None
+
+    def save(self, simulator):
+        """
+        snapshot the training state of the simulator, and write it (in the background, unless background is False)
+        :return: the path of the checkpoint
+        """
+        state = training_state(simulator, self.include_memories)
+        checkpoint_path = os.path.join(self.path, CHECKPOINT_FILENAME.format(simulator.games['#episodes']))
+        # only one checkpoint is written at a time
+        self.wait()
+        if self.background:
+            self._thread = threading.Thread(target=self._write, args=(state, checkpoint_path),
+                                            name='Checkpointer')
+            self._thread.start()
+        else:
+            self._write(state, checkpoint_path)
+            self._raise_error()
+        return checkpoint_path
+
+    def wait(self):
+        """
+        wait for the checkpoint being written, if any
+        """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._raise_error()
+
+    def restore(self, simulator, checkpoint_path=None):
+        """
+        :param checkpoint_path: the checkpoint to restore (default: the latest one of the directory)
+        :return: the path of the restored checkpoint, None if there was none
+        """
+        if checkpoint_path is None:
+            checkpoint_path = latest_checkpoint(self.path)
+        if checkpoint_path is None:
+            return None
+        # the checkpoint holds numpy and python objects (random states, memories), not only tensors
+        state = t.load(checkpoint_path, map_location='cpu', weights_only=False)
+        restore_training_state(simulator, state)
+        return checkpoint_path
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write(self, state, checkpoint_path):
+        tmp_path = checkpoint_path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                t.save(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, checkpoint_path)
+            checkpoints = sorted(glob.glob(os.path.join(self.path, CHECKPOINT_FILENAME.replace('{:012d}', '*'))))
+            for old in checkpoints[:-self.keep]:
+                os.remove(old)
+        except Exception as e:
+            self._error = e
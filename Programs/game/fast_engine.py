@@ -0,0 +1,575 @@
+"""
+Fast engines for matchups between baseline strategies (random, mirror)
+
+The baselines don't look at the cards: there is no need to build Card objects. Many tables are played side by side:
+the cards of all the tables are drawn with one RNG call and the showdowns are evaluated together (see
+evaluate_hands_batch).
+    - VectorizedEngine plays the betting of all the tables on arrays: stacks, side pots and betting states (see
+      game.betting) are arrays, the legal actions of all the tables are computed at once (see
+      game_utils.legal_actions_arrays) and the random/mirror choices are sampled for the whole array. It only plays
+      strategy_random and strategy_mirror, with the same rules as the Simulator but not the same random draws
+    - BaselineEngine plays any strategy function of a Player: each table goes through the same rules as the Simulator
+      (Player.play, Action, the legal-action table, the betting state machine), one decision at a time. With
+      deal_first, the cards are drawn before the betting and given to the players and the board, for the strategies
+      that look at them (e.g a snapshot of pi evaluated against the baselines, see evaluation.evaluation_worker)
+They are used to calibrate the evaluation baselines and to measure their variance.
+"""
+import numpy as np
+
+from constant import INITIAL_MONEY
+from game import betting
+from game.config import BLINDS
+from game.game_utils import AMOUNT_TO_BUCKET, CARDS, MAX_BET_BUCKET, LegalActionArrays, blinds, deal_card_indexes
+from game.rng import RNGStreams
+from odds.evaluation import evaluate_hands_batch
+from players.player import Player
+from players.strategies import strategy_mirror, strategy_random
+
+# number of cards of the board at each betting round
+BOARD_SIZES = (0, 3, 4, 5)
+
+
+def showdown_scores(cards, is_dealer_0):
+    """
+    :param cards: n x 9 cards (see BaselineEngine.draw_cards)
+    :param is_dealer_0: n booleans, True if player 0 is the dealer
+    :return: the scores of the hands of player 0 and of player 1 (see evaluate_hands_batch)
+    """
+    # the dealer is dealt first (see deal)
+    is_dealer_0 = np.asarray(is_dealer_0, dtype=bool)[:, None]
+    dealer_hands, other_hands = cards[:, [0, 2]], cards[:, [1, 3]]
+    hands_0 = np.concatenate([np.where(is_dealer_0, dealer_hands, other_hands), cards[:, 4:]], axis=1)
+    hands_1 = np.concatenate([np.where(is_dealer_0, other_hands, dealer_hands), cards[:, 4:]], axis=1)
+    # one batch for both players
+    hands = np.concatenate([hands_0, hands_1])
+    scores = evaluate_hands_batch(hands // 4 + 1, hands % 4)
+    return scores[:len(cards)], scores[len(cards):]
+
+
+class _Table:
+    """one heads-up table, replaying the episode logic of the Simulator without its learning machinery"""
+
+    def __init__(self, strategies, dealer, names, rngs):
+        self.players = [Player(p_id, strategy, INITIAL_MONEY, names[p_id], rng=rngs[p_id])
+                        for p_id, strategy in enumerate(strategies)]
+        self.dealer = dealer
+        self.players[dealer].is_dealer = True
+        self.n_episodes_in_game = 0
+
+    def new_game(self):
+        for p in self.players:
+            p.cash(INITIAL_MONEY)
+        self.n_episodes_in_game = 0
+
+    def play_betting(self, episode_idx, cards=None):
+        """
+        play the betting rounds of an episode
+        :param cards: the 9 cards of the episode (see BaselineEngine.draw_cards), None if they are drawn at the showdown
+        :return: True if a showdown is needed to decide the winner
+        """
+        players = self.players
+        # stacks before the blinds, to compute the rewards of the episode
+        self.start_stacks = [p.stack for p in players]
+        self.cards = cards
+        self.board = []
+        if cards is not None:
+            # the dealer is dealt first (see deal)
+            players[self.dealer].cards = [CARDS[cards[0]], CARDS[cards[2]]]
+            players[1 - self.dealer].cards = [CARDS[cards[1]], CARDS[cards[3]]]
+        self.pot = blinds(players)
+        players[0].is_all_in = False
+        players[1].is_all_in = False
+        self.actions = {b_round: {player: [] for player in range(2)} for b_round in range(-1, 4)}
+        self.actions[-1][players[0].id] = players[0].side_pot
+        self.actions[-1][players[1].id] = players[1].side_pot
+        self.fold_occured = False
+        self.winner = None
+        self.null = 0
+        self.all_in = 0
+        for p in players:
+            if p.stack == 0:
+                self.all_in = 2
+                p.is_all_in = True
+
+        for b_round in range(4):
+            if self.all_in < 2:
+                if cards is not None:
+                    self.board = [CARDS[c] for c in cards[4:4 + BOARD_SIZES[b_round]]]
+                self.agreed = False
+                self.betting_state = betting.initial_state(b_round)
+                self.to_play = 1 - self.dealer if b_round != 0 else self.dealer
+                while not self.agreed:
+                    self._play_round(b_round, episode_idx)
+                self._update_side_pot()
+                if self.fold_occured:
+                    break
+            else:
+                self._update_side_pot()
+                break
+        self.n_episodes_in_game += 1
+        return not self.fold_occured
+
+    def _play_round(self, b_round, episode_idx):
+        player = self.players[self.to_play]
+        opponent = self.players[1 - self.to_play]
+        action = player.play(self.board, self.pot, self.actions, b_round, opponent.stack, opponent.side_pot, BLINDS,
+                             episode_idx, betting_state=self.betting_state)
+        if action.type == 'null':
+            self.to_play = 1 - self.to_play
+            self.null += 1
+            if self.null >= 2:
+                self.agreed = True
+            return
+
+        value = action.total
+        player.side_pot += value
+        player.stack -= value
+        self.pot += value
+        self.actions[b_round][player.id].append(action)
+        position = betting.SB if player.id == betting.get_dealer(self.actions) else betting.BB
+        self.betting_state = betting.step(self.betting_state, position, betting.TYPE_TO_IDX[action.type])
+
+        if action.type == 'all in':
+            self.all_in += 1
+            player.is_all_in = True
+            if player.side_pot <= opponent.side_pot:
+                self.all_in += 1
+        elif action.type == 'call' and self.all_in == 1:
+            self.all_in += 1
+
+        if action.type == 'fold':
+            self.fold_occured = True
+            for p in self.players:
+                p.contribution_in_this_pot = p.side_pot
+                p.side_pot = 0
+            self.winner = 1 - self.to_play
+            self.agreed = True
+            return
+        self.agreed = betting.is_over(self.betting_state) or (self.all_in == 2)
+        self.to_play = 1 - self.to_play
+
+    def _update_side_pot(self):
+        for p in self.players:
+            p.contribution_in_this_pot += p.side_pot
+            p.side_pot = 0
+
+    def settle(self, winner=None, split=False):
+        """
+        distribute the pot (same rules as Simulator._handle_split/_handle_no_split) and prepare the next episode
+        :return: True if the game is over (somebody is bankrupt)
+        """
+        players = self.players
+        if split:
+            for p in players:
+                p.stack += p.contribution_in_this_pot
+        else:
+            if winner is not None:
+                self.winner = winner
+            w = self.winner
+            s_pot = players[w].contribution_in_this_pot
+            if s_pot * 2 >= self.pot:
+                players[w].stack += self.pot
+            else:
+                players[w].stack += 2 * s_pot
+                players[1 - w].stack += self.pot - 2 * s_pot
+
+        self.pot = 0
+        self.dealer = 1 - self.dealer
+        players[self.dealer].is_dealer = True
+        players[1 - self.dealer].is_dealer = False
+        for p in players:
+            p.contribution_in_this_pot = 0
+        return players[0].stack == 0 or players[1].stack == 0
+
+
+class BaselineEngine:
+    def __init__(self, strategy_p1, strategy_p2, n_tables=64, seed=None, names=('SB', 'DH'), rng_streams=None,
+                 deal_first=False):
+        """
+        :param strategy_p1: strategy function of the first player (e.g strategy_random)
+        :param strategy_p2: strategy function of the second player
+        :param n_tables: number of tables played side by side
+        :param seed: seed of the run (ignored if rng_streams is given)
+        :param rng_streams: RNGStreams of the run (see game.rng): the cards and the initial dealers use the stream of
+        table 0, the players of each table have their own stream
+        :param deal_first: deal the cards before the betting, for the strategies that look at them
+        """
+        self.rng_streams = rng_streams if rng_streams is not None else RNGStreams(seed)
+        self.rng = self.rng_streams.table()
+        dealers = self.rng.integers(0, 2, n_tables)
+        self.tables = [_Table([strategy_p1, strategy_p2], int(dealer), names,
+                              [self.rng_streams.actor(p_id, table_id) for p_id in range(2)])
+                       for table_id, dealer in enumerate(dealers)]
+        self.deal_first = deal_first
+        self.n_episodes = 0
+
+    def draw_cards(self, n):
+        """
+        :return: n x 9 cards (card = 4 * rank index + suit index): hand of the dealer, hand of the other player, board
+        """
+        return deal_card_indexes(n, rng=self.rng)
+
+    def _play_episodes(self, tables=None):
+        """
+        play an episode on each table
+        :param tables: the tables to play on (all of them by default)
+        :return: list of (rewards of the players, id of the winner of the game if it is over (None otherwise),
+                 number of episodes of the game), one per table
+        """
+        tables = self.tables if tables is None else tables
+        if self.deal_first:
+            dealt = self.draw_cards(len(tables))
+            is_showdown = np.array([table.play_betting(self.n_episodes, table_cards)
+                                    for table, table_cards in zip(tables, dealt)], dtype=bool)
+            showdowns = [table for table, showdown in zip(tables, is_showdown) if showdown]
+            cards = dealt[is_showdown]
+        else:
+            showdowns = [table for table in tables if table.play_betting(self.n_episodes)]
+            cards = self.draw_cards(len(showdowns)) if len(showdowns) > 0 else None
+        self.n_episodes += len(tables)
+
+        results = {}
+        if len(showdowns) > 0:
+            scores_0, scores_1 = showdown_scores(cards, [table.dealer == 0 for table in showdowns])
+            for table, score_0, score_1 in zip(showdowns, scores_0, scores_1):
+                results[id(table)] = (score_0, score_1)
+
+        episodes = []
+        for table in tables:
+            if id(table) in results:
+                score_0, score_1 = results[id(table)]
+                game_over = table.settle(winner=int(score_1 > score_0), split=score_0 == score_1)
+            else:
+                game_over = table.settle()
+            rewards = tuple(p.stack - stack for p, stack in zip(table.players, table.start_stacks))
+            if game_over:
+                episodes.append((rewards, int(table.players[1].stack > 0), table.n_episodes_in_game))
+                table.new_game()
+            else:
+                episodes.append((rewards, None, table.n_episodes_in_game))
+        return episodes
+
+    def run(self, n_games):
+        """
+        Each table plays the same number of games (up to one). Keeping the games that end first instead would favour
+        the short games
+        :return: a dict with, for each game (the first game of each table, then the second one, ...):
+                 'winners' (id of the player who won the game), 'episodes' (number of episodes of the game)
+        """
+        games_per_table = -(-n_games // len(self.tables))
+        games = [[] for _ in self.tables]
+        for table in self.tables:
+            table.new_game()
+        active = list(range(len(self.tables)))
+        while len(active) > 0:
+            played = self._play_episodes([self.tables[i] for i in active])
+            for i, (_, winner, n_episodes) in zip(active, played):
+                if winner is not None:
+                    games[i].append((winner, n_episodes))
+            active = [i for i in active if len(games[i]) < games_per_table]
+        ordered = [table_games[k] for k in range(games_per_table) for table_games in games][:n_games]
+        return {'winners': np.array([winner for winner, _ in ordered]),
+                'episodes': np.array([n_episodes for _, n_episodes in ordered])}
+
+    def run_episodes(self, n_episodes):
+        """
+        :return: array n_episodes x 2 of the rewards (profit) of each player in each episode
+        """
+        rewards = []
+        for table in self.tables:
+            table.new_game()
+        while len(rewards) < n_episodes:
+            rewards.extend(r for r, _, _ in self._play_episodes())
+        return np.array(rewards[:n_episodes], dtype=np.int64)
+
+
+_CALL, _RAISE, _ALL_IN, _FOLD = [betting.TYPE_TO_IDX[action_type] for action_type in ('call', 'raise', 'all in', 'fold')]
+
+
+def _choose_random(situations, rows, preflop, rng):
+    """
+    a bucket chosen uniformly among the authorized ones (see strategy_random)
+    :param situations: LegalActionArrays of the decisions
+    :param rows: the decisions of the player
+    :param preflop: whether each decision (of rows) is preflop
+    """
+    extra, low, high, all_in = situations.extra[rows], situations.low[rows], situations.high[rows], \
+        situations.all_in[rows]
+    # the authorized buckets in the order of authorized_actions_buckets: fold or check, extra, range, all in
+    has_extra = extra != -2
+    n_range = np.maximum(high - low + 1, 0)
+    picks = rng.integers(0, 1 + has_extra + n_range + all_in)
+    in_range = picks - 1 - has_extra
+    return np.where(picks == 0, np.where(situations.check[rows], 0, -1),
+                    np.where(has_extra & (picks == 1), extra, np.where(in_range < n_range, low + in_range, 14)))
+
+
+def _choose_mirror(situations, rows, preflop, rng):
+    """see strategy_mirror (and _choose_random)"""
+    types = betting.TYPE_TO_IDX
+    opponent_types = situations.opponent_types[rows]
+    first_to_play = np.where(preflop, np.where(MAX_BET_BUCKET[situations.stacks[rows]] <= 2, 14, 1), 0)
+    # after a raise, the authorized bucket after the fold: the call (or the all in)
+    extra, low, high = situations.extra[rows], situations.low[rows], situations.high[rows]
+    after_raise = np.where(extra != -2, extra, np.where(low <= high, low, 14))
+    return np.select([opponent_types == types['none'],
+                      (opponent_types == types['check']) | (opponent_types == types['call']),
+                      opponent_types == types['bet'], opponent_types == types['all in']],
+                     [first_to_play, 0, AMOUNT_TO_BUCKET[situations.opponent_last_values[rows]], 14], after_raise)
+
+
+# choice of each baseline strategy for an array of decisions: the buckets chosen from the authorized ones
+BASELINE_CHOICES = {strategy_random: _choose_random, strategy_mirror: _choose_mirror}
+
+
+class VectorizedEngine:
+    """
+    The tables are not played in lockstep: each decision step plays the next decision of every table, whatever its
+    betting round, and a table starts its next round (or episode) as soon as the previous one is over. This keeps the
+    arrays full: an episode only takes a few decisions
+    """
+
+    def __init__(self, strategy_p1, strategy_p2, n_tables=4096, seed=None, rng_streams=None):
+        """
+        :param strategy_p1: strategy function of the first player (strategy_random or strategy_mirror)
+        :param strategy_p2: strategy function of the second player
+        :param n_tables: number of tables played side by side
+        :param seed: seed of the run (ignored if rng_streams is given)
+        :param rng_streams: RNGStreams of the run (see game.rng): the cards and the initial dealers use the stream of
+        table 0, the decisions of each player the stream of its actor on table 0
+        """
+        for strategy in (strategy_p1, strategy_p2):
+            if strategy not in BASELINE_CHOICES:
+                raise ValueError('VectorizedEngine only plays strategy_random and strategy_mirror, not ' +
+                                 str(strategy))
+        self.choices = [BASELINE_CHOICES[strategy_p1], BASELINE_CHOICES[strategy_p2]]
+        self.rng_streams = rng_streams if rng_streams is not None else RNGStreams(seed)
+        self.rng = self.rng_streams.table()
+        self.actor_rngs = [self.rng_streams.actor(p_id) for p_id in range(2)]
+        self.n_tables = n_tables
+        self.dealers = self.rng.integers(0, 2, n_tables)
+        self.stacks = np.full((n_tables, 2), INITIAL_MONEY, dtype=np.int64)
+        self.n_episodes_in_game = np.zeros(n_tables, dtype=np.int64)
+        self.n_episodes = 0
+
+        # the episode being played on each table (see _Table.play_betting)
+        self.start_stacks = np.zeros((n_tables, 2), dtype=np.int64)
+        self.side_pots = np.zeros((n_tables, 2), dtype=np.int64)
+        self.contributions = np.zeros((n_tables, 2), dtype=np.int64)
+        self.pots = np.zeros(n_tables, dtype=np.int64)
+        self.is_all_in = np.zeros((n_tables, 2), dtype=bool)
+        self.n_all_in = np.zeros(n_tables, dtype=np.int64)
+        self.n_null = np.zeros(n_tables, dtype=np.int64)
+        self.folded = np.zeros(n_tables, dtype=bool)
+        self.winners = np.zeros(n_tables, dtype=np.int64)
+        # whether each player took an action preflop
+        self.played_preflop = np.zeros((n_tables, 2), dtype=bool)
+        # the betting round being played on each table
+        self.b_rounds = np.zeros(n_tables, dtype=np.int64)
+        self.betting_states = np.zeros(n_tables, dtype=np.int64)
+        self.to_play = np.zeros(n_tables, dtype=np.int64)
+        # value of the last action of each player in the round, and its number of min-raises
+        self.last_values = np.zeros((n_tables, 2), dtype=np.int64)
+        self.n_min_raises = np.zeros((n_tables, 2), dtype=np.int64)
+
+    def draw_cards(self, n):
+        """see BaselineEngine.draw_cards"""
+        return deal_card_indexes(n, rng=self.rng)
+
+    def _new_games(self, tables):
+        self.stacks[tables] = INITIAL_MONEY
+        self.n_episodes_in_game[tables] = 0
+
+    def _new_episodes(self, tables):
+        dealers, stacks = self.dealers[tables], self.stacks[tables]
+        self.start_stacks[tables] = stacks
+        # blinds (see blinds)
+        rows = np.arange(len(tables))
+        side_pots = np.zeros((len(tables), 2), dtype=np.int64)
+        side_pots[rows, dealers] = np.minimum(stacks[rows, dealers], BLINDS[0])
+        side_pots[rows, 1 - dealers] = np.minimum(stacks[rows, 1 - dealers], BLINDS[1])
+        self.stacks[tables] = stacks - side_pots
+        self.side_pots[tables] = side_pots
+        self.pots[tables] = side_pots.sum(axis=1)
+        self.contributions[tables] = 0
+        self.is_all_in[tables] = stacks == side_pots
+        self.n_all_in[tables] = np.where(self.is_all_in[tables].any(axis=1), 2, 0)
+        self.n_null[tables] = 0
+        self.folded[tables] = False
+        self.played_preflop[tables] = False
+        self.b_rounds[tables] = 0
+        self._new_rounds(tables)
+
+    def _new_rounds(self, tables):
+        preflop = self.b_rounds[tables] == 0
+        self.betting_states[tables] = np.where(preflop, betting.initial_state(0), betting.initial_state(1))
+        dealers = self.dealers[tables]
+        self.to_play[tables] = np.where(preflop, dealers, 1 - dealers)
+        self.last_values[tables] = 0
+        self.n_min_raises[tables] = 0
+
+    def _decide(self, tables):
+        """
+        play the next decision of each table (see _Table._play_round)
+        :return: whether the betting round of each table is over
+        """
+        players = self.to_play[tables]
+        over = np.zeros(len(tables), dtype=bool)
+        # the players who are all in do nothing
+        null = self.is_all_in[tables, players]
+        if null.any():
+            idle = tables[null]
+            self.n_null[idle] += 1
+            self.to_play[idle] = 1 - players[null]
+            over[null] = self.n_null[idle] >= 2
+            tables, players = tables[~null], players[~null]
+        opponents = 1 - players
+        stacks = self.stacks[tables, players]
+        side_pots = self.side_pots[tables, players]
+        opponent_side_pots = self.side_pots[tables, opponents]
+        opponent_last_values = self.last_values[tables, opponents]
+        is_dealer = players == self.dealers[tables]
+        preflop = self.b_rounds[tables] == 0
+        states = self.betting_states[tables]
+        situations = LegalActionArrays(states, stacks, side_pots, is_dealer, opponent_side_pots, opponent_last_values,
+                                       np.minimum(self.n_min_raises[tables, players], 2),
+                                       ~self.played_preflop[tables, opponents])
+        buckets = np.zeros(len(tables), dtype=np.int64)
+        for p_id in range(2):
+            plays = np.flatnonzero(players == p_id)
+            if len(plays) > 0:
+                buckets[plays] = self.choices[p_id](situations, plays, preflop[plays], self.actor_rngs[p_id])
+        types, values, totals, min_raises = situations.actions(buckets)
+        # the player goes all in when the action leaves it nothing (see Player.play)
+        all_in = (stacks - values <= 0) | (types == _ALL_IN)
+        types[all_in] = _ALL_IN
+        values[all_in] = stacks[all_in]
+        totals[all_in] = stacks[all_in]
+
+        side_pots += totals
+        self.side_pots[tables, players] = side_pots
+        self.stacks[tables, players] = stacks - totals
+        self.pots[tables] += totals
+        self.is_all_in[tables, players] |= all_in
+        self.last_values[tables, players] = values
+        self.n_min_raises[tables, players] += (types == _RAISE) & min_raises
+        self.played_preflop[tables, players] |= preflop
+        states = betting.step(states, np.where(is_dealer, betting.SB, betting.BB), types)
+        self.betting_states[tables] = states
+
+        n_all_in = self.n_all_in[tables]
+        n_all_in += np.where(all_in, 1 + (side_pots <= opponent_side_pots), (types == _CALL) & (n_all_in == 1))
+        self.n_all_in[tables] = n_all_in
+        folds = types == _FOLD
+        if folds.any():
+            folders = tables[folds]
+            # as in _Table: the contributions are replaced by the side pots of the round
+            self.contributions[folders] = self.side_pots[folders]
+            self.side_pots[folders] = 0
+            self.folded[folders] = True
+            self.winners[folders] = opponents[folds]
+        self.to_play[tables] = opponents
+        over[~null] = folds | betting.is_over(states) | (n_all_in == 2)
+        return over
+
+    def _end_rounds(self, tables):
+        """
+        :return: the tables whose episode is over, the others start their next betting round
+        """
+        self.contributions[tables] += self.side_pots[tables]
+        self.side_pots[tables] = 0
+        over = self.folded[tables] | (self.n_all_in[tables] >= 2) | (self.b_rounds[tables] == 3)
+        next_round = tables[~over]
+        self.b_rounds[next_round] += 1
+        self._new_rounds(next_round)
+        return tables[over]
+
+    def _settle(self, tables):
+        """
+        distribute the pots (see _Table.settle)
+        :return: rewards of the players (k x 2), id of the winner of the game if it is over (-1 otherwise), number of
+                 episodes of the game, one per table
+        """
+        self.n_episodes += len(tables)
+        dealers = self.dealers[tables]
+        winners = self.winners[tables]
+        split = np.zeros(len(tables), dtype=bool)
+        showdowns = np.flatnonzero(~self.folded[tables])
+        if len(showdowns) > 0:
+            scores_0, scores_1 = showdown_scores(self.draw_cards(len(showdowns)), dealers[showdowns] == 0)
+            winners[showdowns] = scores_1 > scores_0
+            split[showdowns] = scores_0 == scores_1
+        rows = np.arange(len(tables))
+        stacks, contributions, pots = self.stacks[tables], self.contributions[tables], self.pots[tables]
+        s_pot = contributions[rows, winners]
+        won = np.where(split, 0, np.where(s_pot * 2 >= pots, pots, 2 * s_pot))
+        stacks[rows, winners] += won
+        stacks[rows, 1 - winners] += np.where(split, 0, pots - won)
+        stacks[split] += contributions[split]
+
+        self.stacks[tables] = stacks
+        self.dealers[tables] = 1 - dealers
+        self.n_episodes_in_game[tables] += 1
+        n_episodes = self.n_episodes_in_game[tables]
+        game_over = (stacks == 0).any(axis=1)
+        self._new_games(tables[game_over])
+        return stacks - self.start_stacks[tables], np.where(game_over, stacks[:, 1] > 0, -1), n_episodes
+
+    def _play(self, tables, keep_playing):
+        """
+        play episodes on the tables until they stop
+        :param keep_playing: function called with the tables whose episodes are over and the results of their
+        episodes (see _settle), returning whether each of these tables plays another episode
+        """
+        playing = np.zeros(self.n_tables, dtype=bool)
+        playing[tables] = True
+        self._new_games(tables)
+        self._new_episodes(tables)
+        ended = np.zeros(0, dtype=np.int64)
+        while True:
+            # the episodes can be over without any decision (all in at the blinds)
+            while len(ended) > 0:
+                continues = keep_playing(ended, *self._settle(ended))
+                playing[ended[~continues]] = False
+                ended = ended[continues]
+                self._new_episodes(ended)
+                ended = ended[self.n_all_in[ended] >= 2]
+            tables = np.flatnonzero(playing)
+            if len(tables) == 0:
+                return
+            ended = self._end_rounds(tables[self._decide(tables)])
+
+    def run(self, n_games):
+        """
+        Each table plays the same number of games (up to one), see BaselineEngine.run
+        :return: a dict with, for each game (the first game of each table, then the second one, ...):
+                 'winners' (id of the player who won the game), 'episodes' (number of episodes of the game)
+        """
+        n_tables = min(self.n_tables, n_games)
+        games_per_table = -(-n_games // n_tables)
+        winners = np.zeros((games_per_table, n_tables), dtype=np.int64)
+        episodes = np.zeros((games_per_table, n_tables), dtype=np.int64)
+        n_played = np.zeros(n_tables, dtype=np.int64)
+
+        def keep_playing(tables, rewards, game_winners, n_episodes):
+            over = game_winners >= 0
+            winners[n_played[tables[over]], tables[over]] = game_winners[over]
+            episodes[n_played[tables[over]], tables[over]] = n_episodes[over]
+            n_played[tables[over]] += 1
+            return n_played[tables] < games_per_table
+        self._play(np.arange(n_tables), keep_playing)
+        return {'winners': winners.ravel()[:n_games], 'episodes': episodes.ravel()[:n_games]}
+
+    def run_episodes(self, n_episodes):
+        """
+        :return: array n_episodes x 2 of the rewards (profit) of each player in each episode, in the order they end
+        """
+        rewards = []
+        n_played = [0]
+
+        def keep_playing(tables, episode_rewards, game_winners, n_game_episodes):
+            rewards.append(episode_rewards)
+            n_played[0] += len(tables)
+            return np.full(len(tables), n_played[0] < n_episodes)
+        self._play(np.arange(self.n_tables), keep_playing)
+        return np.concatenate(rewards)[:n_episodes]
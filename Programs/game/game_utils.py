@@ -8,9 +8,11 @@ Define classes for :
 Setting the blinds, the dealer button, deal cards, processing actions, transforming the board into a
 """
 from itertools import product
-from sklearn.utils import shuffle
 from game.config import BLINDS
+from constant import NUM_ACTIONS
 from game.utils import sample_categorical, variable
+from game import betting
+from game.rng import get_rng
 import numpy as np
 import torch as t
 
@@ -50,66 +52,91 @@ class Card:
         return self.RANK_TO_IDX[self.rank] > self.RANK_TO_IDX[other.rank]
 
 
+N_CARDS = 52
+# a heads-up episode uses at most 9 cards: 2 hands and the board
+HEADS_UP_CARDS = 9
+# the cards are never modified: they are created once. The index of a card is 4 * rank index + suit index
+CARDS = [Card(rank, suit) for rank, suit in product(Card.RANKS, Card.SUITS)]
+
+
+def card_index(card):
+    """index of a Card in CARDS (4 * rank index + suit index)"""
+    return 4 * Card.RANK_TO_IDX[card.rank] + Card.SUITS.index(card.suit)
+
+
+def draw_swaps(n=None, n_cards=HEADS_UP_CARDS, rng=None):
+    """
+    Draw the first n_cards steps of Fisher-Yates shuffles of the 52 cards, for n decks in one call to the generator
+    :return: array (n x) n_cards: the k-th card of a deck is swapped with the card at position swaps[k] >= k
+    """
+    size = None if n is None else (n, n_cards)
+    return get_rng(rng).integers(np.arange(n_cards), N_CARDS, size=size)
+
+
+def deal_card_indexes(n, n_cards=HEADS_UP_CARDS, rng=None):
+    """
+    :return: array n x n_cards, the indexes (see CARDS) of the first n_cards cards of n shuffled decks
+    """
+    swaps = draw_swaps(n, n_cards, rng)
+    decks = np.tile(np.arange(N_CARDS), (n, 1))
+    rows = np.arange(n)
+    for k in range(n_cards):
+        drawn = decks[rows, swaps[:, k]]
+        decks[rows, swaps[:, k]] = decks[:, k]
+        decks[:, k] = drawn
+    return decks[:, :n_cards]
+
+
 class Deck:
-    """A set of cards"""
+    """
+    The 52 cards, as indexes in CARDS. The deck is reused from an episode to the next: shuffling only draws the
+    positions of the cards that will be dealt, and the cards are put in place as they are drawn (partial Fisher-Yates)
+    """
     def __init__(self):
-        self.cards = []
+        self.order = list(range(N_CARDS))
+        self.n_drawn = 0
+        self._swaps = []
+        self._rng = None
 
     def populate(self):
-        cards_tuples = list(product(Card.RANKS, Card.SUITS))
-        self.cards = [Card(t[0], t[1]) for t in cards_tuples]
+        """put the drawn cards back"""
+        self.n_drawn = 0
+
+    def shuffle(self, rng=None, swaps=None):
+        """
+        :param swaps: the positions of the next cards (see draw_swaps), e.g drawn for many decks at once. They are
+        drawn with rng if not given. Cards drawn beyond them are drawn one by one
+        """
+        self.populate()
+        self._rng = rng
+        self._swaps = (swaps if swaps is not None else draw_swaps(rng=rng)).tolist()
+
+    def draw(self):
+        k = self.n_drawn
+        if k < len(self._swaps):
+            j = self._swaps[k]
+        else:
+            j = int(get_rng(self._rng).integers(k, N_CARDS))
+        order = self.order
+        order[k], order[j] = order[j], order[k]
+        self.n_drawn += 1
+        return CARDS[order[k]]
 
-    def shuffle(self):
-        self.cards = shuffle(self.cards)
+    @property
+    def cards(self):
+        """the cards that were not drawn"""
+        return [CARDS[i] for i in self.order[self.n_drawn:]]
 
 
 def agreement(actions, betting_round):
     """
     Verify whether two players came to an agreement, meaning that the betting round can end now
+    (see game.betting for the rules, as a state machine)
     :param actions: a dict {betting_round: {player_id: [actions]}}
     :param betting_round: the id of the betting round (0:preflop, 1:flop,...)
     :return: True/False
     """
-    if len(actions[betting_round][0]) == 0 or len(actions[betting_round][1]) == 0:
-        return False
-    # 1 raise 1 call
-    dealer = 0 if actions[-1][0] == 1 else 1
-    if betting_round > 0:  # after preflop, any call/raise situation leads to the end of the betting round
-        if (actions[betting_round][0][-1].type == 'raise' and actions[betting_round][1][-1].type == 'call') or (actions[betting_round][0][-1].type == 'call' and actions[betting_round][1][-1].type == 'raise'):
-            return True
-    else:
-        # at preflop, if the SB called and the BB raised, it continues playing. If the SB raised and the BB called, it ends the preflop
-        if len(actions[0][0]) == len(actions[0][1]) == 1:
-            if actions[betting_round][dealer][-1].type == 'raise' and actions[betting_round][1-dealer][-1].type == 'call':
-                return True
-        # at preflop, if the BB raised the call of the SB, then there is no more special situation
-        else:
-            if (actions[betting_round][0][-1].type == 'raise' and actions[betting_round][1][-1].type == 'call') or (actions[betting_round][0][-1].type == 'call' and actions[betting_round][1][-1].type == 'raise'):
-                return True
-    # 1 fold
-    if actions[betting_round][0][-1].type == 'fold' or actions[betting_round][1][-1].type == 'fold':
-        return True
-    # 1 check 1 call
-    if (actions[betting_round][0][-1].type == 'check' and actions[betting_round][1][-1].type == 'call') or (actions[betting_round][0][-1].type == 'call' and actions[betting_round][1][-1].type == 'check'):
-        return True
-    # 1 check 1 bet
-    if (actions[betting_round][0][-1].type == 'check' and actions[betting_round][1][-1].type == 'bet') or (actions[betting_round][0][-1].type == 'bet' and actions[betting_round][1][-1].type == 'check'):
-        return False
-    # 2 checks
-    if actions[betting_round][0][-1].type == 'check' and actions[betting_round][1][-1].type == 'check':
-        return True
-    # 1 bet 1 call
-    if (actions[betting_round][0][-1].type == 'bet' and actions[betting_round][1][-1].type == 'call') or (
-            actions[betting_round][0][-1].type == 'call' and actions[betting_round][1][-1].type == 'bet'):
-        return True
-    # 1 all-in and 1 call
-    if (actions[betting_round][0][-1].type == 'all in' and actions[betting_round][1][-1].type == 'call') or (
-                    actions[betting_round][0][-1].type == 'call' and actions[betting_round][1][-1].type == 'all in'):
-        return True
-    # 2 all-in
-    if actions[betting_round][0][-1].type == 'all in' and actions[betting_round][1][-1].type == 'all in':
-        return True
-    return False
+    return bool(betting.is_over(betting.state_from_actions(actions, betting_round)))
 
 
 def blinds(players, verbose=False):
@@ -150,10 +177,9 @@ def blinds(players, verbose=False):
     return sb_paid + bb_paid
 
 
-def set_dealer(players, verbose=False):
+def set_dealer(players, verbose=False, rng=None):
     """Randomly set the dealer"""
-    import random
-    if random.random() > .5:
+    if get_rng(rng).random() > .5:
         if verbose:
             print(players[0].name + ' is dealer')
         players[0].is_dealer = True
@@ -175,27 +201,27 @@ def deal(deck, players, board, b_round, verbose=False):
     if b_round == 0:
         first_player = players[0] if players[0].is_dealer else players[1]
         second_player = players[(first_player.id + 1) % 2]
-        first_player.cards.append(deck.cards.pop())
-        second_player.cards.append(deck.cards.pop())
-        first_player.cards.append(deck.cards.pop())
-        second_player.cards.append(deck.cards.pop())
+        first_player.cards.append(deck.draw())
+        second_player.cards.append(deck.draw())
+        first_player.cards.append(deck.draw())
+        second_player.cards.append(deck.draw())
         if verbose:
             print(first_player.name + '\'s cards: ' + str(first_player.cards))
             print(second_player.name + '\'s cards: ' + str(second_player.cards))
     if b_round == 1:
-        board.append(deck.cards.pop())
-        board.append(deck.cards.pop())
-        board.append(deck.cards.pop())
+        board.append(deck.draw())
+        board.append(deck.draw())
+        board.append(deck.draw())
         if verbose:
             print('flop')
             print(board)
     if b_round == 2:
-        board.append(deck.cards.pop())
+        board.append(deck.draw())
         if verbose:
             print('turn')
             print(board)
     if b_round == 3:
-        board.append(deck.cards.pop())
+        board.append(deck.draw())
         if verbose:
             print('river')
             print(board)
@@ -298,14 +324,18 @@ class Action:
 
 
 def idx_to_bucket(idx):
-    """Mapping between the indexes of the Q values (numpy array) and the idx of the actions in Action.BET_BUCKET"""
-    if idx <= 1:
-        return idx - 1
-    else:
-        return idx
+    """
+    Mapping between the indexes of the Q values (numpy array) and the idx of the actions in Action.BET_BUCKET
+    Index k is bucket k-1 (fold is -1, all-in is 14), the same convention as `action_to_bucket_idx`
+    """
+    return idx - 1
 
 
-def bucket_to_action(bucket, actions, b_round, player, opponent_side_pot):
+# bit of each Q/pi output in a packed action mask
+ACTION_BITS = 1 << np.arange(NUM_ACTIONS)
+
+
+def _bucket_to_action(bucket, actions, b_round, player, opponent_side_pot):
     """
     Actions are identified by discrete buckets (see Action.BET_BUCKETS)
     We need to choose an action from a given bucket
@@ -405,16 +435,44 @@ def get_raise_from_bucket(bucket, actions, b_round, player, opponent_side_pot, r
         return min_side_pot_to_match_for_raise - opponent_side_pot
 
 
-def sample_action(idx, probabilities):
+def sample_action(idx, probabilities, rng=None):
     """
     Sample from categorical distribution
     """
     try:
-        return idx[sample_categorical(probabilities)]
+        return idx[sample_categorical(probabilities, rng)]
     except:
         raise ValueError(probabilities)
 
 
+def sample_masked_action(probabilities, mask, rng=None):
+    """
+    Sample the index of an authorized action
+    :param probabilities: NUM_ACTIONS nonnegative weights (they don't need to sum to 1)
+    :param mask: boolean mask of the authorized actions (see `authorized_actions_mask`)
+    :param rng: numpy Generator (see game.rng)
+    :return: the index of the sampled action. If all the authorized actions have weight 0, it is sampled uniformly
+    """
+    weights = np.where(mask, probabilities, 0.)
+    cumulated = np.cumsum(weights)
+    if cumulated[-1] <= 0:
+        cumulated = np.cumsum(mask)
+    idx = np.searchsorted(cumulated, get_rng(rng).random() * cumulated[-1], side='right')
+    return int(min(idx, len(cumulated) - 1))
+
+
+def greedy_masked_action(values, mask, rng=None):
+    """
+    Index of the authorized action with the highest value (ties are broken at random)
+    :param values: NUM_ACTIONS values (e.g Q values)
+    :param mask: boolean mask of the authorized actions (see `authorized_actions_mask`)
+    :param rng: numpy Generator (see game.rng)
+    """
+    masked_values = np.where(mask, values, -np.inf)
+    ties = np.flatnonzero(masked_values == masked_values.max())
+    return int(ties[0]) if len(ties) == 1 else int(get_rng(rng).choice(ties))
+
+
 def get_call_bucket(bet):
     """Returns the bucket that contains `bet`"""
     for bucket, range in Action.BET_BUCKETS.items():
@@ -425,6 +483,10 @@ def get_call_bucket(bet):
     return 14
 
 
+# bucket containing each amount that can be put in the pot (stacks never exceed 200)
+AMOUNT_TO_BUCKET = np.array([get_call_bucket(amount) for amount in range(201)])
+
+
 def get_max_bet_bucket(stack):
     """Returns the biggest bucket you can use to make a bet. Note that it is below the one that leads you to all-in"""
     assert 0 < stack <= 200, stack
@@ -469,7 +531,7 @@ def get_min_raise_bucket(opponent_side_pot, actions, b_round, player, raise_val=
             return get_call_bucket(minimum_side_pot_you_have_to_match - player.side_pot), minimum_side_pot_you_have_to_match
 
 
-def authorized_actions_buckets(player, actions, b_round, opponent_side_pot):
+def _authorized_actions_buckets(player, actions, b_round, opponent_side_pot):
     """
     Gives you the buckets you have right to choose
     :param player:
@@ -493,7 +555,7 @@ def authorized_actions_buckets(player, actions, b_round, opponent_side_pot):
             assert max_bet_bucket != 14
             # bucket_to_action(call_bucket, actions, b_round, player, opponent_side_pot).total >= player.stack
             if min_bet_bucket < max_bet_bucket or ((min_bet_bucket == max_bet_bucket) and (Action.BET_BUCKETS[min_bet_bucket][1] > Action.BET_BUCKETS[min_bet_bucket][0])):
-                if bucket_to_action(max_bet_bucket, actions, b_round, player, opponent_side_pot).total >= player.stack:
+                if _bucket_to_action(max_bet_bucket, actions, b_round, player, opponent_side_pot).total >= player.stack:
                     return [check_bucket] + list(range(min_bet_bucket, max_bet_bucket)) + [14]
                 else:
                     return [check_bucket] + list(range(min_bet_bucket, max_bet_bucket+1)) + [14]
@@ -569,7 +631,7 @@ def authorized_actions_buckets(player, actions, b_round, opponent_side_pot):
             call_bucket = get_call_bucket(opponent_side_pot - player.side_pot)
             max_bet_bucket = get_max_bet_bucket(player.stack)
             if max_bet_bucket <= call_bucket:
-                if bucket_to_action(call_bucket, actions, b_round, player, opponent_side_pot).total >= player.stack:
+                if _bucket_to_action(call_bucket, actions, b_round, player, opponent_side_pot).total >= player.stack:
                     return [-1, 14]
                 else:
                     return [-1, call_bucket]
@@ -595,6 +657,277 @@ def authorized_actions_buckets(player, actions, b_round, opponent_side_pot):
                 return [0, 14]
 
 
+def legal_actions_key(player, actions, b_round, opponent_side_pot):
+    """
+    Everything `authorized_actions_buckets` and `bucket_to_action` read from a decision situation.
+    The state of the betting round (see game.betting) gives the street and the types of the last actions: it is the
+    one tracked by the engine (player.betting_state) if any, it is derived from the actions otherwise
+    :return: a hashable key
+    """
+    betting_state = player.betting_state if player.betting_state is not None else \
+        betting.state_from_actions(actions, b_round, player.id if player.is_dealer else 1 - player.id)
+    opponent_actions = actions[b_round][1 - player.id]
+    opponent_last_value = opponent_actions[-1].value if len(opponent_actions) > 0 else None
+    # only the 2 first min-raises are allowed (see `get_min_raise_bucket`)
+    n_min_raise = min(sum([a.min_raise for a in actions[b_round][player.id] if a.type == 'raise']), 2)
+    return (betting_state, player.stack, player.side_pot, player.is_dealer, opponent_side_pot, opponent_last_value,
+            n_min_raise, len(actions[0][1 - player.id]) == 0)
+
+
+class LegalActionTable:
+    """
+    Authorized buckets (and their mask) and concrete actions of each bucket, indexed by decision situation, for the
+    scalar engine (the engines that play on arrays use LegalActionArrays, computed from dense per-amount tables).
+    The situations (stacks, side pots, last action of the opponent, ...) are too many to be enumerated (~1e11 keys),
+    and most of them never occur, so the table is filled lazily: each situation is computed once, when it is met for
+    the first time, and then looked up in O(1).
+    The situations met keep growing with the training (e.g the side pots), so the table is bounded: when it is full,
+    it is emptied and refilled by the next lookups.
+    """
+
+    def __init__(self, max_size=2 ** 15):
+        """
+        :param max_size: number of situations (and of actions) above which the table is emptied
+        """
+        self.max_size = max_size
+        self._buckets = {}
+        self._actions = {}
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def clear(self):
+        self._buckets.clear()
+        self._actions.clear()
+
+    def _entry(self, key, player, actions, b_round, opponent_side_pot):
+        entry = self._buckets.get(key)
+        if entry is None:
+            if len(self._buckets) >= self.max_size:
+                self.clear()
+            buckets = _authorized_actions_buckets(player, actions, b_round, opponent_side_pot)
+            mask = np.zeros(NUM_ACTIONS, dtype=bool)
+            mask[np.array(buckets) + 1] = True
+            entry = (tuple(buckets), mask, pack_action_mask(mask))
+            self._buckets[key] = entry
+        return entry
+
+    def buckets(self, player, actions, b_round, opponent_side_pot):
+        key = legal_actions_key(player, actions, b_round, opponent_side_pot)
+        return list(self._entry(key, player, actions, b_round, opponent_side_pot)[0])
+
+    def mask(self, player, actions, b_round, opponent_side_pot):
+        key = legal_actions_key(player, actions, b_round, opponent_side_pot)
+        return self._entry(key, player, actions, b_round, opponent_side_pot)[1].copy()
+
+    def packed_mask(self, player, actions, b_round, opponent_side_pot):
+        key = legal_actions_key(player, actions, b_round, opponent_side_pot)
+        return self._entry(key, player, actions, b_round, opponent_side_pot)[2]
+
+    def action(self, bucket, player, actions, b_round, opponent_side_pot):
+        key = (legal_actions_key(player, actions, b_round, opponent_side_pot), bucket)
+        action = self._actions.get(key)
+        if action is None:
+            if len(self._actions) >= self.max_size:
+                self.clear()
+            a = _bucket_to_action(bucket, actions, b_round, player, opponent_side_pot)
+            action = (a.type, a.value, a.min_raise, a.total)
+            self._actions[key] = action
+        # the actions end up in the history of the episode: they are not shared
+        return Action(*action)
+
+
+LEGAL_ACTIONS = LegalActionTable()
+
+
+def bucket_to_action(bucket, actions, b_round, player, opponent_side_pot):
+    """
+    Actions are identified by discrete buckets (see Action.BET_BUCKETS)
+    We need to choose an action from a given bucket (see `_bucket_to_action`), looked up in LEGAL_ACTIONS
+    """
+    return LEGAL_ACTIONS.action(bucket, player, actions, b_round, opponent_side_pot)
+
+
+def authorized_actions_buckets(player, actions, b_round, opponent_side_pot):
+    """
+    Gives you the buckets you have right to choose (see `_authorized_actions_buckets`), looked up in LEGAL_ACTIONS
+    """
+    return LEGAL_ACTIONS.buckets(player, actions, b_round, opponent_side_pot)
+
+
+def authorized_actions_mask(player, actions, b_round, opponent_side_pot):
+    """
+    Same as `authorized_actions_buckets`, but as a boolean mask over the outputs of Q/pi (index = bucket + 1)
+    :return: a numpy array of NUM_ACTIONS booleans
+    """
+    return LEGAL_ACTIONS.mask(player, actions, b_round, opponent_side_pot)
+
+
+# Dense tables of the bucket rules, for the engines that play tables on arrays (see LegalActionArrays). The key of
+# legal_actions_key is bounded but far too large to be enumerated (~1e11 situations, of which random players keep
+# meeting new ones), so the rules are computed on arrays from tables indexed by what they read: an amount (stacks and
+# side pots never exceed 200) or a bucket
+# bucket of each output of Q/pi (see idx_to_bucket)
+BUCKETS = np.arange(-1, NUM_ACTIONS - 1)
+# range of amounts of each bucket (indexed by bucket + 1, see Action.BET_BUCKETS)
+BUCKET_LOW = np.array([Action.BET_BUCKETS[b][0] if 0 <= b <= 13 else 0 for b in BUCKETS])
+BUCKET_HIGH = np.array([Action.BET_BUCKETS[b][1] if 0 <= b <= 13 else 0 for b in BUCKETS])
+# get_max_bet_bucket of each stack (the players with an empty stack don't play)
+MAX_BET_BUCKET = np.array([0] + [get_max_bet_bucket(stack) for stack in range(1, 201)])
+
+_NONE, _CHECK, _BET, _CALL, _RAISE, _ALL_IN, _FOLD = [betting.TYPE_TO_IDX[action_type] for action_type in
+                                                       ('none', 'check', 'bet', 'call', 'raise', 'all in', 'fold')]
+
+
+def amount_buckets(amounts):
+    """`get_call_bucket` of an array of amounts"""
+    return np.where((amounts >= 0) & (amounts <= 200), AMOUNT_TO_BUCKET[np.clip(amounts, 0, 200)], 14)
+
+
+def _raise_from_bucket(buckets, side_pots, opponent_side_pots, min_side_pots):
+    """`get_raise_from_bucket` of arrays, and whether the buckets contain a raise"""
+    low, high = BUCKET_LOW[buckets + 1], BUCKET_HIGH[buckets + 1]
+    raise_values = np.where(low + side_pots > min_side_pots, low + side_pots - opponent_side_pots,
+                            min_side_pots - opponent_side_pots)
+    return raise_values, high + side_pots >= min_side_pots
+
+
+class LegalActionArrays:
+    """
+    `authorized_actions_mask` and `bucket_to_action` of n decision situations at once, with the same rules, for the
+    engines that play tables on arrays (see game.fast_engine.VectorizedEngine)
+    """
+
+    def __init__(self, betting_states, stacks, side_pots, is_dealer, opponent_side_pots, opponent_last_values,
+                 n_min_raises, opponent_no_preflop):
+        """
+        The params are the fields of `legal_actions_key`, as arrays of n elements (or scalars)
+        :param opponent_last_values: value of the last action of the opponent in the betting round (0 if it didn't
+        play)
+        """
+        fields = np.broadcast_arrays(*[np.atleast_1d(np.asarray(field, dtype=np.int64)) for field in
+                                       (betting_states, stacks, side_pots, is_dealer, opponent_side_pots,
+                                        opponent_last_values, n_min_raises, opponent_no_preflop)])
+        betting_states, self.stacks, self.side_pots, is_dealer, self.opponent_side_pots, self.opponent_last_values, \
+            n_min_raises, opponent_no_preflop = fields
+        phase, last_sb, last_bb = betting.decode(betting_states)
+        self.preflop = phase != betting.POSTFLOP
+        # the dealer is the SB
+        self.opponent_types = np.where(is_dealer != 0, last_bb, last_sb)
+        self.to_call = self.opponent_side_pots - self.side_pots
+        self.call_buckets = amount_buckets(self.to_call)
+        # side pot to match with the smallest raise, and its bucket (see get_min_raise_bucket)
+        first_raise_of_sb = (is_dealer != 0) & self.preflop & (opponent_no_preflop != 0)
+        raise_values = np.where(self.opponent_types != _NONE, self.opponent_last_values, 0)
+        self.min_side_pots = np.where(n_min_raises >= 2, 2 * self.opponent_side_pots,
+                                      np.where(first_raise_of_sb, 4, raise_values + self.opponent_side_pots))
+        self.min_raise_buckets = np.where((n_min_raises < 2) & first_raise_of_sb, 3,
+                                          amount_buckets(self.min_side_pots - self.side_pots))
+        # the authorized buckets are, in the order of authorized_actions_buckets: the fold (or the check if
+        # self.check), an extra bucket (usually the call, -2 if none), the range self.low..self.high and the all in (if
+        # self.all_in)
+        self._authorize()
+
+    def actions(self, buckets):
+        """
+        :param buckets: a bucket for each situation (n), or n x m buckets
+        :return: the actions of the buckets (see _bucket_to_action), as arrays of the shape of buckets: type (index in
+                 betting.ACTION_TYPES, 'none' if the bucket is not authorized), value, total and min_raise
+        """
+        buckets = np.asarray(buckets)
+        stacks, side_pots, opponent_side_pots, opponent_last_values, to_call, call_buckets, min_side_pots, \
+            opponent_types = [x.reshape(x.shape + (1,) * (buckets.ndim - 1)) for x in
+                              (self.stacks, self.side_pots, self.opponent_side_pots, self.opponent_last_values,
+                               self.to_call, self.call_buckets, self.min_side_pots, self.opponent_types)]
+        raise_values, is_raise = _raise_from_bucket(np.clip(buckets, 0, 13), side_pots, opponent_side_pots,
+                                                    min_side_pots)
+        raise_totals = raise_values + to_call
+        is_raise &= call_buckets < buckets
+        # from the last case of _bucket_to_action to the first one: the first case that applies is the last written
+        raises, all_in_raises = is_raise & (raise_totals < stacks), is_raise & (raise_totals == stacks)
+        types = np.where(raises, _RAISE, np.where(all_in_raises, _ALL_IN, _NONE))
+        values = np.where(raises, raise_values, np.where(all_in_raises, stacks, 0))
+        totals = np.where(raises, raise_totals, values)
+        calls = call_buckets == buckets
+        types = np.where(calls, _CALL, types)
+        values = np.where(calls, to_call, values)
+        bets = (opponent_side_pots == 0) & (buckets >= 1) & (buckets <= 13)
+        types = np.where(bets, _BET, types)
+        values = np.where(bets, BUCKET_LOW[buckets + 1], values)
+        totals = np.where(calls | bets, values, totals)
+        types = np.where(buckets == 14, _ALL_IN, np.where(buckets == 0, _CHECK, np.where(buckets == -1, _FOLD, types)))
+        values = np.where(buckets == 14, stacks, np.where((buckets == 0) | (buckets == -1), 0, values))
+        totals = np.where(buckets == 14, stacks, np.where((buckets == 0) | (buckets == -1), 0, totals))
+        min_raises = (types == _RAISE) & np.where(opponent_types != _NONE, raise_values == opponent_last_values,
+                                                  raise_values == 2)
+        return types, values, totals, min_raises
+
+    def _authorize(self):
+        """the authorized buckets (see _authorized_actions_buckets)"""
+        stacks, side_pots, opponent_side_pots, types = \
+            self.stacks, self.side_pots, self.opponent_side_pots, self.opponent_types
+        call_buckets, min_raise_buckets = self.call_buckets, self.min_raise_buckets
+        max_buckets = MAX_BET_BUCKET[stacks]
+        first_preflop, first_postflop = (types == _NONE) & self.preflop, (types == _NONE) & ~self.preflop
+        after_bet, after_raise, after_all_in = types == _BET, types == _RAISE, types == _ALL_IN
+        min_raise_values, _ = _raise_from_bucket(np.clip(min_raise_buckets, 0, 13), side_pots, opponent_side_pots,
+                                                 self.min_side_pots)
+        max_raise_values, max_is_raise = _raise_from_bucket(max_buckets, side_pots, opponent_side_pots,
+                                                            self.min_side_pots)
+        max_raise_values = np.where(max_is_raise, max_raise_values, min_raise_values)
+        # after a bet: fold or all in, the call is an all in, only the call, the max bucket is an all in
+        bet_call_buckets = amount_buckets(self.opponent_last_values)
+        bet_no_call = max_buckets <= bet_call_buckets
+        bet_all_in_call = ~bet_no_call & (opponent_side_pots >= side_pots + stacks)
+        bet_only_call = ~bet_no_call & ~bet_all_in_call & \
+            ((min_raise_buckets == 14) | (min_raise_values + opponent_side_pots > stacks))
+        bet_raises = ~bet_no_call & ~bet_only_call
+        bet_max_all_in = ~bet_all_in_call & (max_raise_values + opponent_side_pots > stacks)
+        # after a raise: fold or all in, or the call and maybe raises
+        raise_no_call = (max_buckets <= call_buckets) | (min_raise_buckets == 14)
+        raise_raises = ~raise_no_call & (stacks > self.to_call + min_raise_values)
+        # after an all in, the call is an all in when it takes the whole stack
+        all_in_no_call = (max_buckets <= call_buckets) & ((call_buckets == 14) | (self.to_call >= stacks))
+
+        check = first_postflop | (types == _CHECK) | (types == _CALL)
+        all_in = ~after_all_in | all_in_no_call
+        extra = np.where(first_preflop & (max_buckets != 1), 1,
+                         np.where(after_bet & ~bet_no_call & ~bet_all_in_call, bet_call_buckets,
+                                  np.where((after_raise & ~raise_no_call) | (after_all_in & ~all_in_no_call),
+                                           call_buckets, -2)))
+        raises = (after_bet & bet_raises) | (after_raise & raise_raises)
+        has_range = first_preflop | (check & (stacks > 2)) | raises
+        low = np.where(raises, min_raise_buckets, np.where(first_preflop, 3, 2))
+        # the max bucket is excluded when betting it is an all in (the opponent checked: it is a bet)
+        high = np.where(after_bet & bet_max_all_in, max_buckets - 1, max_buckets)
+        high = np.where(first_postflop | (types == _CHECK),
+                        np.where(BUCKET_LOW[max_buckets + 1] >= stacks, max_buckets - 1, max_buckets), high)
+        high = np.where(has_range, high, -2)
+        self.check, self.extra, self.low, self.high, self.all_in = check, extra, low, high, all_in
+
+    def masks(self):
+        """
+        :return: the authorized buckets, as n x NUM_ACTIONS booleans (see authorized_actions_mask)
+        """
+        b = BUCKETS[None, :]
+        return ((b == -1) & ~self.check[:, None]) | ((b == 0) & self.check[:, None]) | (b == self.extra[:, None]) | \
+            ((b >= self.low[:, None]) & (b <= self.high[:, None])) | ((b == 14) & self.all_in[:, None])
+
+
+def pack_action_mask(mask):
+    """Pack a boolean action mask into a single int (to store it in the replay memories)"""
+    return int(ACTION_BITS[mask].sum())
+
+
+def unpack_action_masks(packed_masks):
+    """
+    Unpack masks packed by `pack_action_mask`
+    :param packed_masks: an int or an array of ints of any shape
+    :return: a boolean array of shape packed_masks.shape x NUM_ACTIONS
+    """
+    return (np.asarray(packed_masks, dtype=np.int64)[..., None] & ACTION_BITS) != 0
+
+
 def action_to_array(action):
     """
     Convert an action into a numpy array
@@ -649,16 +982,34 @@ def bucket_encode_actions(actions, cuda=False):
 
     YOU SHOULD ADD +1 (see the keys of `Action.BET_BUCKETS` to understand why)
 
+    Prefer `action_to_bucket_idx` at insertion time: the learning code only needs the indexes.
+
     :param actions: a VARIABLE of size batch_size x 5 (il y a 5 types d'actions: check, bet, call, raise, all-in)
     :return: a VARIABLE of size batch_size x 14 (il y a 14 buckets)
     """
     values, indices = t.max(actions, -1)
-    actions_buckets = variable(np.zeros(values.data.cpu().numpy().shape), cuda=cuda)
-    actions_buckets[indices==0] = 0  # check
-    actions_buckets[indices==4] = 14  # all in
-    actions_buckets[indices==5] = -1  # fold
-    for bucket_idx in range(1, 14):
-        indicator = lambda x: bucket_idx*(x>=Action.BET_BUCKETS[bucket_idx][0]).float()*((x<=Action.BET_BUCKETS[bucket_idx][1]).float())
-        mask = (indices != 0)*(indices != 5)*(indices != 4)
-        actions_buckets[mask] += indicator(values[mask])
+    amount_to_bucket = variable(AMOUNT_TO_BUCKET, to_float=False, cuda=cuda)
+    amounts = values.long().clamp(0, len(AMOUNT_TO_BUCKET) - 1)
+    is_amount = ((indices != 0) * (indices != 4) * (indices != 5)).float()
+    # check is 0, so only all-ins, folds and bets/calls/raises contribute
+    actions_buckets = is_amount * amount_to_bucket.index_select(0, amounts).float() + 14 * (indices == 4).float() - (indices == 5).float()
     return actions_buckets
+
+
+def action_to_bucket_idx(action_array):
+    """
+    Index of the Q/pi output corresponding to an action array (see `action_to_array`)
+    This is the bucket of the action + 1, i.e what `bucket_encode_actions` computes for a whole batch
+    :param action_array: a numpy array of size 6
+    :return: an int between 0 and 15
+    """
+    kind = int(np.argmax(action_array))
+    if kind == 0:
+        bucket = 0  # check
+    elif kind == 4:
+        bucket = 14  # all in
+    elif kind == 5:
+        bucket = -1  # fold
+    else:
+        bucket = AMOUNT_TO_BUCKET[min(int(action_array[kind]), len(AMOUNT_TO_BUCKET) - 1)]
+    return int(bucket) + 1
@@ -0,0 +1,178 @@
+"""
+Append-only hand history: the cards, actions and results of every episode
+
+A hand history is a directory of chunks. A chunk is an .npz file holding two arrays of fixed-size records:
+    - 'episodes' (EPISODE_DTYPE): one record per episode. Its actions are actions[action_start:action_start + n_actions]
+    - 'actions' (ACTION_DTYPE): the actions of the episodes, in the order they were played
+The index (a file of INDEX_DTYPE records, one per chunk) is the list of the complete chunks: a chunk is written to a
+temporary file, renamed, and only then appended to the index, so that a crash loses at most the episodes that were
+not yet written, and never corrupts the chunks that were.
+The writer buffers the episodes and writes a chunk every `chunk_size` episodes: recording an episode takes a constant
+time, whatever the length of the run. The reader loads one chunk at a time (see `HandHistoryReader.chunks`).
+
+Cards are indexes of game_utils.CARDS (4 * rank index + suit), NO_CARD where there is no card.
+"""
+import os
+
+import numpy as np
+
+from game.game_utils import card_index
+
+NO_CARD = 255
+# the order of Action.type, and of the actions in the chunks
+ACTION_TYPES = ('fold', 'check', 'call', 'bet', 'raise', 'all in', 'null')
+ACTION_TYPE_CODES = {a: i for i, a in enumerate(ACTION_TYPES)}
+
+EPISODE_DTYPE = np.dtype([('episode', '<i8'),
+                          ('game', '<i4'),
+                          ('dealer', 'i1'),
+                          ('showdown', '?'),
+                          ('hands', 'u1', (2, 2)),
+                          ('board', 'u1', (5,)),
+                          # stacks before the blinds, and profit of the episode, of each player
+                          ('stacks', '<i4', (2,)),
+                          ('rewards', '<i4', (2,)),
+                          ('action_start', '<i8'),
+                          ('n_actions', '<i2')])
+ACTION_DTYPE = np.dtype([('street', 'i1'),
+                         ('player', 'i1'),
+                         ('type', 'i1'),
+                         ('value', '<i4')])
+INDEX_DTYPE = np.dtype([('first_episode', '<i8'),
+                        ('n_episodes', '<i8'),
+                        ('n_actions', '<i8')])
+
+INDEX_FILENAME = 'index.bin'
+CHUNK_FILENAME = 'chunk_{:08d}.npz'
+
+
+def _read_index(path):
+    index_path = os.path.join(path, INDEX_FILENAME)
+    if not os.path.exists(index_path):
+        return np.zeros(0, dtype=INDEX_DTYPE)
+    with open(index_path, 'rb') as f:
+        data = f.read()
+    # a record may have been partially appended before a crash
+    n = len(data) // INDEX_DTYPE.itemsize
+    return np.frombuffer(data[:n * INDEX_DTYPE.itemsize], dtype=INDEX_DTYPE)
+
+
+def ordered_actions(actions, dealer):
+    """
+    :param actions: actions of an episode, as in the Simulator {b_round: {player id: [Action]}}
+    :return: list of (street, player id, Action) in the order they were played (the dealer plays first preflop,
+             second afterwards)
+    """
+    ordered = []
+    for b_round in range(4):
+        first = dealer if b_round == 0 else 1 - dealer
+        per_player = (actions[b_round][first], actions[b_round][1 - first])
+        for i in range(max(len(per_player[0]), len(per_player[1]))):
+            for k, player in enumerate([first, 1 - first]):
+                if i < len(per_player[k]):
+                    ordered.append((b_round, player, per_player[k][i]))
+    return ordered
+
+
+class HandHistoryWriter:
+    def __init__(self, path, chunk_size=2 ** 14):
+        """
+        :param path: directory of the hand history. If it already contains one, the episodes are appended to it
+        """
+        self.path = path
+        self.chunk_size = chunk_size
+        os.makedirs(path, exist_ok=True)
+        index = _read_index(path)
+        self.n_chunks = len(index)
+        self._episodes = np.zeros(chunk_size, dtype=EPISODE_DTYPE)
+        self._n_episodes = 0
+        self._actions = []
+
+    def record(self, episode, game, dealer, hands, board, stacks, rewards, actions, showdown):
+        """
+        :param hands: the 2 cards (Card objects) of each player
+        :param board: the 0 to 5 cards of the board
+        :param stacks: stacks of the players before the blinds
+        :param rewards: profit of each player in the episode
+        :param actions: {b_round: {player id: [Action]}} (see `ordered_actions`)
+        """
+        e = self._episodes[self._n_episodes]
+        e['episode'] = episode
+        e['game'] = game
+        e['dealer'] = dealer
+        e['showdown'] = showdown
+        e['hands'] = [[card_index(c) for c in hand] if len(hand) == 2 else [NO_CARD, NO_CARD] for hand in hands]
+        e['board'] = [card_index(c) for c in board] + [NO_CARD] * (5 - len(board))
+        e['stacks'] = stacks
+        e['rewards'] = rewards
+        e['action_start'] = len(self._actions)
+        for b_round, player, action in ordered_actions(actions, dealer):
+            self._actions.append((b_round, player, ACTION_TYPE_CODES[action.type], action.value))
+        e['n_actions'] = len(self._actions) - e['action_start']
+        self._n_episodes += 1
+        if self._n_episodes == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        write the buffered episodes as a new chunk
+        """
+        if self._n_episodes == 0:
+            return
+        episodes = self._episodes[:self._n_episodes]
+        actions = np.array(self._actions, dtype=ACTION_DTYPE)
+        chunk_path = os.path.join(self.path, CHUNK_FILENAME.format(self.n_chunks))
+        tmp_path = chunk_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, episodes=episodes, actions=actions)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, chunk_path)
+        entry = np.array([(episodes['episode'][0], len(episodes), len(actions))], dtype=INDEX_DTYPE)
+        with open(os.path.join(self.path, INDEX_FILENAME), 'ab') as f:
+            f.write(entry.tobytes())
+        self.n_chunks += 1
+        self._episodes = np.zeros(self.chunk_size, dtype=EPISODE_DTYPE)
+        self._n_episodes = 0
+        self._actions = []
+
+    def close(self):
+        self.flush()
+
+
+class HandHistoryReader:
+    def __init__(self, path):
+        self.path = path
+        self.index = _read_index(path)
+        # position of the first episode of each chunk in the history
+        self.offsets = np.concatenate([[0], np.cumsum(self.index['n_episodes'])])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def load_chunk(self, i):
+        """
+        :return: (episodes, actions) of the i-th chunk
+        """
+        with np.load(os.path.join(self.path, CHUNK_FILENAME.format(i))) as chunk:
+            return chunk['episodes'], chunk['actions']
+
+    def chunks(self):
+        """
+        :return: iterator over the (episodes, actions) of the chunks, loaded one at a time
+        """
+        for i in range(len(self.index)):
+            yield self.load_chunk(i)
+
+    def __getitem__(self, i):
+        """
+        :return: (episode record, its actions) of the i-th episode of the history
+        """
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        chunk = int(np.searchsorted(self.offsets, i, side='right')) - 1
+        episodes, actions = self.load_chunk(chunk)
+        e = episodes[i - self.offsets[chunk]]
+        return e, actions[e['action_start']:e['action_start'] + e['n_actions']]
@@ -0,0 +1,167 @@
+"""
+Local metrics writer, with the interface of a pycrayon experiment (add_scalar_value, add_scalar_dict, to_zip)
+
+The points are buffered in memory and appended to files by a background thread, so that logging a scalar never waits
+for the disk (or, as with Crayon, for an HTTP round trip). The points of a scalar are stored in columns, in a
+directory named after the (quoted) name of the scalar:
+    <path>/<name>/wall_time.f64   float64 timestamps
+    <path>/<name>/step.i64        int64 steps
+    <path>/<name>/value.f64       float64 values
+They can be read with `load_scalar` (numpy.fromfile) while the run goes on.
+An error of the background thread (e.g the disk is full) is raised by the next call of flush (or close). The points of
+the failed flush are lost, the next ones are written.
+"""
+from collections import defaultdict
+import os
+import threading
+import time
+from urllib.parse import quote, unquote
+import zipfile
+
+import numpy as np
+
+COLUMNS = (('wall_time', np.float64), ('step', np.int64), ('value', np.float64))
+
+
+def _column_path(scalar_path, column, dtype):
+    return os.path.join(scalar_path, '{}.{}{}'.format(column, np.dtype(dtype).kind, 8 * np.dtype(dtype).itemsize))
+
+
+def load_scalar(path, name):
+    """
+    :return: {'wall_time': array, 'step': array, 'value': array} of the flushed points of a scalar
+    """
+    scalar_path = os.path.join(path, quote(name, safe=''))
+    columns = {column: np.fromfile(_column_path(scalar_path, column, dtype), dtype=dtype)
+               for column, dtype in COLUMNS}
+    # a flush may have been interrupted between two columns
+    n = min(len(c) for c in columns.values())
+    return {column: c[:n] for column, c in columns.items()}
+
+
+class MetricsWriter:
+    def __init__(self, path, flush_interval=1., max_pending=2 ** 16):
+        """
+        :param path: directory of the scalars
+        :param flush_interval: seconds between two flushes of the background thread
+        :param max_pending: wake up the background thread when that many points are waiting
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        os.makedirs(path, exist_ok=True)
+        self._pending = defaultdict(list)
+        self._n_pending = 0
+        # last step of each scalar (steps are numbered from 0 when they are not given, as in Crayon)
+        self._steps = defaultdict(lambda: -1)
+        self._lock = threading.Lock()
+        # only one flush at a time writes to the files
+        self._flush_lock = threading.Lock()
+        self._wake_up = threading.Event()
+        self._closed = False
+        # error of the last flush of the background thread, raised by the next flush
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='MetricsWriter', daemon=True)
+        self._thread.start()
+
+    def add_scalar_value(self, name, value, wall_time=-1, step=-1):
+        if wall_time == -1:
+            wall_time = time.time()
+        with self._lock:
+            if self._closed:
+                raise ValueError('the metrics writer is closed')
+            if step == -1:
+                step = self._steps[name] + 1
+            self._steps[name] = step
+            self._pending[name].append((wall_time, step, value))
+            self._n_pending += 1
+            if self._n_pending >= self.max_pending:
+                self._wake_up.set()
+
+    def add_scalar_dict(self, data, wall_time=-1, step=-1):
+        """
+        :param data: {name: value or list of values}
+        """
+        if wall_time == -1:
+            wall_time = time.time()
+        for name, values in data.items():
+            if not isinstance(values, (list, tuple)):
+                values = [values]
+            for value in values:
+                self.add_scalar_value(name, value, wall_time, step)
+
+    def get_scalar_names(self):
+        self.flush()
+        return sorted(unquote(name) for name in os.listdir(self.path)
+                      if os.path.isdir(os.path.join(self.path, name)))
+
+    def get_scalar_values(self, name):
+        """
+        :return: the list of [wall_time, step, value] of a scalar
+        """
+        self.flush()
+        columns = load_scalar(self.path, name)
+        return [[float(w), int(s), float(v)] for w, s, v in zip(columns['wall_time'], columns['step'],
+                                                                   columns['value'])]
+
+    def flush(self):
+        """
+        append the pending points to the files, and raise the error of the background thread if it failed
+        """
+        self._write_pending()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write_pending(self):
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, defaultdict(list)
+                self._n_pending = 0
+            for name, points in pending.items():
+                scalar_path = os.path.join(self.path, quote(name, safe=''))
+                os.makedirs(scalar_path, exist_ok=True)
+                points = list(zip(*points))
+                for (column, dtype), values in zip(COLUMNS, points):
+                    with open(_column_path(scalar_path, column, dtype), 'ab') as f:
+                        np.asarray(values, dtype=dtype).tofile(f)
+
+    def to_zip(self, filename=None):
+        """
+        archive the scalars (as Crayon, the archive is written to filename, as is)
+        :return: the name of the archive
+        """
+        self.flush()
+        if filename is None:
+            filename = '{}_{}.zip'.format(os.path.normpath(self.path), time.time())
+        with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for root, _, files in os.walk(self.path):
+                for file in files:
+                    file_path = os.path.join(root, file)
+                    archive.write(file_path, os.path.relpath(file_path, self.path))
+        return filename
+
+    def close(self):
+        """
+        write the pending points and stop the background thread. The points added afterwards are rejected
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._wake_up.set()
+        self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while not self._closed:
+            self._wake_up.wait(self.flush_interval)
+            self._wake_up.clear()
+            try:
+                self._write_pending()
+            except Exception as e:
+                # let the next flush raise it
+                self._error = e
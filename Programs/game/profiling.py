@@ -0,0 +1,119 @@
+"""
+Wall time spent in each phase of the episodes (dealing, acting, storing, learning, ...)
+
+The phases are timed with `with profiler.phase(name):` blocks, which can be nested: the name of a phase is prefixed
+by the names of the phases it is in (e.g 'learn/rl/forward'). The time of a phase includes the time of its subphases.
+Only the thread that created the profiler is timed (e.g the sampling done by a ReplayPrefetcher is not), and a
+disabled profiler costs a method call per phase.
+`record` returns what was accumulated since the previous record, as a dict that can be exported (see `export`).
+"""
+from collections import defaultdict
+import json
+import threading
+import time
+
+
+class _NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase:
+    __slots__ = ('profiler', 'name')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.start(self.name)
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.stop()
+        return False
+
+
+class PhaseProfiler:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._thread_id = threading.get_ident()
+        self._stack = []
+        self.reset()
+
+    def reset(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.episodes = 0
+        self._record_time = time.perf_counter()
+
+    def phase(self, name):
+        if not self.enabled or threading.get_ident() != self._thread_id:
+            return _NULL_PHASE
+        return _Phase(self, name)
+
+    def start(self, name):
+        if len(self._stack) > 0:
+            name = self._stack[-1][0] + '/' + name
+        self._stack.append((name, time.perf_counter()))
+
+    def stop(self):
+        name, start = self._stack.pop()
+        self.seconds[name] += time.perf_counter() - start
+        self.calls[name] += 1
+
+    def add(self, name, seconds):
+        """
+        account for a phase timed by the caller (e.g when its name is only known at the end)
+        """
+        if not self.enabled or threading.get_ident() != self._thread_id:
+            return
+        if len(self._stack) > 0:
+            name = self._stack[-1][0] + '/' + name
+        self.seconds[name] += seconds
+        self.calls[name] += 1
+
+    def count_episode(self):
+        self.episodes += 1
+
+    def record(self, reset=True):
+        """
+        :return: {'time': timestamp, 'wall_seconds': seconds since the previous record, 'episodes': number of episodes,
+                  'phases': {name: {'seconds', 'calls', 'ms_per_episode', 'share' (of the wall time)}}}
+        """
+        wall_seconds = max(time.perf_counter() - self._record_time, 1e-9)
+        episodes = max(self.episodes, 1)
+        phases = {name: {'seconds': seconds,
+                         'calls': self.calls[name],
+                         'ms_per_episode': 1000 * seconds / episodes,
+                         'share': seconds / wall_seconds}
+                  for name, seconds in sorted(self.seconds.items())}
+        record = {'time': time.time(), 'wall_seconds': wall_seconds, 'episodes': self.episodes, 'phases': phases}
+        if reset:
+            self.reset()
+        return record
+
+    @staticmethod
+    def export(record, path):
+        """
+        append the record to a file of JSON lines
+        """
+        with open(path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    @staticmethod
+    def format(record):
+        lines = ['{:.1f}s, {} episodes'.format(record['wall_seconds'], record['episodes'])]
+        for name, phase in record['phases'].items():
+            lines.append('  {:<30} {:8.3f} ms/episode {:6.1%}'.format(name, phase['ms_per_episode'], phase['share']))
+        return '\n'.join(lines)
+
+
+# default profiler of the objects that were not given one
+NULL_PROFILER = PhaseProfiler(enabled=False)
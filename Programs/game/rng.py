@@ -0,0 +1,108 @@
+"""
+Random number streams
+
+All the randomness of a run (cards and dealer of each table, decisions of each actor, sampling of each replay buffer)
+comes from numpy Generators derived from one seed with a SeedSequence. Each generator only depends on the seed and on
+its key (e.g ('actor', table, player)), not on the order in which the generators are created, so that a run is
+reproducible, and so are parallel runs given the streams of `spawn`.
+The functions that can be called without a generator use a process-wide unseeded one (see `get_rng`).
+"""
+import random
+
+import numpy as np
+import torch as t
+
+# kinds of streams (first element of the spawn keys). The streams of the children of `spawn` are under SPAWN, so that
+# their keys never overlap the ones of the parent
+TABLE, ACTOR, BUFFER, GLOBALS, EVALUATION, EQUITY, SPAWN = range(7)
+BUFFER_TARGETS = {'rl': 0, 'sl': 1}
+
+_default_rng = np.random.default_rng()
+
+
+def get_rng(rng=None):
+    """
+    :return: rng, or the process-wide generator if it is None
+    """
+    return _default_rng if rng is None else rng
+
+
+class RNGStreams:
+    def __init__(self, seed=None):
+        """
+        :param seed: an int, a SeedSequence (e.g from `spawn`) or None for fresh entropy
+        """
+        if isinstance(seed, np.random.SeedSequence):
+            self.seed_sequence = seed
+        else:
+            self.seed_sequence = np.random.SeedSequence(seed)
+        # the seed to report to reproduce the run (it is the entropy drawn by numpy if no seed was given)
+        self.seed = self.seed_sequence.entropy
+        self._generators = {}
+        # number of children created by spawn
+        self.n_children = 0
+
+    def _sequence(self, *key):
+        return np.random.SeedSequence(self.seed_sequence.entropy,
+                                      spawn_key=self.seed_sequence.spawn_key + key)
+
+    def _generator(self, *key):
+        if key not in self._generators:
+            self._generators[key] = np.random.Generator(np.random.PCG64(self._sequence(*key)))
+        return self._generators[key]
+
+    def table(self, table_id=0):
+        """cards and dealer of a table"""
+        return self._generator(TABLE, table_id)
+
+    def actor(self, player_id, table_id=0):
+        """decisions of a player (random actions, exploration, choice between Q and pi)"""
+        return self._generator(ACTOR, table_id, player_id)
+
+    def equity(self, table_id=0):
+        """runouts sampled to estimate the all-in equities of a table (see odds.equity), apart from its cards"""
+        return self._generator(EQUITY, table_id)
+
+    def buffer(self, player_id, target):
+        """
+        :param target: 'rl' or 'sl'
+        """
+        return self._generator(BUFFER, player_id, BUFFER_TARGETS[target])
+
+    def evaluation(self, episode):
+        """
+        :return: the RNGStreams of the evaluation of the networks at an episode (see evaluation.evaluation_worker)
+        """
+        return RNGStreams(self._sequence(EVALUATION, episode))
+
+    def state_dict(self):
+        """
+        :return: the states of the generators created so far {key: state of the bit generator} (e.g for a checkpoint)
+        """
+        # the state of a bit generator is returned as a new dict
+        return {key: g.bit_generator.state for key, g in self._generators.items()}
+
+    def load_state_dict(self, state):
+        """
+        restore the generators of a state_dict. The generators it doesn't hold will be derived from the seed when
+        they are created
+        """
+        for key, generator_state in state.items():
+            self._generator(*key).bit_generator.state = generator_state
+
+    def spawn(self, n):
+        """
+        :return: n independent RNGStreams, e.g for parallel simulations (each call gives new ones)
+        """
+        children = [RNGStreams(self._sequence(SPAWN, i)) for i in range(self.n_children, self.n_children + n)]
+        self.n_children += n
+        return children
+
+    def seed_globals(self):
+        """
+        seed the global generators of random, numpy and torch (e.g the initialization of the networks)
+        """
+        seed = int(self._sequence(GLOBALS).generate_state(1)[0])
+        random.seed(seed)
+        np.random.seed(seed)
+        t.manual_seed(seed)
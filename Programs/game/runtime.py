@@ -0,0 +1,72 @@
+"""
+Runtime configuration of the training loop on CPU
+
+Acting only runs forward passes on a batch of one state: it is faster on a single thread,
+whereas the learning steps (minibatches) benefit from all the cores. The torch intra-op thread pool is
+resized when switching from one to the other.
+It also keeps counters of what was done (decisions, episodes, learner updates) to report the achieved throughput.
+"""
+import time
+import torch as t
+
+
+class RuntimeConfig:
+    def __init__(self, num_threads_act=None, num_threads_learn=None, num_interop_threads=None, report_freq=0, verbose=False):
+        """
+        :param num_threads_act: intra-op threads used to choose actions (None: leave torch's default)
+        :param num_threads_learn: intra-op threads used for the learning steps (None: leave torch's default)
+        :param num_interop_threads: inter-op threads. It can only be set before torch runs anything in parallel
+        :param report_freq: print the throughput every X episodes (0 to never print it)
+        """
+        self.num_threads_act = num_threads_act
+        self.num_threads_learn = num_threads_learn
+        self.num_interop_threads = num_interop_threads
+        self.report_freq = report_freq
+        self.verbose = verbose
+
+        if num_interop_threads is not None and hasattr(t, 'set_num_interop_threads'):
+            t.set_num_interop_threads(num_interop_threads)
+        self._default_num_threads = t.get_num_threads()
+        self._num_threads = self._default_num_threads
+
+        self.counts = {'episodes': 0, 'decisions': 0, 'updates': 0}
+        self._last_report_counts = dict(self.counts)
+        self._last_report_time = time.time()
+
+    def acting(self):
+        """Switch the thread pool to the acting configuration"""
+        self._set_num_threads(self.num_threads_act)
+
+    def learning(self):
+        """Switch the thread pool to the learning configuration"""
+        self._set_num_threads(self.num_threads_learn)
+
+    def _set_num_threads(self, num_threads):
+        if num_threads is None:
+            num_threads = self._default_num_threads
+        # resizing the pool is not free, only do it when it changes
+        if num_threads != self._num_threads:
+            t.set_num_threads(num_threads)
+            self._num_threads = num_threads
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def throughput(self):
+        """
+        Rates achieved since the last call
+        :return: a dict {'<counter>_per_sec': rate}
+        """
+        now = time.time()
+        elapsed = max(now - self._last_report_time, 1e-9)
+        rates = {'{}_per_sec'.format(k): (v - self._last_report_counts[k]) / elapsed for k, v in self.counts.items()}
+        self._last_report_counts = dict(self.counts)
+        self._last_report_time = now
+        return rates
+
+    def should_report(self):
+        return self.report_freq > 0 and self.counts['episodes'] % self.report_freq == 0
+
+    def __repr__(self):
+        return 'RuntimeConfig(act threads: {}, learn threads: {}, interop threads: {})'.format(
+            self.num_threads_act, self.num_threads_learn, self.num_interop_threads)
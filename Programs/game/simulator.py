@@ -1,19 +1,29 @@
 from odds.evaluation import evaluate_hand
+from odds.equity import all_in_equity
 from models.q_network import QNetwork, QNetworkBN, PiNetwork, PiNetworkBN
 
 from players.strategies import strategy_RL, strategy_random, strategy_mirror, StrategyNFSP
 from players.player import Player, NeuralFictitiousPlayer
 
 from game.utils import get_last_round, load_model
-from game.game_utils import Deck, set_dealer, blinds, deal, agreement, actions_to_array, array_to_cards, action_to_array, cards_to_array
-from game.state import build_state, create_state_variable_batch
+from game.game_utils import Deck, set_dealer, blinds, deal, actions_to_array, array_to_cards, action_to_array, cards_to_array, action_to_bucket_idx, pack_action_mask
+from game.state import build_state, create_state_variable_batch, EpisodeState
+from game.runtime import RuntimeConfig
+from game import betting
+from game.fast_engine import VectorizedEngine
+from game.rng import RNGStreams
+from game.profiling import PhaseProfiler
+from game.statistics import StatisticsAggregator
+from game.hand_history import HandHistoryWriter
+from game.checkpoint import Checkpointer
+from evaluation.evaluation_worker import EvaluationWorker, format_evaluation
 
 from constant import *
 from models.featurizer import FeaturizerManager
+from models.flat_parameters import FlatParameters
 import time
 import numpy as np
 import torch as t
-import pickle
 import models.q_network
 import os.path
 from torch.autograd import Variable
@@ -55,7 +65,27 @@ class Simulator:
                  grad_clip=None,
                  verbose=False,
                  cuda=False,
-                 tensorboard=None):
+                 tensorboard=None,
+                 runtime_config=None,
+                 prefetch_batches=0,
+                 updates_per_learn=1,
+                 target_Q_tau=None,
+                 flat_parameters=False,
+                 fast_baselines=False,
+                 all_in_equity=False,
+                 profile=False,
+                 profile_path=None,
+                 statistics_freq=1000,
+                 hand_history_path=None,
+                 checkpoint_path=None,
+                 checkpoint_freq=10000,
+                 checkpoint_background=True,
+                 checkpoint_memories=False,
+                 resume=True,
+                 evaluation_freq=0,
+                 evaluation_hands=2000,
+                 exploitability_stack=None,
+                 seed=None):
         # define msc.
         self.verbose = verbose
         self.cuda = cuda
@@ -66,15 +96,32 @@ class Simulator:
         self.learning_rate_sl = learning_rate_sl
         self.learning_freq = learning_freq
         self.target_Q_update_freq = target_Q_update_freq
+        self.target_Q_tau = target_Q_tau
+        # store the weights of Q and pi of each player in one buffer
+        self.flat_parameters = flat_parameters
+        # play the matchups between baselines with VectorizedEngine (same games and hooks, not the same random draws)
+        self.fast_baselines = fast_baselines
+        # when both players are all in before the river, the terminal rewards are the expected ones over the runouts
+        # (the stacks are still settled with the runout that is dealt)
+        self.all_in_equity = all_in_equity
+        self.equity = None
         self.learn_start = learn_start
         self.use_batch_norm = use_batch_norm
         self.strategy_p1 = strategy_p1
         self.strategy_p2 = strategy_p2
+        # all the random generators derive from the seed (see game.rng). It is drawn if not given, and can be reported
+        self.rng_streams = RNGStreams(seed)
+        self.seed = self.rng_streams.seed
+        if seed is not None:
+            # e.g the initialization of the networks
+            self.rng_streams.seed_globals()
 
         # NFSP-speicfic network hyperparams
         self.etas = {0: eta_p1, 1: eta_p2}
         self.memory_rl_config = memory_rl_config
         self.memory_sl_config = memory_sl_config
+        self.prefetch_batches = prefetch_batches
+        self.updates_per_learn = updates_per_learn
 
         # historical data
         # 1. game score
@@ -83,6 +130,18 @@ class Simulator:
         self.tensorboard = tensorboard
         self.experiment_id = experiment_id
 
+        # thread pools and throughput counters
+        self.runtime = runtime_config if runtime_config is not None else RuntimeConfig()
+        self.runtime.acting()
+        # time spent in each phase of the episodes, reported with the throughput (and appended to profile_path)
+        self.profiler = PhaseProfiler(enabled=profile)
+        self.profile_path = profile_path
+        # values too numerous to be logged one by one (e.g sampled actions), summarized every statistics_freq episodes
+        self.statistics = StatisticsAggregator(enabled=tensorboard is not None)
+        self.statistics_freq = statistics_freq
+        # cards, actions and results of every episode (see game.hand_history)
+        self.hand_history = HandHistoryWriter(hand_history_path) if hand_history_path is not None else None
+
         # debugging utility variables
         self.last_game_start_time = None
         self.last_episode_start_time = None
@@ -91,6 +150,8 @@ class Simulator:
 
         # define game-level game states here
         self.new_game = True
+        # state of the players, updated as the cards are dealt and the actions played
+        self.episode_state = EpisodeState()
         self.global_step = 0
 
         # define players
@@ -155,28 +216,162 @@ class Simulator:
         self.players = self._generate_player_instances(strategy_p1, strategy_p2,
                                                        Q_networks, Pi_networks,
                                                        learn_start, verbose)
+        self._attach_profiler()
+        self._attach_statistics()
 
         # define episode-level game states here
         self.deck = Deck()
-        self.dealer = set_dealer(self.players)
+        self.dealer = set_dealer(self.players, rng=self.rng_streams.table())
         self.board = []
         self.experiences = [None] * len(self.players)
 
-    def start(self, term_game_count=-1, return_results=False):
+        # training state saved every checkpoint_freq episodes (see game.checkpoint), and restored if resume. The
+        # resumed run is the same as an uninterrupted one only without prefetching (prefetch_batches=0)
+        self.checkpointer = None
+        self.checkpoint_freq = checkpoint_freq
+        # set (e.g by a signal handler) to stop after the current episode
+        self.stop_requested = False
+        if checkpoint_path is not None:
+            self.checkpointer = Checkpointer(checkpoint_path, background=checkpoint_background,
+                                             include_memories=checkpoint_memories)
+            if resume:
+                restored = self.checkpointer.restore(self)
+                if restored is not None:
+                    print('resumed from {} ({} episodes)'.format(restored, self.games['#episodes']))
+
+        # snapshots of the NFSP players evaluated against the baselines every evaluation_freq episodes (0: never), in
+        # a separate process (see evaluation.evaluation_worker)
+        self.evaluator = None
+        self.evaluation_freq = evaluation_freq
+        if evaluation_freq > 0 and any(p.player_type == 'nfsp' for p in self.players):
+            self.evaluator = EvaluationWorker(featurizer_path, use_batch_norm, n_hands=evaluation_hands,
+                                              exploitability_stack=exploitability_stack)
+
+    def start(self, term_game_count=-1, return_results=False, term_episode_count=-1):
+        '''
+        play until term_game_count games or term_episode_count episodes have been played (-1: no limit)
+        '''
+        if term_game_count > 0 and term_episode_count <= 0 and self._can_use_fast_engine():
+            return self._start_fast_engine(term_game_count, return_results)
         while True:
             if term_game_count > 0 and self.games['n'] > term_game_count:
                 break
+            if term_episode_count > 0 and self.games['#episodes'] >= term_episode_count:
+                break
             if self.new_game:
                 self._prepare_new_game()
             safe_to_start = self._prepare_new_episode()
             if not safe_to_start:
                 raise Exception('corrupt game')
             self._start_episode()
+            if self.checkpointer is not None and self.games['#episodes'] % self.checkpoint_freq == 0:
+                with self.profiler.phase('checkpoint'):
+                    self.checkpointer.save(self)
+            if self.evaluator is not None:
+                with self.profiler.phase('evaluation'):
+                    self._evaluate()
+            if self.stop_requested:
+                break
 
         if return_results:
             # return self.games.winnings
             return self.games['winnings']
 
+    def request_stop(self):
+        '''
+        stop `start` at the end of the current episode (e.g to checkpoint it)
+        '''
+        self.stop_requested = True
+
+    def checkpoint(self):
+        '''
+        write a checkpoint of the training state and wait until it is written
+        '''
+        path = self.checkpointer.save(self)
+        self.checkpointer.wait()
+        return path
+
+    def stop_evaluation(self):
+        '''
+        wait for the snapshots being evaluated, log their evaluations and stop the evaluation worker
+        '''
+        if self.evaluator is not None:
+            for evaluation in self.evaluator.close():
+                self._log_evaluation(evaluation)
+            self.evaluator = None
+
+    def close(self):
+        '''
+        stop the background work of the training once it is over: wait for the checkpoint being written and for the
+        evaluations, close the hand history and stop the prefetchers of the NFSP players
+        '''
+        if self.checkpointer is not None:
+            self.checkpointer.wait()
+        self.stop_evaluation()
+        if self.hand_history is not None:
+            self.hand_history.close()
+        for p in self.players:
+            if p.player_type == 'nfsp':
+                p.close()
+
+    def _evaluate(self):
+        '''
+        submit snapshots of the NFSP players every evaluation_freq episodes, and log the evaluations that are over
+        '''
+        episode = self.games['#episodes']
+        if episode % self.evaluation_freq == 0:
+            for p in self.players:
+                if p.player_type == 'nfsp':
+                    # the buffers (batch norm statistics) are not part of the flat parameters
+                    networks = (p.strategy._Q, p.strategy._pi)
+                    has_buffers = any(len(list(network.buffers())) > 0 for network in networks)
+                    self.evaluator.submit(episode, p.id, p.strategy._Q, p.strategy._pi,
+                                          self.rng_streams.evaluation(episode),
+                                          flat_parameters=None if has_buffers else p.flat_parameters)
+        for evaluation in self.evaluator.poll():
+            self._log_evaluation(evaluation)
+
+    def _log_evaluation(self, evaluation):
+        print(format_evaluation(evaluation))
+        if self.tensorboard is not None:
+            for policy, by_opponent in evaluation['results'].items():
+                for opponent, result in by_opponent.items():
+                    name = 'p{}_eval_{}_vs_{}'.format(evaluation['player'] + 1, policy, opponent)
+                    low, high = result['ci95']
+                    self.tensorboard.add_scalar_dict({name + '/mbb_per_hand': result['mbb_per_hand'],
+                                                      name + '/ci95_low': low,
+                                                      name + '/ci95_high': high}, step=evaluation['episode'])
+            if 'exploitability' in evaluation:
+                self.tensorboard.add_scalar_value('p{}_eval_pi_exploitability'.format(evaluation['player'] + 1),
+                                                  evaluation['exploitability']['exploitability'],
+                                                  step=evaluation['episode'])
+
+    def _can_use_fast_engine(self):
+        """baselines only, and nothing to log"""
+        return self.fast_baselines and self.strategy_p1 in baseline_strategies and \
+            self.strategy_p2 in baseline_strategies and self.tensorboard is None and not self.verbose and \
+            self.hand_history is None
+
+    def _start_fast_engine(self, term_game_count, return_results=False):
+        # as many games as the loop of start, which stops once games['n'] > term_game_count
+        n_games = term_game_count + 1 - self.games['n']
+        if n_games <= 0:
+            return self.games['winnings'] if return_results else None
+        engine = VectorizedEngine(strategy_function_map[self.strategy_p1], strategy_function_map[self.strategy_p2],
+                                  rng_streams=self.rng_streams)
+        results = engine.run(n_games)
+        for winner, n_episodes in zip(results['winners'], results['episodes']):
+            self.games['n'] += 1
+            self.games['#episodes'] += int(n_episodes)
+            self.runtime.count('episodes', int(n_episodes))
+            # the end of the game as seen by the loop of start: the winnings are recorded, and saved every log_freq
+            for p in self.players:
+                p.cash(2 * INITIAL_MONEY if p.id == winner else 0)
+            self._set_new_game()
+        self.fast_engine_results = results
+        if return_results:
+            return self.games['winnings']
+
     def _generate_player_instances(self, strategy_p1, strategy_p2,
                                    Q_networks, Pi_networks, learn_start, verbose):
         players = []
@@ -185,21 +380,27 @@ class Simulator:
             if strategy not in allowed_strategies:
                 raise ValueError("Not a valid strategy")
             elif strategy in baseline_strategies:
-                players.append(Player(p_id, strategy_function_map[strategy], INITIAL_MONEY, p_names[p_id], verbose=verbose))
+                players.append(Player(p_id, strategy_function_map[strategy], INITIAL_MONEY, p_names[p_id], verbose=verbose,
+                                      rng=self.rng_streams.actor(p_id)))
             elif strategy in qnetwork_strategies:
-                players.append(Player(p_id, strategy_function_map[strategy](Q_networks[p_id], True), INITIAL_MONEY, p_names[p_id], verbose=verbose))
+                players.append(Player(p_id, strategy_function_map[strategy](Q_networks[p_id], True), INITIAL_MONEY, p_names[p_id], verbose=verbose,
+                                      rng=self.rng_streams.actor(p_id)))
             elif strategy in NFSP_strategies:
                 Q = Q_networks[p_id]
                 pi = Pi_networks[p_id]
                 if self.should_load_models[p_id]:
                     Q = load_model(self.q_model_paths[p_id], Q, cuda=self.cuda)
                     pi = load_model(self.pi_model_paths[p_id], pi, cuda=self.cuda)
+                # Q first, so that its weights are a prefix of the buffer (used by the target network)
+                flat_parameters = FlatParameters([Q, pi]) if self.flat_parameters else None
 
                 strategy = StrategyNFSP(Q=Q,
                                         pi=pi,
                                         eta=self.etas[p_id],
                                         eps=self.eps,
-                                        cuda=self.cuda)
+                                        target_Q_tau=self.target_Q_tau,
+                                        cuda=self.cuda,
+                                        rng=self.rng_streams.actor(p_id))
 
                 nfp = NeuralFictitiousPlayer(pid=p_id,
                                              strategy=strategy,
@@ -211,12 +412,32 @@ class Simulator:
                                              memory_rl_config=self.memory_rl_config,
                                              memory_sl_config=self.memory_sl_config,
                                              learn_start=self.learn_start,
+                                             prefetch_batches=self.prefetch_batches,
+                                             updates_per_learn=self.updates_per_learn,
+                                             flat_parameters=flat_parameters,
+                                             rng_streams=self.rng_streams,
                                              verbose=self.verbose,
                                              tensorboard=self.tensorboard,
                                              cuda=self.cuda)
                 players.append(nfp)
         return players
 
+    def _attach_profiler(self):
+        for p in self.players:
+            if p.player_type == 'nfsp':
+                p.profiler = self.profiler
+                p.memory_rl.profiler = self.profiler
+                p.memory_sl.profiler = self.profiler
+                p.strategy._Q.profiler = self.profiler
+                p.strategy._pi.profiler = self.profiler
+
+    def _attach_statistics(self):
+        for p in self.players:
+            if p.player_type == 'nfsp':
+                p.statistics = self.statistics
+                p.strategy._Q.statistics = self.statistics
+                p.strategy._pi.statistics = self.statistics
+
     def _prepare_new_game(self):
         '''
         if new game -> initialize
@@ -241,15 +462,16 @@ class Simulator:
 
     def _prepare_new_episode(self):
         self.games['#episodes'] += 1
+        self.episode_start_stacks = (self.players[0].stack, self.players[1].stack)
         # PAY BLINDS
         self.pot = blinds(self.players, self.verbose)
         if self.verbose:
             print('pot: ' + str(self.pot))
 
         # SHUFFLE DECK AND CLEAR BOARD
-        self.deck.populate()
-        self.deck.shuffle()
+        self.deck.shuffle(self.rng_streams.table())
         self.board = []
+        self.episode_state.reset()
         self.players[0].is_all_in = False
         self.players[1].is_all_in = False
 
@@ -290,33 +512,59 @@ class Simulator:
         self.split = False
         self.showdown_occured = 0
         if not self.fold_occured:
-            self._showdown()
+            with self.profiler.phase('showdown'):
+                self._showdown()
             self.showdown_occured = 1
+        if self.equity is not None:
+            expected_rewards = self._expected_rewards(self.equity)
 
         # these two clauses update the `s`, `is_terminal` and `final_reward` of self.experiences[0/1]
-        if self.split:
-            self._handle_split()
-        else:
-            self._handle_no_split()
+        with self.profiler.phase('settle'):
+            if self.split:
+                self._handle_split()
+            else:
+                self._handle_no_split()
+        if self.equity is not None:
+            for p in self.players:
+                if p.player_type == 'nfsp' and not p.memory_rl.is_last_step_buffer_empty:
+                    self.experiences[p.id]['final_reward'] = expected_rewards[p.id]
         # store final experience
         # KEEP TRACK OF TRANSITIONS
-        last_round = get_last_round(self.actions, 0)
-        if last_round > -1:  # in that case you didnt play and was allin because of the blinds
-            if self.players[0].player_type == 'nfsp':
-                self.players[0].remember(self.experiences[0])
-
-        last_round = get_last_round(self.actions, 1)
-        if last_round > -1:  # in that case you didnt play and was allin because of the blinds
-            if len(self.actions[last_round][1]) > 0:
-                if self.players[1].player_type == 'nfsp':
-                    self.players[1].remember(self.experiences[1])
+        with self.profiler.phase('remember'):
+            last_round = get_last_round(self.actions, 0)
+            if last_round > -1:  # in that case you didnt play and was allin because of the blinds
+                if self.players[0].player_type == 'nfsp':
+                    self.players[0].remember(self.experiences[0])
+
+            last_round = get_last_round(self.actions, 1)
+            if last_round > -1:  # in that case you didnt play and was allin because of the blinds
+                if len(self.actions[last_round][1]) > 0:
+                    if self.players[1].player_type == 'nfsp':
+                        self.players[1].remember(self.experiences[1])
 
         if self.tensorboard is not None:
-            self._send_data_to_tensorboard()
-
-        for p in self.players:
-            if p.player_type == 'nfsp':
-                p.learn(self.global_step, self.games['#episodes'])
+            with self.profiler.phase('logging'):
+                self._send_data_to_tensorboard()
+        if self.hand_history is not None:
+            with self.profiler.phase('logging'):
+                self._record_hand_history()
+
+        self.runtime.learning()
+        with self.profiler.phase('learn'):
+            for p in self.players:
+                if p.player_type == 'nfsp':
+                    n_updates = p.learn(self.global_step, self.games['#episodes'])
+                    self.runtime.count('updates', n_updates)
+        self.runtime.acting()
+
+        self.runtime.count('episodes')
+        self.profiler.count_episode()
+        if self.runtime.should_report():
+            with self.profiler.phase('logging'):
+                self._report_throughput()
+        if self.tensorboard is not None and self.games['#episodes'] % self.statistics_freq == 0:
+            with self.profiler.phase('logging'):
+                self.statistics.emit(self.tensorboard)
 
         if self.verbose:
             self._log_episode_play_speed()
@@ -335,8 +583,11 @@ class Simulator:
             # DIFFERENTIATE THE CASES WHERE PLAYERS ARE ALL-IN FROM THE ONES WHERE NONE OF THEM IS
             if self.all_in < 2:
                 # DEAL CARDS
-                deal(self.deck, self.players, self.board, self.b_round, verbose=self.verbose)
+                with self.profiler.phase('deal'):
+                    deal(self.deck, self.players, self.board, self.b_round, verbose=self.verbose)
+                    self.episode_state.deal(self.players, self.board)
                 self.agreed = False  # True when the max bet has been called by everybody
+                self.betting_state = betting.initial_state(self.b_round)
 
                 # PLAY
                 if self.b_round != 0:
@@ -354,9 +605,15 @@ class Simulator:
                     # end episode
                     break
             else:
+                if self.all_in_equity and len(self.players[0].cards) == 2:
+                    with self.profiler.phase('equity'):
+                        self.equity = all_in_equity(self.players[0].cards, self.players[1].cards, self.board,
+                                                    rng=self.rng_streams.equity())
                 # DEAL REMAINING CARS
-                for r in range(self.b_round, 4):
-                    deal(self.deck, self.players, self.board, r, verbose=self.verbose)
+                with self.profiler.phase('deal'):
+                    for r in range(self.b_round, 4):
+                        deal(self.deck, self.players, self.board, r, verbose=self.verbose)
+                    self.episode_state.deal(self.players, self.board)
 
                 # END THE EPISODE
                 self._update_side_pot()
@@ -374,11 +631,27 @@ class Simulator:
         assert self.player.stack >= 0, self.player.stack
         assert not ((self.player.stack == 0) and not self.player.is_all_in), (self.player, self.player.is_all_in, self.actions)
 
-        self.action = self.player.play(self.board, self.pot,
-                                       self.actions, self.b_round,
-                                       self.players[1 - self.to_play].stack,
-                                       self.players[1 - self.to_play].side_pot,
-                                       BLINDS, self.games['#episodes'])
+        if self.player.player_type == 'nfsp':
+            # the same state is used to choose the action and stored in the experience
+            with self.profiler.phase('state'):
+                state = self.episode_state.snapshot(self.player, self.pot, self.players[1 - self.to_play].stack, BLINDS[1])
+            start = time.perf_counter()
+            self.action = self.player.play(self.board, self.pot,
+                                           self.actions, self.b_round,
+                                           self.players[1 - self.to_play].stack,
+                                           self.players[1 - self.to_play].side_pot,
+                                           BLINDS, self.games['#episodes'], state=state,
+                                           betting_state=self.betting_state)
+            # whether Q or pi chose the action is only known now
+            self.profiler.add('act/Q' if self.player.is_Q_used else 'act/pi', time.perf_counter() - start)
+        else:
+            start = time.perf_counter()
+            self.action = self.player.play(self.board, self.pot,
+                                           self.actions, self.b_round,
+                                           self.players[1 - self.to_play].stack,
+                                           self.players[1 - self.to_play].side_pot,
+                                           BLINDS, self.games['#episodes'], betting_state=self.betting_state)
+            self.profiler.add('act/baseline', time.perf_counter() - start)
 
         if self.action.type == 'null':
             # this happens when a player is all-in. In this case it can no longer play
@@ -393,14 +666,16 @@ class Simulator:
             # go to the next agreement step
             return
         self.player.has_played = True
+        self.runtime.count('decisions')
 
         # RL : STORE EXPERIENCES IN MEMORY.
         # Just for the NSFP agents. Note that it is saved BEFORE that the chosen action updates the state
         if self.player.player_type == 'nfsp':
-            self.experiences[self.player.id] = self.make_experience(self.player, self.action, self.new_game, self.board,
-                                                                    self.pot, self.dealer, self.actions, BLINDS[1],
-                                                                    self.global_step, self.b_round)
-            self.player.remember(self.experiences[self.player.id])
+            with self.profiler.phase('remember'):
+                self.experiences[self.player.id] = self.make_experience(self.player, self.action, self.new_game, self.board,
+                                                                        self.pot, self.dealer, self.actions, BLINDS[1],
+                                                                        self.global_step, self.b_round, state=state)
+                self.player.remember(self.experiences[self.player.id])
 
         # UPDATE STATE DEPENDING ON THE ACTION YOU TOOK
         # Sanity check: it should be impossible to bet/call/all in with value 0
@@ -426,11 +701,23 @@ class Simulator:
             return
 
         # otherwise, check if players came to an agreement
-        self.agreed = agreement(self.actions, self.b_round) or (self.all_in == 2)
+        self.agreed = betting.is_over(self.betting_state) or (self.all_in == 2)
         self.to_play = 1 - self.to_play
 
     def update_winnings(self):
-        self.games['winnings'][self.games['n']] = {self.players[0].stack, self.players[1].stack}
+        # stacks of player 0 and player 1
+        self.games['winnings'][self.games['n']] = (self.players[0].stack, self.players[1].stack)
+
+    def _record_hand_history(self):
+        self.hand_history.record(episode=self.games['#episodes'],
+                                 game=self.games['n'],
+                                 dealer=self.dealer,
+                                 hands=[p.cards for p in self.players],
+                                 board=self.board,
+                                 stacks=self.episode_start_stacks,
+                                 rewards=[p.stack - s for p, s in zip(self.players, self.episode_start_stacks)],
+                                 actions=self.actions,
+                                 showdown=bool(self.showdown_occured))
 
     def save_history_results(self, tag=''):
         # we save all history data here. Clear the dicts after saving them.
@@ -449,6 +736,8 @@ class Simulator:
         if self.tensorboard is not None:
             self.tensorboard.to_zip('{}{}_{}{}'.format(EXPERIMENT_PATH, cur_t, exp_id, tag))
             self._send_winnings_data_to_tensorboard()
+        if self.hand_history is not None:
+            self.hand_history.flush()
 
         # @todo: save experience replay
         print(self.games['n'], " games played and saved")
@@ -513,7 +802,7 @@ class Simulator:
         # logging the last winning results every log frequency
         for res in self.games['winnings'].values():
             for p in self.players:
-                did_win = int(list(res)[p.id] == INITIAL_MONEY * len(self.players))
+                did_win = int(res[p.id] == INITIAL_MONEY * len(self.players))
                 self.tensorboard.add_scalar_value('p{}_winnings'.format(p.id+1), did_win, time.time())
 
     def _send_showdown_data_to_tensorboard(self, showdown_occurred):
@@ -536,19 +825,6 @@ class Simulator:
             if self.players[1].has_played:
                 self.play_history[self.global_step][1]['r'] += self.experiences[1]['final_reward']
 
-    def _save_results(self, new_data, path):
-        if os.path.exists(path):
-            with open(path, 'rb') as f:
-                # extend the existing data with the new data
-                data = pickle.load(f)
-                data.update(new_data)
-
-            with open(path, 'wb') as f:
-                pickle.dump(data, f)
-        else:
-            with open(path, 'wb') as f:
-                pickle.dump(new_data, f)
-
     def _set_new_game(self):
         if self.players[0].stack == 0 or self.players[1].stack == 0:
             self.update_winnings()
@@ -582,12 +858,12 @@ class Simulator:
         self.experiences[1]['is_terminal'] = True
 
         opponent_stack = self.players[1].stack
-        state_ = build_state(self.players[0], self.board, self.pot, self.actions, opponent_stack, BLINDS[1], as_variable=False)
+        state_ = self.episode_state.snapshot(self.players[0], self.pot, opponent_stack, BLINDS[1])
         self.experiences[0]['s'] = state_
         self.experiences[0]['a'] = None
 
         opponent_stack = self.players[0].stack
-        state_ = build_state(self.players[1], self.board, self.pot, self.actions, opponent_stack, BLINDS[1], as_variable=False)
+        state_ = self.episode_state.snapshot(self.players[1], self.pot, opponent_stack, BLINDS[1])
         self.experiences[1]['s'] = state_
         self.experiences[1]['a'] = None
 
@@ -607,13 +883,10 @@ class Simulator:
         #       Reward for loser is pot - 2*opp_contribution - contribution
         if s_pot[self.winner] * 2 >= self.pot:  # if winner contributed at least to 50% of the pot, it takes all
             self.players[self.winner].stack += self.pot
-            self.total_reward_in_episode[self.winner] += self.pot - self.players[self.winner].contribution_in_this_pot
-            self.total_reward_in_episode[1 - self.winner] -= self.players[1 - self.winner].contribution_in_this_pot
         else:  # if winner contributed to less than 50% of the pot, it gets 2x its contribution
             self.players[self.winner].stack += 2 * s_pot[self.winner]
             self.players[1 - self.winner].stack += self.pot - 2 * s_pot[self.winner]
-            self.total_reward_in_episode[self.winner] += 2 * s_pot[self.winner] - self.players[self.winner].contribution_in_this_pot
-            self.total_reward_in_episode[1 - self.winner] += self.pot - 2 * s_pot[self.winner] - self.players[1 - self.winner].contribution_in_this_pot
+        self.total_reward_in_episode = self._showdown_rewards(self.winner)
 
         # RL
         if self.players[self.winner].player_type == 'nfsp':
@@ -627,15 +900,42 @@ class Simulator:
         self.experiences[1]['is_terminal'] = True
 
         opponent_stack = self.players[1].stack
-        state_ = build_state(self.players[0], self.board, self.pot, self.actions, opponent_stack, BLINDS[1], as_variable=False)
+        state_ = self.episode_state.snapshot(self.players[0], self.pot, opponent_stack, BLINDS[1])
         self.experiences[0]['s'] = state_
         self.experiences[0]['a'] = None
 
         opponent_stack = self.players[0].stack
-        state_ = build_state(self.players[1], self.board, self.pot, self.actions, opponent_stack, BLINDS[1], as_variable=False)
+        state_ = self.episode_state.snapshot(self.players[1], self.pot, opponent_stack, BLINDS[1])
         self.experiences[1]['s'] = state_
         self.experiences[1]['a'] = None
 
+    def _showdown_rewards(self, winner):
+        """
+        :return: the profit of each player if winner wins the pot (see the cases of _handle_no_split)
+        """
+        rewards = {}
+        s_pot = self.players[0].contribution_in_this_pot, self.players[1].contribution_in_this_pot
+        if s_pot[winner] * 2 >= self.pot:
+            rewards[winner] = self.pot - s_pot[winner]
+            rewards[1 - winner] = -s_pot[1 - winner]
+        else:
+            # it gets 2x its contribution
+            rewards[winner] = s_pot[winner]
+            rewards[1 - winner] = self.pot - 2 * s_pot[winner] - s_pot[1 - winner]
+        return rewards
+
+    def _expected_rewards(self, equity):
+        """
+        :param equity: probabilities that player 0 wins, that player 1 wins and of a split (see all_in_equity)
+        :return: the expected profit of each player over the runouts (a split is worth 0)
+        """
+        expected = {0: 0., 1: 0.}
+        for winner in range(2):
+            rewards = self._showdown_rewards(winner)
+            for p_id in range(2):
+                expected[p_id] += float(equity[winner]) * rewards[p_id]
+        return expected
+
     def _showdown(self):
         # compute the value of hands
         self.hand_1 = evaluate_hand(self.players[1].cards + self.board)
@@ -678,6 +978,7 @@ class Simulator:
     def _reset_variables(self):
         # RESET VARIABLES
         self.winner = None
+        self.equity = None
         self.pot = 0
         self.players[0].has_played = False
         self.players[1].has_played = False
@@ -742,11 +1043,14 @@ class Simulator:
         assert self.pot + self.players[0].stack + self.players[1].stack == 2 * INITIAL_MONEY, (self.players, self.actions, self.action)
         assert not ((self.player.stack == 0) and self.action.type != 'all in'), (self.actions, self.action, self.player)
         self.actions[self.b_round][self.player.id].append(self.action)
+        self.episode_state.add_action(self.b_round, self.player.id, len(self.actions[self.b_round][self.player.id]) - 1, self.action)
+        position = betting.SB if self.player.id == betting.get_dealer(self.actions) else betting.BB
+        self.betting_state = betting.step(self.betting_state, position, betting.TYPE_TO_IDX[self.action.type])
 
     def make_experience(self, player, action, new_game, board, pot, dealer, actions,
-                        big_blind, global_step, b_round):
+                        big_blind, global_step, b_round, state=None):
         opponent_stack = self.players[1 - player.id].stack
-        state_ = build_state(player, board, pot, actions, opponent_stack, big_blind, as_variable=False)
+        state_ = state if state is not None else self.episode_state.snapshot(player, pot, opponent_stack, big_blind)
 
         action_ = action_to_array(action)
         reward_ = 0  # terminal rewards only !!!!!!!!!
@@ -761,6 +1065,8 @@ class Simulator:
 
         experience = {'s': state_,
                       'a': action_,
+                      'a_idx': action_to_bucket_idx(action_),
+                      'legal_mask': pack_action_mask(player.legal_mask),
                       'r': reward_,
                       'next_s': None,
                       't': step_,
@@ -773,6 +1079,8 @@ class Simulator:
     def _make_new_exp(self):
         exp = {'s': 'TERMINAL',
                'a': None,
+               'a_idx': None,
+               'legal_mask': 0,  # nothing can be done in a terminal state
                'r': 0,
                's': None,
                't': self.global_step,
@@ -782,6 +1090,26 @@ class Simulator:
                }
         return exp
 
+    def _report_throughput(self):
+        rates = self.runtime.throughput()
+        print('episodes/sec: {episodes_per_sec:.1f} decisions/sec: {decisions_per_sec:.1f} '
+              'updates/sec: {updates_per_sec:.1f}'.format(**rates))
+        for player in self.players:
+            if player.player_type == 'nfsp':
+                # how many times each stored transition has been sampled on average
+                for target, ratio in player.replay_ratios.items():
+                    rates['p{}_{}_replay_ratio'.format(player.id, target)] = ratio
+                print('{} replay ratios: {}'.format(player.name, player.replay_ratios))
+        if self.profiler.enabled:
+            record = self.profiler.record()
+            print(PhaseProfiler.format(record))
+            if self.profile_path is not None:
+                PhaseProfiler.export(record, self.profile_path)
+            for name, phase in record['phases'].items():
+                rates['ms_per_episode/{}'.format(name)] = phase['ms_per_episode']
+        if self.tensorboard is not None:
+            self.tensorboard.add_scalar_dict(rates)
+
     def _log_game_play_speed(self):
         if self.last_game_start_time is None:
             self.last_game_start_time = time.time()
@@ -1,7 +1,7 @@
 import numpy as np
 import torch as t
 from torch.autograd import Variable
-from game.game_utils import cards_to_array, actions_to_array
+from game.game_utils import Card, cards_to_array, actions_to_array, action_to_array
 from game.utils import variable
 
 def create_state_variable(state, cuda=False):
@@ -67,3 +67,63 @@ def build_state(player, board, pot, actions, opponent_stack, big_blind, as_varia
         return create_state_variable(state)
     else:
         return state
+
+
+# layout of the state in the buffers of EpisodeState (same components as build_state)
+STATE_SHAPES = [(13, 4), (3, 13, 4), (1,), (1,), (1,), (1,), (1,), (6, 5, 2), (6, 5, 2), (6, 5, 2), (6, 5, 2)]
+STATE_OFFSETS = np.cumsum([0] + [int(np.prod(shape)) for shape in STATE_SHAPES])
+HAND, BOARD, POT, STACK, OPPONENT_STACK, BIG_BLIND, DEALER, PREFLOP_PLAYS = range(8)
+# plane of the board array of each card (see cards_to_array)
+BOARD_PLANES = [0, 0, 0, 1, 2]
+
+
+class EpisodeState:
+    """
+    State of an episode (as returned by build_state) maintained incrementally by the Simulator:
+    the cards and the plays are written once, when they are dealt or played, instead of being rebuilt at each decision.
+    Each player has its own buffer and taking a snapshot is a single copy of it.
+    """
+
+    def __init__(self):
+        self.buffers = np.zeros((2, STATE_OFFSETS[-1]))
+        self.views = [self._split(buffer) for buffer in self.buffers]
+
+    @staticmethod
+    def _split(buffer):
+        return [buffer[STATE_OFFSETS[i]:STATE_OFFSETS[i + 1]].reshape(shape) for i, shape in enumerate(STATE_SHAPES)]
+
+    def reset(self):
+        """to be called when a new episode starts"""
+        self.buffers[:] = 0
+
+    def deal(self, players, board):
+        """
+        to be called after some cards were dealt. Writing a card again does nothing
+        """
+        for player in players:
+            for card in player.cards:
+                self.views[player.id][HAND][Card.RANK_TO_IDX[card.rank], Card.SUITS.index(card.suit)] = 1
+        for i, card in enumerate(board):
+            for views in self.views:
+                views[BOARD][BOARD_PLANES[i], Card.RANK_TO_IDX[card.rank], Card.SUITS.index(card.suit)] = 1
+
+    def add_action(self, b_round, player_id, k, action):
+        """
+        to be called after the k-th action of player_id in b_round was played
+        note that, as in actions_to_array, the plays are indexed by player id (not relative to the player)
+        """
+        play = action_to_array(action)[:-1]
+        for views in self.views:
+            views[PREFLOP_PLAYS + b_round][k, :, player_id] = play
+
+    def snapshot(self, player, pot, opponent_stack, big_blind):
+        """
+        :return: the state of player, equal to build_state(player, board, pot, actions, opponent_stack, big_blind)
+        """
+        views = self.views[player.id]
+        views[POT][0] = pot
+        views[STACK][0] = player.stack
+        views[OPPONENT_STACK][0] = opponent_stack
+        views[BIG_BLIND][0] = big_blind
+        views[DEALER][0] = player.id if player.is_dealer else 1 - player.id
+        return [np.expand_dims(s, axis=0) for s in self._split(self.buffers[player.id].copy())]
@@ -0,0 +1,139 @@
+"""
+Aggregation of the values that are too numerous to be logged one by one (sampled actions and rewards, hand strengths)
+
+The values are accumulated with vectorized updates, in counters, histograms and running moments, and a summary of
+what was accumulated is emitted every N episodes as a dict of scalars {'<name>/<statistic>': value}, e.g
+'M_RL_sampled_rewards/mean' or 'M_RL_sampled_actions/3' (number of samples in the bin of the action bucket 3).
+A disabled aggregator ignores the values.
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+
+class RunningMoments:
+    """count, mean, variance, min and max of a stream of values"""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.  # sum of the squared deviations from the mean
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values) == 0:
+            return
+        # merge the moments of the batch (Chan et al.)
+        count, mean = len(values), values.mean()
+        m2 = ((values - mean) ** 2).sum()
+        delta = mean - self.mean
+        total = self.count + count
+        self.mean += delta * count / total
+        self.m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+    @property
+    def variance(self):
+        return self.m2 / self.count if self.count > 0 else 0.
+
+    def summary(self):
+        return OrderedDict([('count', self.count), ('mean', self.mean), ('std', np.sqrt(self.variance)),
+                            ('min', self.min), ('max', self.max)])
+
+
+class Histogram:
+    """counts of the values of a stream that fall in each bin"""
+
+    def __init__(self, edges):
+        """
+        :param edges: the n + 1 increasing edges of the n bins. The values out of them are counted apart
+        """
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.counts = np.zeros(len(self.edges) - 1, dtype=np.int64)
+        self.n_out = 0
+
+    @classmethod
+    def integers(cls, low, high):
+        """one bin per integer of [low, high]"""
+        return cls(np.arange(low, high + 2) - .5)
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        counts, _ = np.histogram(values, self.edges)
+        self.counts += counts
+        self.n_out += len(values) - counts.sum()
+
+    def labels(self):
+        """the integer of the bins of an `integers` histogram, the left edge of the bins otherwise"""
+        centers = (self.edges[:-1] + self.edges[1:]) / 2
+        if np.allclose(self.edges[1:] - self.edges[:-1], 1) and np.allclose(centers, np.round(centers)):
+            return [str(int(round(c))) for c in centers]
+        return ['{:g}'.format(e) for e in self.edges[:-1]]
+
+    def summary(self):
+        summary = OrderedDict(zip(self.labels(), self.counts.tolist()))
+        summary['out'] = self.n_out
+        return summary
+
+
+class StatisticsAggregator:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self._counters = OrderedDict()
+        self._histograms = OrderedDict()
+        self._moments = OrderedDict()
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        self._counters[name] = self._counters.get(name, 0) + n
+
+    def histogram(self, name, values, edges):
+        """
+        :param edges: edges of the bins, used when the histogram is created (e.g `Histogram.integers(l, h).edges`)
+        """
+        if not self.enabled:
+            return
+        if name not in self._histograms:
+            self._histograms[name] = Histogram(edges)
+        self._histograms[name].add(values)
+
+    def moments(self, name, values):
+        if not self.enabled:
+            return
+        if name not in self._moments:
+            self._moments[name] = RunningMoments()
+        self._moments[name].add(values)
+
+    def summary(self, reset=True):
+        """
+        :return: {'<name>/<statistic>': value} of what was accumulated since the last reset
+        """
+        summary = OrderedDict(self._counters)
+        for stats in [self._histograms, self._moments]:
+            for name, s in stats.items():
+                for statistic, value in s.summary().items():
+                    summary['{}/{}'.format(name, statistic)] = float(value)
+        if reset:
+            self.reset()
+        return summary
+
+    def emit(self, writer):
+        """
+        send the summary to a metrics writer (see game.metrics) and reset the statistics
+        """
+        summary = self.summary()
+        if len(summary) > 0:
+            writer.add_scalar_dict(summary)
+        return summary
+
+
+# default aggregator of the objects that were not given one
+NULL_STATISTICS = StatisticsAggregator(enabled=False)
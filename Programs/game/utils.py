@@ -3,6 +3,8 @@ import torch as t
 import datetime
 import os, errno
 
+from game.rng import get_rng
+
 
 def get_last_round(actions, player):
     for i in reversed(range(0, 4)):
@@ -17,11 +19,11 @@ def softmax(x):
     return e_x / e_x.sum(axis=0)
 
 
-def sample_categorical(probabilities):
+def sample_categorical(probabilities, rng=None):
     stops = [0]
     for p in probabilities:
         stops.append(stops[-1]+p)
-    u = np.random.uniform()
+    u = get_rng(rng).random()
     for k in range(len(stops)-1):
         if stops[k] <= u < stops[k+1]:
             return k
@@ -47,6 +49,18 @@ def variable(array, requires_grad=False, to_float=True, cuda=False):
         return v
 
 
+def masked_max(values, mask):
+    """
+    Max over the last dimension of `values`, restricted to the entries where `mask` is 1
+    :param values: variable of size batch_size x n
+    :param mask: float variable of size batch_size x n, with 1 for the entries to consider and 0 elsewhere
+    :return: variable of size batch_size. It is 0 for the rows where mask is empty (e.g terminal states)
+    """
+    has_any = t.max(mask, -1)[0]
+    masked_values = values * mask + (mask - 1) * 1e9
+    return t.max(masked_values, -1)[0] * has_any
+
+
 def moving_avg(x, window=50):
     return [np.mean(x[k:k+window]) for k in range(len(x)-window)]
 
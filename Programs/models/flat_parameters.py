@@ -0,0 +1,129 @@
+"""
+Parameters stored in one contiguous buffer
+
+The parameters of several modules (e.g Q and pi of a player, which share layers) become views of a flat tensor,
+so that copying all the weights somewhere else (a target network, a copy in another process) is a single copy.
+The modules must be on their final device before being flattened: .cuda() replaces the parameters' storage.
+A WeightBroadcaster publishes the buffer in shared memory, e.g for the evaluation worker (see
+evaluation.evaluation_worker) to read the weights of the networks without them being pickled.
+"""
+import torch as t
+
+
+def contiguous_view(params):
+    """
+    :return: a 1D view of the concatenation of params if they are stored one after the other in the same tensor,
+             None otherwise
+    """
+    params = list(params)
+    if len(params) == 0:
+        return None
+    first = params[0].data
+    expected = first.data_ptr()
+    for p in params:
+        if not p.data.is_contiguous() or p.data.data_ptr() != expected or \
+                p.data.untyped_storage().data_ptr() != first.untyped_storage().data_ptr():
+            return None
+        expected += p.numel() * p.data.element_size()
+    n = sum(p.numel() for p in params)
+    return first.new().set_(first.untyped_storage(), first.storage_offset(), (n,))
+
+
+class FlatParameters:
+    def __init__(self, modules, trainable_only=True):
+        """
+        :param modules: list of modules. Their parameters are laid out in this order (a parameter shared by several
+                        modules appears once), so that the parameters of the first module are a prefix of the buffer
+        :param trainable_only: leave the frozen parameters (requires_grad=False, e.g the featurizer) where they are
+        """
+        self.params = []
+        seen = set()
+        for module in modules:
+            for p in module.parameters():
+                if id(p) in seen or (trainable_only and not p.requires_grad):
+                    continue
+                seen.add(id(p))
+                self.params.append(p)
+
+        self.flat = t.cat([p.data.view(-1) for p in self.params])
+        self.offsets = {}
+        offset = 0
+        for p in self.params:
+            n = p.numel()
+            # the optimizers keep references to the parameters: only their data is replaced
+            p.data = self.flat[offset:offset + n].view_as(p)
+            self.offsets[id(p)] = (offset, n)
+            offset += n
+        # incremented each time the weights change (see bump)
+        self.version = 0
+
+    def __len__(self):
+        return self.flat.numel()
+
+    def segment(self, module):
+        """
+        :return: the part of the buffer holding the (flattened) parameters of module, if they are contiguous
+        """
+        return contiguous_view(p for p in module.parameters() if id(p) in self.offsets)
+
+    def bump(self):
+        """
+        to be called after the parameters were updated (e.g after an optimizer step)
+        """
+        self.version += 1
+
+    def copy_from(self, flat):
+        self.flat.copy_(flat)
+
+
+class WeightBroadcaster:
+    """
+    Publishes the weights of a FlatParameters in shared memory, for a copy of the networks in another process to pull
+    them only when they changed. The broadcaster is sent to the other process as is (through a multiprocessing queue
+    or as an argument of the process): the shared tensors are not copied, and the source stays in this process
+    """
+
+    def __init__(self, source):
+        """
+        :param source: FlatParameters of the learner
+        """
+        self.source = source
+        self.buffer = source.flat.detach().clone().share_memory_()
+        self.version = t.zeros(1).long().share_memory_()
+        self.version[0] = source.version
+        # version of the weights pulled last (-1: never)
+        self.pulled = t.full((1,), -1).long().share_memory_()
+
+    def __getstate__(self):
+        return {'source': None, 'buffer': self.buffer, 'version': self.version, 'pulled': self.pulled}
+
+    def is_pulled(self):
+        """
+        :return: True if the weights published last were pulled (publishing now doesn't overwrite weights not read yet)
+        """
+        return int(self.pulled[0]) == int(self.version[0])
+
+    def publish(self):
+        """
+        copy the learner's weights to the shared buffer, if they changed since the last call
+        :return: the version of the published weights
+        """
+        if self.source.version != int(self.version[0]):
+            self.buffer.copy_(self.source.flat)
+            self.version[0] = self.source.version
+        return int(self.version[0])
+
+    def pull(self, replica, replica_version=-1):
+        """
+        :param replica: FlatParameters with the same layout as the source
+        :param replica_version: version of the weights the replica holds
+        :return: the version of the weights the replica holds after the call
+        """
+        if len(replica) != self.buffer.numel():
+            raise ValueError('the replica has {} parameters, the source {}'.format(len(replica), self.buffer.numel()))
+        version = int(self.version[0])
+        if version != replica_version:
+            replica.copy_from(self.buffer)
+            replica.version = version
+        self.pulled[0] = version
+        return version
@@ -4,8 +4,10 @@ import torch.nn as nn
 import torch.optim as optim
 import numpy as np
 import time
-from game.game_utils import bucket_encode_actions, array_to_cards
+from game.game_utils import array_to_cards
 from game.utils import variable
+from game.profiling import NULL_PROFILER
+from game.statistics import NULL_STATISTICS
 
 selu = SELU()
 softmax = Softmax()
@@ -172,6 +174,11 @@ class SharedNetwork(t.nn.Module):
 
 
 class QNetwork(t.nn.Module):
+    # times the learning steps (see game.profiling)
+    profiler = NULL_PROFILER
+    # aggregates the hand strengths (see game.statistics)
+    statistics = NULL_STATISTICS
+
     def __init__(self,
                  n_actions,
                  hidden_dim,
@@ -250,12 +257,9 @@ class QNetwork(t.nn.Module):
 
         HS, flop_features, turn_features, river_features, cards_features = self.featurizer.forward(hand, board)
 
-        if self.verbose and for_play:
+        if self.verbose and for_play and self.statistics.enabled:
             # if forward was used during play (not training)
-            if self.tensorboard is not None:
-                hand_strength = float(HS.data.cpu().numpy().flatten()[0])
-                self.tensorboard.add_scalar_value('p{}_hand_strength_q(play)'.format(self.player_id + 1),
-                                                  hand_strength, time.time())
+            self.statistics.moments('p{}_hand_strength_q(play)'.format(self.player_id + 1), HS.data.cpu().numpy())
 
         # HS, proba_combinations, flop_features, turn_features, river_features, cards_features = self.featurizer.forward(hand, board)
         situation_with_opponent = self.shared_network.forward(HS, cards_features, flop_features, turn_features, river_features, pot, stack, opponent_stack, big_blind, dealer, preflop_plays, flop_plays, turn_plays, river_plays)
@@ -264,25 +268,29 @@ class QNetwork(t.nn.Module):
 
         return q_values
 
-    def learn(self, states, actions, Q_targets, imp_weights):
+    def learn(self, states, action_idxs, Q_targets, imp_weights):
+        """
+        :param action_idxs: LongTensor variable of the indexes of the actions taken (bucket + 1, see `action_to_bucket_idx`)
+        """
         self.optim.zero_grad()
-        all_Q_preds = self.forward(*states)
+        with self.profiler.phase('forward'):
+            all_Q_preds = self.forward(*states)
+            Q_preds = all_Q_preds.gather(1, action_idxs.unsqueeze(1)).squeeze(1)  # Q(s,a)
 
-        actions_ = (bucket_encode_actions(actions, cuda=self.is_cuda) + 1).long()
-        Q_preds = t.cat([all_Q_preds[i, aa] for i, aa in enumerate(actions_.data)]).squeeze()  # Q(s,a)
-
-        loss, td_deltas = self.compute_loss(Q_preds, Q_targets, imp_weights)
+            loss, td_deltas = self.compute_loss(Q_preds, Q_targets, imp_weights)
 
         if self.tensorboard is not None:
-            raw_loss = loss.data.cpu().numpy()[0]
+            raw_loss = loss.data.cpu().numpy().flatten()[0]
             self.tensorboard.add_scalar_value('p{}_q_loss'.format(self.player_id + 1), float(raw_loss), time.time())
 
-        loss.backward()
+        with self.profiler.phase('backward'):
+            loss.backward()
 
-        if self.grad_clip is not None:
-            t.nn.utils.clip_grad_norm(self.parameters(), self.grad_clip)
+        with self.profiler.phase('optimizer'):
+            if self.grad_clip is not None:
+                t.nn.utils.clip_grad_norm(self.parameters(), self.grad_clip)
 
-        self.optim.step()
+            self.optim.step()
         return td_deltas
 
     def compute_loss(self, pred, target, imp_weights):
@@ -311,6 +319,11 @@ class QNetwork(t.nn.Module):
 
 
 class PiNetwork(t.nn.Module):
+    # times the learning steps (see game.profiling)
+    profiler = NULL_PROFILER
+    # aggregates the hand strengths (see game.statistics)
+    statistics = NULL_STATISTICS
+
     def __init__(self,
                  n_actions,
                  hidden_dim,
@@ -387,16 +400,13 @@ class PiNetwork(t.nn.Module):
 
         HS, flop_features, turn_features, river_features, cards_features = self.featurizer.forward(hand, board)
 
-        if self.verbose and for_play:
+        if self.verbose and for_play and self.statistics.enabled:
             # if forward was used during play (not training)
-            if self.tensorboard is not None:
-                hand_strength = float(HS.data.cpu().numpy().flatten()[0])
-                self.tensorboard.add_scalar_value('p{}_hand_strength_pi(play)'.format(self.player_id + 1),
-                                                  hand_strength, time.time())
+            self.statistics.moments('p{}_hand_strength_pi(play)'.format(self.player_id + 1), HS.data.cpu().numpy())
         situation_with_opponent = self.shared_network.forward(HS, cards_features, flop_features, turn_features, river_features, pot, stack, opponent_stack, big_blind, dealer, preflop_plays, flop_plays, turn_plays, river_plays)
 
         pi_values = selu(dropout(self.fc27(situation_with_opponent)))
-        softmax = Softmax(dim=0)
+        softmax = Softmax(dim=-1)
         pi_values = softmax(dropout(self.fc28(pi_values)))
 
         # for saving neural network history data
@@ -408,23 +418,28 @@ class PiNetwork(t.nn.Module):
 
         return pi_values
 
-    def learn(self, states, actions):
+    def learn(self, states, action_idxs):
+        """
+        :param action_idxs: LongTensor variable of the indexes of the actions taken (bucket + 1, see `action_to_bucket_idx`)
+        """
         self.optim.zero_grad()
-        pi_preds = self.forward(*states).squeeze()
-        criterion = nn.CrossEntropyLoss()
-        one_hot_actions = bucket_encode_actions(actions, cuda=self.is_cuda)
-        loss = criterion(pi_preds, (1+one_hot_actions).long())
+        with self.profiler.phase('forward'):
+            pi_preds = self.forward(*states).squeeze()
+            criterion = nn.CrossEntropyLoss()
+            loss = criterion(pi_preds, action_idxs)
 
-        raw_loss = loss.data.cpu().numpy()[0]
+        raw_loss = loss.data.cpu().numpy().flatten()[0]
 
         if self.tensorboard is not None:
             self.tensorboard.add_scalar_value('p{}_pi_loss'.format(self.player_id + 1), float(raw_loss), time.time())
 
-        loss.backward()
+        with self.profiler.phase('backward'):
+            loss.backward()
 
-        if self.grad_clip is not None:
-            t.nn.utils.clip_grad_norm(self.parameters(), self.grad_clip)
-        self.optim.step()
+        with self.profiler.phase('optimizer'):
+            if self.grad_clip is not None:
+                t.nn.utils.clip_grad_norm(self.parameters(), self.grad_clip)
+            self.optim.step()
 
         return loss
 
@@ -475,6 +490,8 @@ class SharedNetworkBN(t.nn.Module):
 
 
 class QNetworkBN(t.nn.Module):
+    statistics = NULL_STATISTICS
+
     def __init__(self,
                  n_actions,
                  hidden_dim,
@@ -537,8 +554,9 @@ class QNetworkBN(t.nn.Module):
         HS, flop_features, turn_features, river_features, cards_features = self.featurizer.forward(hand, board)
         # HS, proba_combinations, flop_features, turn_features, river_features, cards_features = self.featurizer.forward(hand, board)
 
-        if self.tensorboard is not None:
-            self.tensorboard.add_scalar_value('p{}_hand_strength'.format(self.player_id + 1), float(HS.data.cpu().numpy().flatten()[0]), time.time())
+        if self.statistics.enabled:
+            # the copy to numpy is only done when the statistics are aggregated
+            self.statistics.moments('p{}_hand_strength'.format(self.player_id + 1), HS.data.cpu().numpy())
         situation_with_opponent = self.shared_network.forward(HS, cards_features, flop_features, turn_features, river_features, pot, stack, opponent_stack, big_blind, dealer, preflop_plays, flop_plays, turn_plays, river_plays)
         q_values = leakyrelu(self.bn27(self.fc27(situation_with_opponent)))
         q_values = self.bn28(self.fc28(q_values))
@@ -552,11 +570,10 @@ class QNetworkBN(t.nn.Module):
 
         return q_values
 
-    def learn(self, states, actions, Q_targets, imp_weights):
+    def learn(self, states, action_idxs, Q_targets, imp_weights):
         self.optim.zero_grad()
         all_Q_preds = self.forward(*states)
-        actions_ = (bucket_encode_actions(actions, cuda=self.is_cuda) + 1).long()
-        Q_preds = t.cat([all_Q_preds[i, aa] for i, aa in enumerate(actions_.data)]).squeeze()  # Q(s,a)
+        Q_preds = all_Q_preds.gather(1, action_idxs.unsqueeze(1)).squeeze(1)  # Q(s,a)
         loss, td_deltas = self.compute_loss(Q_preds, Q_targets, imp_weights)
 
         # log loss history data
@@ -653,7 +670,7 @@ class PiNetworkBN(t.nn.Module):
 
         return pi_values
 
-    def learn(self, states, actions):
+    def learn(self, states, action_idxs):
         """
         From Torch site
          loss = nn.CrossEntropyLoss()
@@ -665,13 +682,12 @@ class PiNetworkBN(t.nn.Module):
         self.optim.zero_grad()
         pi_preds = self.forward(*states).squeeze()
         criterion = nn.CrossEntropyLoss()
-        one_hot_actions = bucket_encode_actions(actions, cuda=self.is_cuda)
-        loss = criterion(pi_preds, (1 + one_hot_actions).long())
+        loss = criterion(pi_preds, action_idxs)
 
         # log loss history data
         #if not 'pi' in self.neural_network_loss[self.player_id]:
         #    self.neural_network_loss[self.player_id]['pi'] = []
-        raw_loss = loss.data.cpu().numpy()[0]
+        raw_loss = loss.data.cpu().numpy().flatten()[0]
         #self.neural_network_loss[self.player_id]['pi'].append(raw_loss)
         if self.tensorboard is not None:
             self.tensorboard.add_scalar_value('p{}_pi_loss'.format(self.player_id + 1), float(raw_loss), time.time())
@@ -0,0 +1,87 @@
+"""
+Target network of the Q-learning updates
+
+The target network is a separate copy of Q whose trainable weights live in one contiguous buffer.
+Synchronizing it with Q is then a single copy (hard update) or a single in-place lerp_ (soft/Polyak update),
+cheap enough to be done after every learning step.
+The frozen modules (e.g the featurizer) are not copied: they are shared with Q.
+If the weights of Q are themselves stored in a flat buffer (see FlatParameters), it is used directly.
+"""
+import copy
+import torch as t
+
+from models.flat_parameters import contiguous_view
+
+
+class TargetNetwork:
+    # attributes of the networks that must not be copied (optimizer state, logging, game history, profiler)
+    SHARED_ATTRIBUTES = ('optim', 'tensorboard', 'game_info', 'profiler', 'statistics')
+
+    def __init__(self, network, tau=None):
+        """
+        :param network: the online network
+        :param tau: weight of the online network in the soft updates. None to only use hard updates
+        """
+        self.online = network
+        self.tau = tau
+        self.network = self._copy(network)
+
+        # pairs of (online, target) tensors: the shared (frozen) ones are skipped
+        pairs = [(p, q) for p, q in zip(network.parameters(), self.network.parameters()) if p is not q]
+        self._online_params = [p for p, _ in pairs]
+        self._buffers = [(b, c) for b, c in zip(network.buffers(), self.network.buffers()) if b is not c]
+
+        # the target parameters become views of a flat buffer
+        target_params = [q for _, q in pairs]
+        self._flat = t.cat([q.data.view(-1) for q in target_params]) if target_params else t.zeros(0)
+        offset = 0
+        for q in target_params:
+            n = q.numel()
+            q.data = self._flat[offset:offset + n].view_as(q)
+            q.requires_grad = False
+            offset += n
+        # where the online parameters are gathered before an update (unless they already are contiguous)
+        self._online_flat = contiguous_view(self._online_params)
+        self._staging = self._flat.clone() if self._online_flat is None else self._online_flat
+
+    def _copy(self, network):
+        memo = {}
+        for name in self.SHARED_ATTRIBUTES:
+            if hasattr(network, name):
+                attr = getattr(network, name)
+                memo[id(attr)] = attr
+        for module in network.children():
+            params = list(module.parameters())
+            if len(params) > 0 and not any(p.requires_grad for p in params):
+                memo[id(module)] = module
+        return copy.deepcopy(network, memo)
+
+    def forward(self, *args, **kwargs):
+        return self.network.forward(*args, **kwargs)
+
+    def __call__(self, *args, **kwargs):
+        return self.network(*args, **kwargs)
+
+    def _gather_online(self):
+        if len(self._online_params) > 0 and self._online_flat is None:
+            t.cat([p.data.view(-1) for p in self._online_params], out=self._staging)
+        for b, c in self._buffers:
+            c.copy_(b)
+
+    def hard_update(self):
+        """
+        copy the weights of the online network
+        """
+        self._gather_online()
+        self._flat.copy_(self._staging)
+
+    def soft_update(self, tau=None):
+        """
+        target <- (1 - tau) * target + tau * online
+        """
+        tau = self.tau if tau is None else tau
+        self._gather_online()
+        self._flat.lerp_(self._staging, tau)
+
+    def state_dict(self):
+        return self.network.state_dict()
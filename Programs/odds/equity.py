@@ -0,0 +1,64 @@
+"""
+Equity of two hands when both players are all in
+
+The runouts of the board are enumerated when there are few of them (after the flop or the turn), and sampled
+otherwise (preflop: C(48, 5) = 1.7M runouts). All of them are evaluated at once with `evaluate_hands_batch`.
+"""
+from itertools import combinations
+from math import comb
+
+import numpy as np
+
+from game.game_utils import N_CARDS, card_index
+from game.rng import get_rng
+from odds.evaluation import evaluate_hands_batch
+
+# above this number of runouts, they are sampled
+MAX_ENUMERATED_RUNOUTS = 5000
+N_SAMPLED_RUNOUTS = 1000
+
+_combinations_cache = {}
+
+
+def _combinations(n, k):
+    if (n, k) not in _combinations_cache:
+        _combinations_cache[(n, k)] = np.array(list(combinations(range(n), k)), dtype=np.int64).reshape(-1, k)
+    return _combinations_cache[(n, k)]
+
+
+def n_runouts(n_board_cards):
+    """number of runouts of the board once n_board_cards are known (and the 2 hands)"""
+    return comb(N_CARDS - 4 - n_board_cards, 5 - n_board_cards)
+
+
+def runouts(known, n_board_cards, n_samples=N_SAMPLED_RUNOUTS, max_enumerated=MAX_ENUMERATED_RUNOUTS, rng=None):
+    """
+    :param known: indexes of the known cards (the hands and the board)
+    :return: array n x (5 - n_board_cards) of the card indexes of the runouts (all of them, or n_samples of them,
+             uniformly, if there are more than max_enumerated)
+    """
+    remaining = np.setdiff1d(np.arange(N_CARDS), known)
+    k = 5 - n_board_cards
+    if k == 0:
+        return np.zeros((1, 0), dtype=np.int64)
+    if n_runouts(n_board_cards) <= max_enumerated:
+        return remaining[_combinations(len(remaining), k)]
+    return remaining[np.argsort(get_rng(rng).random((n_samples, len(remaining))), axis=1)[:, :k]]
+
+
+def all_in_equity(hand_0, hand_1, board, n_samples=N_SAMPLED_RUNOUTS, max_enumerated=MAX_ENUMERATED_RUNOUTS,
+                  rng=None):
+    """
+    :param hand_0: the 2 cards (Card objects) of player 0
+    :param hand_1: the 2 cards of player 1
+    :param board: the 0, 3 or 4 cards of the board
+    :return: array [probability that player 0 wins, probability that player 1 wins, probability of a split]
+    """
+    known = np.array([card_index(c) for c in list(hand_0) + list(hand_1) + list(board)], dtype=np.int64)
+    boards = runouts(known, len(board), n_samples, max_enumerated, rng)
+    boards = np.concatenate([np.tile(known[4:], (len(boards), 1)), boards], axis=1)
+    hands_0 = np.concatenate([np.tile(known[:2], (len(boards), 1)), boards], axis=1)
+    hands_1 = np.concatenate([np.tile(known[2:4], (len(boards), 1)), boards], axis=1)
+    scores_0 = evaluate_hands_batch(hands_0 // 4 + 1, hands_0 % 4)
+    scores_1 = evaluate_hands_batch(hands_1 // 4 + 1, hands_1 % 4)
+    return np.array([(scores_0 > scores_1).mean(), (scores_1 > scores_0).mean(), (scores_0 == scores_1).mean()])
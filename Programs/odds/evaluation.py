@@ -1,4 +1,5 @@
 from collections import Counter
+import numpy as np
 
 
 def cn(value):
@@ -165,4 +166,78 @@ names = {1: 'deuce',
 
 
 def compare_hands(players):
-    return int(evaluate_hand(players[1].cards) > evaluate_hand(players[0].cards))
\ No newline at end of file
+    return int(evaluate_hand(players[1].cards) > evaluate_hand(players[0].cards))
+
+# base of the encoding of the tie breaks in `evaluate_hands_batch` (values are in 1..13)
+TIE_BREAK_BASE = 14
+
+
+def evaluate_hands_batch(values, suits):
+    """
+    Vectorized version of `evaluate_hand` for 7-card hands (2 cards in hand and 5 on the board), quirks included
+    (no wheel straight, a flush needs exactly 5 cards of a suit, ...).
+    Comparing the scores of two hands gives the same result as comparing their hand values, then their tie breaks
+    (see Simulator._showdown)
+    :param values: array N x 7 of the values of the cards (1 for deuce to 13 for ace, see Card.value)
+    :param suits: array N x 7 of the indexes of the suits of the cards (0 to 3)
+    :return: array of N scores (int64). A greater score is a better hand, and equal scores are a split
+    """
+    values = np.asarray(values, dtype=np.int64)
+    suits = np.asarray(suits, dtype=np.int64)
+    n = len(values)
+    rows = np.arange(n)
+
+    counts = np.zeros((n, 14), dtype=np.int64)
+    np.add.at(counts, (rows[:, None], values), 1)
+    card_counts = counts[rows[:, None], values]
+    n_pairs = (counts == 2).sum(1)
+    n_trips = (counts == 3).sum(1)
+    n_quads = (counts == 4).sum(1)
+
+    # cards belonging to multiples (`winning_cards`) and the remaining ones, sorted in decreasing order
+    winning_cards = -np.sort(-np.where(card_counts > 1, values, 0), axis=1)
+    singles = -np.sort(-np.where(card_counts == 1, values, 0), axis=1)
+    highest_trip = np.where(counts == 3, np.arange(14), 0).max(1)
+
+    # straights (the ace is never low), the highest one wins
+    present = counts[:, 1:] > 0
+    straight = np.zeros(n, dtype=np.int64)
+    for low in range(1, 10):
+        straight = np.where(present[:, low - 1:low + 4].all(1), low + 4, straight)
+    straight_cards = straight[:, None] - np.arange(5)
+
+    # flush: exactly 5 cards of the same suit
+    suit_counts = np.zeros((n, 4), dtype=np.int64)
+    np.add.at(suit_counts, (rows[:, None], suits), 1)
+    flush = (suit_counts == 5).any(1)
+    flush_suit = suit_counts.argmax(1)
+    flush_cards = -np.sort(-np.where(suits == flush_suit[:, None], values, 0), axis=1)[:, :5]
+
+    def pad(cards):
+        return np.concatenate([cards, np.zeros((n, 5 - cards.shape[1]), dtype=np.int64)], axis=1)
+
+    no_cards = np.zeros((n, 5), dtype=np.int64)
+    hand_value = np.zeros(n, dtype=np.int64)
+    tie_break = no_cards
+    # same order as evaluate_hand: the last matching category wins
+    categories = [
+        (n_pairs == 1, 100 + winning_cards[:, :2].sum(1), pad(singles[:, :3])),
+        (n_pairs > 1, 200 + winning_cards[:, :4].sum(1), pad(singles[:, :1])),
+        (n_trips == 1, 300 + winning_cards[:, :3].sum(1), pad(singles[:, :2])),
+        (straight > 0, 400 + straight, straight_cards),
+        (flush, 500 + flush_cards[:, 0], flush_cards),
+        ((n_trips == 1) & (n_pairs >= 1), 600 + winning_cards[:, :3].sum(1), no_cards),
+        (n_trips == 2, 600 + 3 * highest_trip, no_cards),
+        (n_quads > 0, 700 + winning_cards[:, :4].sum(1), pad(singles[:, :1])),
+        ((straight >= 1) & (straight < 9) & flush, 800 + straight, None),
+    ]
+    for is_category, category_value, category_tie_break in categories:
+        hand_value = np.where(is_category, category_value, hand_value)
+        if category_tie_break is not None:
+            tie_break = np.where(is_category[:, None], category_tie_break, tie_break)
+    high_card = hand_value == 0
+    hand_value = np.where(high_card, singles[:, 0], hand_value)
+    tie_break = np.where(high_card[:, None], pad(singles[:, :4]), tie_break)
+
+    weights = TIE_BREAK_BASE ** np.arange(4, -1, -1)
+    return hand_value * TIE_BREAK_BASE ** 5 + (tie_break * weights).sum(1)
@@ -8,19 +8,25 @@
 '''COMMANDS TO RUN
 Small Test : python perf_eval_experiments.py -ng 100 -ls 256 -bs_rl 32 -bfs_rl 128 -bs_sl 32 -bfs_sl 256 -np 16
 Actual Test : python perf_eval_experiments.py -s1 NFSP -s2 Mirror -ng 100000 -ep1 1 -g 1 -bs_rl 512 -bs_sl 1024 -bfs_rl 262144 -np 2048 -bfs_sl 262144 -ls 1024 -eps 0.3 -lrnf 64 -lr_rl 0.01 -lr_sl 0.001 -gc 7.0 -lf 250
+Throughput : python perf_eval_experiments.py -bm -nep 2000 -s1 NFSP -s2 NFSP -bfs_rl 16384 -np 128 -bfs_sl 16384 -lrnf 1
 
 '''
 
 import pickle
 import evaluation.expt_utils as eu
+from evaluation.hand_history_analysis import analyze, format_report
 import argparse
 import game
 from game.simulator import Simulator
+from game.runtime import RuntimeConfig
+from game.metrics import MetricsWriter
 
+import atexit
 import os
 import sys
 import glob as g
-from pycrayon import CrayonClient
+import json
+import resource
 import time
 import signal
 
@@ -28,6 +34,8 @@ GAME_SCORE_HISTORY_PATH = 'data/game_score_history/'
 PLAY_HISTORY_PATH = 'data/play_history/'
 NEURAL_NETWORK_HISTORY_PATH = 'data/neural_network_history/'
 NEURAL_NETWORK_LOSS_PATH = 'data/neural_network_history/loss/'
+METRICS_PATH = 'data/metrics/'
+HAND_HISTORY_PATH = 'data/hand_history/'
 
 def load_results(path):
     with open(path, 'rb') as f:
@@ -51,6 +59,8 @@ def get_arg_parser():
     parser.add_argument('-ss', '--skip_simulation', action='store_true',
                         dest='skip_simulation', help='show only the latest results without simulation')
     parser.set_defaults(skip_simulation=False)
+    parser.add_argument('-an', '--analyze', default=None, type=str, dest='analyze',
+                        help='show the results of this hand history without simulation')
     parser.add_argument('-en', '--experiment_name', default='', type=str, help="name to be displayed in tensorboard", dest="experiment_name")
     # game/experiment
     parser.add_argument('-ng', '--num_games', default=10000, type=int, dest='num_games',
@@ -85,6 +95,8 @@ def get_arg_parser():
                         dest='learning_rate_sl', help='learning rate for memory sl')
     parser.add_argument('-tf', '--target_Q_update_freq', default=100, type=int,
                         dest='target_Q_update_freq', help='update target Q every X number of episodes')
+    parser.add_argument('-tau', '--target_Q_tau', default=None, type=float, dest='target_Q_tau',
+                        help='soft update of target Q after each learning step with this weight (replaces the periodic update)')
     parser.add_argument('-ep1', '--eta_p1', default=0.1, type=float, dest='eta_p1',
                         help='eta for player 1')
     parser.add_argument('-ep2', '--eta_p2', default=0.1, type=float, dest='eta_p2',
@@ -98,6 +110,35 @@ def get_arg_parser():
     # default is eery episode
     parser.add_argument('-lrnf', '--learning_frequency', default=1, type=int, dest='learning_freq',
                         help='performing backprop every how many episodes')
+    parser.add_argument('-crayon', '--crayon', action='store_true', dest='crayon',
+                        help='send the metrics to a Crayon server (see -tbhn and -tbp) instead of writing them locally')
+    parser.add_argument('-mp', '--metrics_path', default=METRICS_PATH, type=str, dest='metrics_path',
+                        help='directory of the local metrics (see game.metrics)')
+    parser.add_argument('-nhh', '--no_hand_history', action='store_true', dest='no_hand_history',
+                        help='do not record the hand history of the episodes (see game.hand_history)')
+    parser.add_argument('-hhp', '--hand_history_path', default=HAND_HISTORY_PATH, type=str, dest='hand_history_path',
+                        help='directory of the hand histories')
+    # checkpoints
+    parser.add_argument('-ckpt', '--checkpoint_path', default=None, type=str, dest='checkpoint_path',
+                        help='directory of the checkpoints of the training state. The run resumes from the latest one '
+                             '(exactly as if it was not stopped only without prefetching, see -pf)')
+    parser.add_argument('-ckpt_f', '--checkpoint_freq', default=10000, type=int, dest='checkpoint_freq',
+                        help='checkpoint every X episodes')
+    parser.add_argument('-ckpt_sync', '--checkpoint_sync', action='store_true', dest='checkpoint_sync',
+                        help='write the checkpoints in the game loop instead of a background thread')
+    parser.add_argument('-ckpt_mem', '--checkpoint_memories', action='store_true', dest='checkpoint_memories',
+                        help='include the replay memories in the checkpoints')
+    parser.add_argument('-nr', '--no_resume', action='store_true', dest='no_resume',
+                        help='do not resume from the latest checkpoint')
+    parser.add_argument('-ef', '--evaluation_freq', default=0, type=int, dest='evaluation_freq',
+                        help='evaluate snapshots of the networks against the baselines every N episodes, in a '
+                             'separate process (0: never)')
+    parser.add_argument('-eh', '--evaluation_hands', default=2000, type=int, dest='evaluation_hands',
+                        help='number of hands of each evaluation against each baseline')
+    parser.add_argument('-xs', '--exploitability_stack', default=None, type=int, dest='exploitability_stack',
+                        help='also measure the exploitability of pi on the preflop game with stacks of N chips')
+    parser.add_argument('-sf', '--statistics_freq', default=1000, type=int, dest='statistics_freq',
+                        help='log the summaries of the sampled actions, rewards and hand strengths every X episodes')
     parser.add_argument('-tbhn', '--tensorboard_hostname', default='http://192.168.99.100',
                         type=str, dest='tb_hostname', help='hostname for tensorboard')
     parser.add_argument('-tbp', '--tensorboard_port', default='8889', type=str, dest='tb_port',
@@ -111,9 +152,49 @@ def get_arg_parser():
     parser.add_argument('-el', '--use_entropy_loss', action='store_true', dest='use_entropy_loss',
                         help='use entropy loss for exploration')
     parser.set_defaults(use_entropy_loss=False)
+    # runtime (CPU thread pools)
+    parser.add_argument('-nta', '--num_threads_act', default=1, type=int, dest='num_threads_act',
+                        help='number of torch threads used to choose actions (forward passes on a single state)')
+    parser.add_argument('-ntl', '--num_threads_learn', default=None, type=int, dest='num_threads_learn',
+                        help='number of torch threads used for learning (default: torch default)')
+    parser.add_argument('-nti', '--num_interop_threads', default=None, type=int, dest='num_interop_threads',
+                        help='number of torch inter-op threads (default: torch default)')
+    parser.add_argument('-pf', '--prefetch_batches', default=0, type=int, dest='prefetch_batches',
+                        help='number of replay minibatches prepared in a background thread (0: sample synchronously)')
+    parser.add_argument('-upl', '--updates_per_learn', default=1, type=int, dest='updates_per_learn',
+                        help='number of gradient steps of each network per learning call')
+    parser.add_argument('-flat', '--flat_parameters', action='store_true', dest='flat_parameters',
+                        help='store the weights of Q and pi of each player in one contiguous buffer')
+    parser.add_argument('-fb', '--fast_baselines', action='store_true', dest='fast_baselines',
+                        help='play the games between two baselines with the fast engine (game.fast_engine)')
+    parser.add_argument('-eq', '--all_in_equity', action='store_true', dest='all_in_equity',
+                        help='when both players are all in, use the expected rewards over the runouts of the board')
+    parser.add_argument('-prof', '--profile', action='store_true', dest='profile',
+                        help='report the time spent in each phase of the episodes with the throughput')
+    parser.add_argument('-prof_path', '--profile_path', default=None, type=str, dest='profile_path',
+                        help='append the profiling records to this file (JSON lines)')
+    # throughput benchmark
+    parser.add_argument('-bm', '--benchmark', action='store_true', dest='benchmark',
+                        help='play a fixed number of episodes without logging and report the throughput')
+    parser.add_argument('-nep', '--num_episodes', default=2000, type=int, dest='num_episodes',
+                        help='number of episodes of the benchmark')
+    parser.add_argument('-bm_path', '--benchmark_path', default=None, type=str, dest='benchmark_path',
+                        help='append the benchmark report to this file (JSON lines)')
+    parser.add_argument('-seed', '--seed', default=None, type=int, dest='seed',
+                        help='seed of all the random generators of the run (default: drawn, and printed)')
+    parser.add_argument('-rf', '--report_freq', default=1000, type=int, dest='report_freq',
+                        help='report the achieved steps/sec every X episodes (0 to disable)')
     return parser
 
+def latest_hand_history(path):
+    # the directories start with the time of the run
+    runs = sorted(d for d in os.listdir(path) if os.path.isdir(os.path.join(path, d)))
+    if len(runs) == 0:
+        raise Exception('no hand history in {}'.format(path))
+    return os.path.join(path, runs[-1])
+
 def setup_tensorboard(exp_id, cur_t, hostname, port):
+    from pycrayon import CrayonClient
     exp_filename = '{}_{}'.format(cur_t, exp_id)
     tb = CrayonClient(hostname=hostname, port=port)
     try:
@@ -124,18 +205,65 @@ def setup_tensorboard(exp_id, cur_t, hostname, port):
         tb_experiment = tb.create_experiment(exp_filename)
     return tb_experiment, tb
 
+def setup_metrics_writer(exp_id, cur_t, path):
+    writer = MetricsWriter(os.path.join(path, '{}_{}'.format(cur_t, exp_id)))
+    # write the points still in memory
+    atexit.register(writer.close)
+    return writer
+
 def remove_all_experiments(hostname, port):
     '''
     DANGER: don't use this, unless you're sure
     '''
+    from pycrayon import CrayonClient
     tb = CrayonClient(hostname=hostname, port=port)
     tb.remove_all_experiments()
 
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+def run_benchmark(simulator, num_episodes):
+    '''
+    play num_episodes episodes
+    :return: the report {'episodes', 'seconds', '<counter>_per_sec', 'peak_rss_mb', 'replay': {memory: {'size', 'mb'}}}
+    '''
+    counts = dict(simulator.runtime.counts)
+    start = time.perf_counter()
+    simulator.start(term_episode_count=simulator.games['#episodes'] + num_episodes)
+    seconds = time.perf_counter() - start
+    report = {'episodes': simulator.runtime.counts['episodes'] - counts['episodes'], 'seconds': seconds}
+    for k, v in simulator.runtime.counts.items():
+        report['{}_per_sec'.format(k)] = (v - counts[k]) / seconds
+    report['peak_rss_mb'] = peak_rss_mb()
+    report['replay'] = {}
+    for p in simulator.players:
+        if p.player_type == 'nfsp':
+            for memory in [p.memory_rl, p.memory_sl]:
+                report['replay']['p{}_{}'.format(p.id, memory.target)] = {'size': memory.size,
+                                                                          'mb': memory.nbytes / 2 ** 20}
+    return report
+
+def format_benchmark(report):
+    lines = ['{} episodes in {:.1f}s'.format(report['episodes'], report['seconds']),
+             'episodes/sec: {episodes_per_sec:.1f} decisions/sec: {decisions_per_sec:.1f} '
+             'updates/sec: {updates_per_sec:.1f}'.format(**report),
+             'peak RSS: {:.1f} MB'.format(report['peak_rss_mb'])]
+    for name, memory in sorted(report['replay'].items()):
+        lines.append('replay {}: {} experiences, {:.1f} MB'.format(name, memory['size'], memory['mb']))
+    return '\n'.join(lines)
+
 def setup_kill_signal_handler(simulator):
     main_process_pid = os.getpid()
 
     def signal_handler(signal, frame):
         if os.getpid() == main_process_pid:
+            if simulator.checkpointer is not None and not simulator.stop_requested:
+                # the episode being played is finished, then checkpointed (see the end of the main)
+                print('Signal ' + str(signal) + ' detected, stopping after this episode.')
+                simulator.request_stop()
+                return
             print('Signal ' + str(signal) + ' detected, saving things.')
             simulator.save_history_results('_final')
             print('Saving completed, shutting down...')
@@ -155,6 +283,11 @@ if __name__ == '__main__':
     change the defaults above, if you don't want to pass flags
     '''
     args = get_arg_parser().parse_args()
+    if args.skip_simulation or args.analyze is not None:
+        path = args.analyze if args.analyze is not None else latest_hand_history(args.hand_history_path)
+        print(path)
+        print(format_report(analyze(path, window=args.mov_avg_window)))
+        sys.exit(0)
     cuda = args.cuda
     verbose = args.verbose
     log_freq = args.log_freq
@@ -193,6 +326,16 @@ if __name__ == '__main__':
     if load_model_p2 and strategy_p2 != 'NFSP':
         raise Exception('if you want to load a model for p2, strategy type should be NFSP')
     no_tensorboard = args.no_tensorboard
+    runtime_config = RuntimeConfig(num_threads_act=args.num_threads_act,
+                                   num_threads_learn=args.num_threads_learn,
+                                   num_interop_threads=args.num_interop_threads,
+                                   report_freq=args.report_freq)
+    if args.benchmark:
+        # comparable runs: same seed, nothing sent or written during the run
+        if args.seed is None:
+            args.seed = 0
+        no_tensorboard = True
+        args.no_hand_history = True
     experiment_name = ''
     print('running tests with the following setup')
     for k, v in vars(args).items():
@@ -200,12 +343,21 @@ if __name__ == '__main__':
         experiment_name += '{}:{}_'.format(k, v)
     experiment_id = '{}vs{}_{}'.format(strategy_p1, strategy_p2, hash(experiment_name)).lower()
     cur_t = time.strftime('%y%m%d_%H%M%S', time.gmtime())
-    with open('data/experiment_log.txt', 'a') as f:
-        f.write('{}\n{}\n'.format(experiment_id, experiment_name, cur_t))
+    if not args.benchmark:
+        with open('data/experiment_log.txt', 'a') as f:
+            f.write('{}\n{}\n'.format(experiment_id, experiment_name, cur_t))
     if no_tensorboard:
         tb_experiment=None
-    else:
+    elif args.crayon:
         tb_experiment, _ = setup_tensorboard(experiment_id, cur_t, tb_hostname, tb_port)
+    else:
+        tb_experiment = setup_metrics_writer(experiment_id, cur_t, args.metrics_path)
+        print('metrics written to {}'.format(tb_experiment.path))
+    if args.no_hand_history:
+        hand_history_path = None
+    else:
+        hand_history_path = os.path.join(args.hand_history_path, '{}_{}'.format(cur_t, experiment_id))
+        print('hand history written to {}'.format(hand_history_path))
 
     results_dict = {}
     # sometimes we want to skip simulation and view only the latest simulation results
@@ -247,7 +399,43 @@ if __name__ == '__main__':
                           log_freq=log_freq,
                           tensorboard=tb_experiment,
                           load_model_p1=load_model_p1,
-                          load_model_p2=load_model_p2)
+                          load_model_p2=load_model_p2,
+                          runtime_config=runtime_config,
+                          prefetch_batches=args.prefetch_batches,
+                          updates_per_learn=args.updates_per_learn,
+                          target_Q_tau=args.target_Q_tau,
+                          flat_parameters=args.flat_parameters,
+                          fast_baselines=args.fast_baselines,
+                          all_in_equity=args.all_in_equity,
+                          profile=args.profile,
+                          profile_path=args.profile_path,
+                          statistics_freq=args.statistics_freq,
+                          hand_history_path=hand_history_path,
+                          checkpoint_path=args.checkpoint_path,
+                          checkpoint_freq=args.checkpoint_freq,
+                          checkpoint_background=not args.checkpoint_sync,
+                          checkpoint_memories=args.checkpoint_memories,
+                          resume=not args.no_resume,
+                          evaluation_freq=args.evaluation_freq,
+                          evaluation_hands=args.evaluation_hands,
+                          exploitability_stack=args.exploitability_stack,
+                          seed=args.seed)
+    print('seed: {}'.format(simulator.seed))
+
+    if args.benchmark:
+        report = run_benchmark(simulator, args.num_episodes)
+        report['args'] = vars(args)
+        print(format_benchmark(report))
+        if args.benchmark_path is not None:
+            with open(args.benchmark_path, 'a') as f:
+                f.write(json.dumps(report) + '\n')
+        simulator.close()
+        sys.exit(0)
 
     setup_kill_signal_handler(simulator)
     simulator.start(num_games)
+    if simulator.checkpointer is not None:
+        print('checkpoint written to {}'.format(simulator.checkpoint()))
+    if simulator.stop_requested:
+        simulator.save_history_results('_final')
+    simulator.close()
@@ -5,17 +5,24 @@ from timeit import default_timer as timer
 import time
 
 from experience_replay.experience_replay import ReplayBufferManager
-from game.game_utils import Action, bucket_encode_actions
-from game.utils import variable
+from experience_replay.prefetch import ReplayPrefetcher
+from game.game_utils import Action, unpack_action_masks
+from game.utils import variable, masked_max
 from game.state import build_state, create_state_variable_batch, create_state_vars_batch
 from game.action import create_action_variable_batch
 from game.reward import create_reward_variable_batch
 from game.config import BLINDS
+from game.rng import get_rng
+from game.profiling import NULL_PROFILER
+from game.statistics import NULL_STATISTICS, Histogram
+from constant import NUM_ACTIONS
 
 # define some utility functions
 create_state_var = create_state_variable_batch()
 create_action_var = create_action_variable_batch()
 create_reward_var = create_reward_variable_batch()
+# one bin per action bucket (see bucket_to_action)
+ACTION_BUCKET_EDGES = Histogram.integers(-1, NUM_ACTIONS - 2).edges
 
 
 # define RL hyperparameters here
@@ -25,8 +32,15 @@ class Player:
     '''
     default player bot
     '''
+    # times the learning steps (see game.profiling)
+    profiler = NULL_PROFILER
+    # aggregates the sampled actions and rewards (see game.statistics)
+    statistics = NULL_STATISTICS
 
-    def __init__(self, pid, strategy, stack, name=None, verbose=False):
+    def __init__(self, pid, strategy, stack, name=None, verbose=False, rng=None):
+        """
+        :param rng: numpy Generator of the random decisions of the strategy (see game.rng)
+        """
         self.id = pid
         self.cards = []
         self.stack = stack
@@ -39,12 +53,20 @@ class Player:
         self.side_pot = 0
         self.contribution_in_this_pot = 0
         self.player_type = 'default'
+        self.rng = get_rng(rng)
+        # state of the betting round when the player plays (see game.betting), None if the engine doesn't track it
+        self.betting_state = None
 
     def cash(self, v):
         self.side_pot = 0
         self.stack = v
 
-    def play(self, board, pot, actions, b_round, opponent_stack, opponent_side_pot, blinds, episode_idx):
+    def play(self, board, pot, actions, b_round, opponent_stack, opponent_side_pot, blinds, episode_idx,
+             betting_state=None):
+        """
+        :param betting_state: the state of the betting round (see game.betting), if the engine tracks it
+        """
+        self.betting_state = betting_state
         # if you are all in you cannot do anything
         if self.is_all_in:
             if self.verbose:
@@ -81,6 +103,25 @@ class Player:
         return name + '\n' + addon + (' '.join([str(c) for c in self.cards]))
 
 
+def split_minibatches(batch, n):
+    '''
+    split a batch of n minibatches stacked one after the other (see ReplayBufferManager.sample)
+    :param batch: dict of variables, arrays, lists or lists of variables (the state components)
+    :return: a list of n dicts with the same keys
+    '''
+    if n == 1:
+        return [batch]
+    size = len(batch['action_idxs']) // n
+
+    def _slice(v, i):
+        if isinstance(v, list) and len(v) > 0 and not np.isscalar(v[0]):
+            # list of state components
+            return [_slice(c, i) for c in v]
+        return v[i * size:(i + 1) * size]
+
+    return [{k: _slice(v, i) for k, v in batch.items()} for i in range(n)]
+
+
 class NeuralFictitiousPlayer(Player):
     '''
     NFSP
@@ -98,10 +139,22 @@ class NeuralFictitiousPlayer(Player):
                  memory_sl_config={},
                  tensorboard=None,
                  is_training=True,
+                 prefetch_batches=0,
+                 updates_per_learn=1,
+                 flat_parameters=None,
+                 rng_streams=None,
                  verbose=False,
                  cuda=False):
+        """
+        :param prefetch_batches: number of minibatches of each memory prepared in the background (0: sample synchronously)
+        :param updates_per_learn: number of gradient steps of each network per learning call. The minibatches they use
+        are sampled (and converted to variables) together
+        :param flat_parameters: FlatParameters holding the weights of Q and pi. Its version is bumped when they are
+        updated, for the copies of the networks (see WeightBroadcaster) to know when to pull them
+        :param rng_streams: RNGStreams giving the generators of the player and of its memories (see game.rng)
+        """
         # we may not need this inheritance
-        super().__init__(pid, strategy, stack)
+        super().__init__(pid, strategy, stack, rng=rng_streams.actor(pid) if rng_streams is not None else None)
         self.cuda = cuda
         self.verbose = verbose
 
@@ -120,59 +173,99 @@ class NeuralFictitiousPlayer(Player):
         self.player_type = 'nfsp'
         self.strategy = strategy
         self.is_Q_used = False
+        self.legal_mask = None
         self.is_training = is_training
         self.gamma = gamma
         self.target_update = target_Q_update_freq
         self.learning_freq = learning_freq
+        self.updates_per_learn = updates_per_learn
+        self.flat_parameters = flat_parameters
         self.tensorboard = tensorboard
 
         # logically they should fall under each player
         # so we can do player.model.Q, player.model.pi
         # experience replay
         self.learn_start = learn_start
-        self.memory_rl = ReplayBufferManager(target='rl', config=memory_rl_config, learn_start=learn_start)
-        self.memory_sl = ReplayBufferManager(target='sl', config=memory_sl_config, learn_start=learn_start)
+        self.memory_rl = ReplayBufferManager(target='rl', config=memory_rl_config, learn_start=learn_start,
+                                             rng=rng_streams.buffer(pid, 'rl') if rng_streams is not None else None)
+        self.memory_sl = ReplayBufferManager(target='sl', config=memory_sl_config, learn_start=learn_start,
+                                             rng=rng_streams.buffer(pid, 'sl') if rng_streams is not None else None)
+
+        # minibatches sampled and converted in the background
+        self.prefetcher_rl = None
+        self.prefetcher_sl = None
+        if prefetch_batches > 0 and is_training:
+            self.prefetcher_rl = ReplayPrefetcher(self.memory_rl, prefetch_batches,
+                                                  is_ready=lambda: self._is_ready_to_learn_RL(None),
+                                                  transform=self._rl_batch_to_variables,
+                                                  minibatches_per_sample=updates_per_learn)
+            self.prefetcher_sl = ReplayPrefetcher(self.memory_sl, prefetch_batches,
+                                                  is_ready=lambda: self._is_ready_to_learn_SL(None),
+                                                  transform=self._sl_batch_to_variables,
+                                                  minibatches_per_sample=updates_per_learn)
 
     def play(self, board, pot, actions, b_round, opponent_stack, opponent_side_pot, blinds,
-             episode_idx):
+             episode_idx, state=None, betting_state=None):
         """
         TODO: check the output action dimension
+        :param state: the state of the player (see build_state) if it is already known
+        :param betting_state: the state of the betting round (see game.betting), if the engine tracks it
         """
+        self.betting_state = betting_state
         action, self.is_Q_used = self.strategy.choose_action(self, board, pot,
                                                              actions, b_round,
                                                              opponent_stack, opponent_side_pot,
-                                                             blinds, episode_idx, for_play=True)
-
+                                                             blinds, episode_idx, for_play=True, state=state)
+        # authorized actions when the decision was taken (stored with the experience)
+        self.legal_mask = self.strategy.legal_mask
         return action
 
     def learn(self, global_step, episode_idx, is_training=True):
         """
         NSFP algorithm: learn on batch
         TODO: add a second player with Q and PI
+        :return: the number of minibatch updates performed
         """
         if self.verbose:
             print('global step', global_step)
             print('Record Size of M_RL', self.memory_rl._buffer.record_size)
             print('Record Size of M_SL', self.memory_sl._buffer.record_size)
 
+        n_updates = 0
         if episode_idx % self.learning_freq == 0:
             # learn only every X number of episodes
             # episode_i increments one by one
             if self._is_ready_to_learn_RL(global_step):
-                self._learn_rl(global_step)
+                with self.profiler.phase('rl'):
+                    self._learn_rl(global_step)
+                n_updates += self.updates_per_learn * int(self.is_training)
 
             if self._is_ready_to_learn_SL(global_step):
-                self._learn_sl(global_step)
+                with self.profiler.phase('sl'):
+                    self._learn_sl(global_step)
+                n_updates += self.updates_per_learn * int(self.is_training)
 
         record_size_rl = self.memory_rl._buffer.record_size
         record_size_sl = self.memory_sl._buffer.record_size
         msg = 'pid: {} record size for RL:{} should be larger than SL: {}'.format(self.id, record_size_rl, record_size_sl)
         # assert (record_size_rl + 1) >= record_size_sl, msg
 
-        if episode_idx % self.target_update == 0:
+        if n_updates > 0 and self.flat_parameters is not None:
+            self.flat_parameters.bump()
+
+        # with soft updates, the target network follows Q after each learning step instead
+        if self.strategy.target_Q_tau is None and episode_idx % self.target_update == 0:
             if self.verbose:
                 print('sync target network periodically')
             self.strategy.sync_target_network()
+        return n_updates
+
+    @property
+    def replay_ratios(self):
+        """
+        average number of times each transition stored in M_RL and M_SL has been sampled so far
+        """
+        return {'rl': self.memory_rl.replay_ratio, 'sl': self.memory_sl.replay_ratio}
 
     def _is_ready_to_learn_RL(self, global_step):
         record_size = self.memory_rl._buffer.record_size
@@ -188,62 +281,111 @@ class NeuralFictitiousPlayer(Player):
         # sample a minibatch of experiences
         # gamma = Variable(t.Tensor([self.gamma]).float(), requires_grad=False)
         gamma = variable([self.gamma], cuda=self.cuda)
-        exps, imp_weights, ids = self.memory_rl.sample(global_step)
-        # how many of the samples in a batch are showdowns or all-ins
-        state_vars = [variable(s, cuda=self.cuda) for s in exps[0]]
-        action_vars = variable(exps[1], cuda=self.cuda)
-        imp_weights = variable(imp_weights, cuda=self.cuda)
-        rewards = variable(exps[2].astype(np.float32), cuda=self.cuda)
-        next_state_vars = [variable(s, cuda=self.cuda) for s in exps[3]]
-       # state_hashes = exps[5]
-
-        if self.verbose and self.tensorboard is not None:
-            actions = bucket_encode_actions(action_vars, cuda=self.cuda)
-            for a in actions.data.cpu().numpy():
-                self.tensorboard.add_scalar_value('M_RL_sampled_actions', int(a), time.time())
-            for r in exps[2]:
-                self.tensorboard.add_scalar_value('M_RL_sampled_rewards', int(r), time.time())
+        if self.prefetcher_rl is not None:
+            with self.profiler.phase('prefetch_wait'):
+                batch = self.prefetcher_rl.get(global_step)
+        else:
+            sample = self.memory_rl.sample(global_step, n_batches=self.updates_per_learn)
+            with self.profiler.phase('to_variables'):
+                batch = self._rl_batch_to_variables(sample)
+
+        if self.verbose:
+            self.statistics.histogram('M_RL_sampled_actions', batch['action_idxs'] - 1, ACTION_BUCKET_EDGES)
+            self.statistics.moments('M_RL_sampled_rewards', batch['rewards'])
 #            for h in state_hashes:
 #                self.tensorboard.add_scalar_value('M_RL_sampled_states', int(h), time.time())
 
 
         if self.is_training:
-            Q_targets = rewards + gamma * t.max(self.strategy._target_Q.forward(*next_state_vars), 1)[0]
-
-            if self.verbose:
-                start = timer()
-            td_deltas = self.strategy._Q.learn(state_vars, action_vars, Q_targets, imp_weights)
-            if self.verbose:
-                print('backward pass of Q network took ', timer() - start)
-            self.memory_rl.update(ids, td_deltas.data.cpu().numpy())
+            for minibatch in split_minibatches(batch, self.updates_per_learn):
+                # the max is taken over the actions authorized in the next state only (and is 0 for terminal states)
+                with self.profiler.phase('target'):
+                    next_Q_values = self.strategy._target_Q.forward(*minibatch['next_state_vars'])
+                    Q_targets = minibatch['reward_vars'] + gamma * masked_max(next_Q_values, minibatch['next_legal_mask_vars'])
+
+                if self.verbose:
+                    start = timer()
+                td_deltas = self.strategy._Q.learn(minibatch['state_vars'], minibatch['action_idx_vars'], Q_targets,
+                                                   minibatch['imp_weight_vars'])
+                if self.verbose:
+                    print('backward pass of Q network took ', timer() - start)
+                with self.profiler.phase('target_update'):
+                    self.strategy.update_target_network()
+                with self.profiler.phase('priority_update'):
+                    if self.prefetcher_rl is not None:
+                        # applied in the background
+                        self.prefetcher_rl.update(minibatch['ids'], td_deltas.data.cpu().numpy())
+                    else:
+                        self.memory_rl.update(minibatch['ids'], td_deltas.data.cpu().numpy())
+
+    def _rl_batch_to_variables(self, sample):
+        """
+        convert a minibatch sampled from M_RL to variables
+        (it may run in the background thread of the prefetcher)
+        """
+        exps, imp_weights, ids = sample
+        return {'state_vars': [variable(s, cuda=self.cuda) for s in exps[0]],
+                # indexes of the actions in the outputs of Q (bucket + 1), computed when the experiences were stored
+                'action_idx_vars': variable(exps[5], to_float=False, cuda=self.cuda),
+                'imp_weight_vars': variable(imp_weights, cuda=self.cuda),
+                'reward_vars': variable(exps[2].astype(np.float32), cuda=self.cuda),
+                'next_state_vars': [variable(s, cuda=self.cuda) for s in exps[3]],
+                'next_legal_mask_vars': variable(unpack_action_masks(exps[6]).astype(np.float32), cuda=self.cuda),
+                'action_idxs': exps[5],
+                'rewards': exps[2],
+                'ids': ids}
 
     def _learn_sl(self, global_step):
         """
         reservoir sampling from M_sl
         """
         if self.is_training:
-            exps = self.memory_sl.sample(global_step)
-            state_vars = [variable(s, cuda=self.cuda) for s in exps[0]]
-            # 4 x 11 each column is torch variable
-            action_vars = variable(exps[1], cuda=self.cuda)
-            #state_hashes = exps[2]
-            if self.verbose and self.tensorboard is not None:
-                actions= bucket_encode_actions(action_vars, cuda=self.cuda)
-                for a in actions.data.cpu().numpy():
-                    self.tensorboard.add_scalar_value('M_SL_sampled_actions', int(a), time.time())
+            if self.prefetcher_sl is not None:
+                with self.profiler.phase('prefetch_wait'):
+                    batch = self.prefetcher_sl.get(global_step)
+            else:
+                sample = self.memory_sl.sample(global_step, n_batches=self.updates_per_learn)
+                with self.profiler.phase('to_variables'):
+                    batch = self._sl_batch_to_variables(sample)
+            if self.verbose:
+                self.statistics.histogram('M_SL_sampled_actions', batch['action_idxs'] - 1, ACTION_BUCKET_EDGES)
 #                for h in state_hashes:
 #                    self.tensorboard.add_scalar_value('M_SL_sampled_states', int(h), time.time())
 
-            if self.verbose:
-                start = timer()
-            self.strategy._pi.learn(state_vars, action_vars)
-            if self.verbose:
-                print('backward pass of pi network took ', timer() - start)
+            for minibatch in split_minibatches(batch, self.updates_per_learn):
+                if self.verbose:
+                    start = timer()
+                self.strategy._pi.learn(minibatch['state_vars'], minibatch['action_idx_vars'])
+                if self.verbose:
+                    print('backward pass of pi network took ', timer() - start)
+
+    def _sl_batch_to_variables(self, exps):
+        """
+        convert a minibatch sampled from M_SL to variables
+        (it may run in the background thread of the prefetcher)
+        """
+        return {'state_vars': [variable(s, cuda=self.cuda) for s in exps[0]],
+                'action_idx_vars': variable(exps[2], to_float=False, cuda=self.cuda),
+                'action_idxs': exps[2]}
 
     def remember(self, exp):
         self.memory_rl.store_experience(exp)
         if self.is_Q_used and not exp['is_terminal']:
             # if action was chosen by e-greedy policy
-            # exp should be just (s,a)
-            simple_exp = (exp['s'], exp['a'])
+            # exp should be just (s,a) (and the index of a in the outputs of pi)
+            simple_exp = (exp['s'], exp['a'], exp['a_idx'])
             self.memory_sl.store_experience(simple_exp)
+        # the memories may be ready to be sampled now
+        for prefetcher in (self.prefetcher_rl, self.prefetcher_sl):
+            if prefetcher is not None:
+                prefetcher.notify()
+
+    def close(self):
+        '''
+        stop the background threads of the prefetchers (the memories are sampled synchronously afterwards)
+        '''
+        for prefetcher in (self.prefetcher_rl, self.prefetcher_sl):
+            if prefetcher is not None:
+                prefetcher.close()
+        self.prefetcher_rl = None
+        self.prefetcher_sl = None
@@ -6,10 +6,10 @@ They should all have the same signature, but don't always use all this informati
 from game.game_utils import *
 from game.state import build_state
 from game.utils import softmax, variable
+from game.rng import get_rng
+from models.target_network import TargetNetwork
 import numpy as np
-import random
 import torch as t
-import random
 from timeit import default_timer as timer
 
 TARGET_NETWORK_UPDATE_PERIOD = 300  # every 300 episodes
@@ -20,8 +20,8 @@ NUM_ACTIONS = 16
 GAMMA_VAL = 0.95
 
 
-def get_random_action(possible_actions, actions, b_round, player, opponent_side_pot):
-    random_action_bucket = np.random.choice(possible_actions)
+def get_random_action(possible_actions, actions, b_round, player, opponent_side_pot, rng=None):
+    random_action_bucket = possible_actions[get_rng(rng).integers(len(possible_actions))]
 
     random_action = bucket_to_action(random_action_bucket, actions, b_round, player, opponent_side_pot)
     return random_action
@@ -32,7 +32,7 @@ def strategy_random(player, board, pot, actions, b_round, opponent_stack, oppone
     Take decision randomly amongst any amount of raise, call , fold, all-in or check.
     """
     possible_actions = authorized_actions_buckets(player, actions, b_round, opponent_side_pot)  # you don't have right to take certain actions, e.g betting more than you have or betting 0 or checking a raise
-    return get_random_action(possible_actions, actions, b_round, player, opponent_side_pot)
+    return get_random_action(possible_actions, actions, b_round, player, opponent_side_pot, rng=player.rng)
 
 
 def strategy_mirror(player, board, pot, actions, b_round, opponent_stack, opponent_side_pot, greedy=True, blinds=BLINDS, verbose=False):
@@ -87,7 +87,8 @@ def strategy_mirror(player, board, pot, actions, b_round, opponent_stack, oppone
 
 
 def strategy_RL_aux(player, board, pot, actions, b_round, opponent_stack, opponent_side_pot, Q,
-                    greedy=True, blinds=BLINDS, verbose=False, eps=0., cuda=False, for_play=False):
+                    greedy=True, blinds=BLINDS, verbose=False, eps=0., cuda=False, for_play=False, legal_mask=None,
+                    state=None, rng=None):
     """
     Take decision using Q values (in a greedy or random way)
     :param player:
@@ -100,76 +101,102 @@ def strategy_RL_aux(player, board, pot, actions, b_round, opponent_stack, oppone
     :param greedy: True for greedy, False for Q-softmax sampling
     :param blinds:
     :param verbose:
+    :param legal_mask: mask of the authorized actions (see `legal_actions_mask`), computed if not provided
+    :param state: the state of the player (see `build_state`), built if not provided
+    :param rng: numpy Generator of the exploration (see game.rng)
     :return:
     """
-    possible_actions = authorized_actions_buckets(player, actions, b_round, opponent_side_pot)  # you don't have right to take certain actions, e.g betting more than you have or betting 0 or checking a raise
-
-    # @hack
-    # add some heuristics
-    # if check is possible
-    if 0 in possible_actions and -1 in possible_actions:
-        # one should not fold
-        del possible_actions[possible_actions.index(-1)]
+    if legal_mask is None:
+        legal_mask = legal_actions_mask(player, actions, b_round, opponent_side_pot)  # you don't have right to take certain actions, e.g betting more than you have or betting 0 or checking a raise
 
-    # @hack: remove high roller actions
-    #try:
-    #    # anything betting above 20 should be discouraged
-    #    # when initial money is only 100
-    #    high_bet_i = possible_actions.index(8)
-    #    # but allow all-in
-    #    possible_actions = possible_actions[:high_bet_i] + [possible_actions[-1]]
-    #except ValueError:
-    #    pass
-
-    state = build_state(player, board, pot, actions, opponent_stack, blinds[1], as_variable=False)
+    if state is None:
+        state = build_state(player, board, pot, actions, opponent_stack, blinds[1], as_variable=False)
     state = [variable(s, cuda=cuda) for s in state]
     state.append(for_play)
     Q_values = Q.forward(*state)[0].squeeze()  # it has multiple outputs, the first is the Qvalues
     Q_values = Q_values.data.cpu().numpy()
 
+    rng = get_rng(rng)
+    is_epsilon = (rng.random() <= eps)
+    if is_epsilon:
+        # uniformly random authorized action
+        action_idx = sample_masked_action(legal_mask, legal_mask, rng)
     # choose action in a greedy way
-    if greedy:
-        Q_values_for_possible_actions = np.array([Q_value for k, Q_value in enumerate(Q_values) if
-                                                  idx_to_bucket(k) in possible_actions])
-        ties = np.flatnonzero(Q_values_for_possible_actions == Q_values_for_possible_actions.max())
-        best_possible_action_bucket = np.random.choice(ties)
-        best_possible_action_bucket = [idx_to_bucket(k) for k, Q_value in enumerate(Q_values) if idx_to_bucket(k) in possible_actions][best_possible_action_bucket]
-        action = bucket_to_action(best_possible_action_bucket, actions, b_round, player, opponent_side_pot)
+    elif greedy:
+        action_idx = greedy_masked_action(Q_values, legal_mask, rng)
     else:
-        idx = [idx_to_bucket(k) for k, Q_value in enumerate(Q_values) if idx_to_bucket(k) in possible_actions]
-        Q_values = [Q_value for k, Q_value in enumerate(Q_values) if idx_to_bucket(k) in possible_actions]
-        probabilities = softmax(Q_values)
-        assert np.abs(np.sum(probabilities) - 1.) < 1e-6, probabilities
-        action = bucket_to_action(sample_action(idx, probabilities), actions, b_round, player, opponent_side_pot)
+        probabilities = softmax(np.where(legal_mask, Q_values, -np.inf))
+        action_idx = sample_masked_action(probabilities, legal_mask, rng)
+    return bucket_to_action(idx_to_bucket(action_idx), actions, b_round, player, opponent_side_pot)
 
-    is_epsilon = (random.random() <= eps)
-    if is_epsilon:
-        return get_random_action(possible_actions, actions, b_round, player, opponent_side_pot)
-    else:
-        return action
+
+def legal_actions_mask(player, actions, b_round, opponent_side_pot):
+    """
+    Mask of the actions the Q and pi networks can choose from (see `authorized_actions_mask`)
+    """
+    legal_mask = authorized_actions_mask(player, actions, b_round, opponent_side_pot)
+    # @hack
+    # add some heuristics
+    # if check is possible, one should not fold
+    if legal_mask[0] and legal_mask[1]:
+        legal_mask[0] = False
+    # @hack: remove high roller actions
+    # anything betting above 20 should be discouraged when initial money is only 100 (but allow all-in)
+    # legal_mask[9:-1] = False
+    return legal_mask
 
 
 def strategy_RL(Q, greedy):
     """Function generator"""
     return lambda player, board, pot, actions, b_round, opponent_stack, opponent_side_pot, blinds=BLINDS, verbose=False, eps=0: strategy_RL_aux(player, board, pot, actions, b_round, opponent_stack, opponent_side_pot, Q, greedy=greedy, blinds=blinds,
-                                                                                                                                                verbose=verbose, eps=eps)
+                                                                                                                                                verbose=verbose, eps=eps, rng=player.rng)
+
+
+def strategy_pi_aux(player, board, pot, actions, b_round, opponent_stack, opponent_side_pot, pi,
+                    blinds=BLINDS, verbose=False, cuda=False, rng=None):
+    """
+    Sample an action from the average policy pi (as StrategyNFSP does when it does not use Q)
+    :param pi: the policy network
+    :param rng: numpy Generator of the sampling (see game.rng)
+    """
+    legal_mask = legal_actions_mask(player, actions, b_round, opponent_side_pot)
+    state = build_state(player, board, pot, actions, opponent_stack, blinds[1], as_variable=False)
+    state = [variable(s, cuda=cuda) for s in state]
+    state.append(True)
+    action_probs = pi.forward(*state).squeeze()
+    action_idx = sample_masked_action(action_probs.data.cpu().numpy(), legal_mask, get_rng(rng))
+    return bucket_to_action(idx_to_bucket(action_idx), actions, b_round, player, opponent_side_pot)
+
+
+def strategy_pi(pi):
+    """Function generator"""
+    return lambda player, board, pot, actions, b_round, opponent_stack, opponent_side_pot, blinds=BLINDS, verbose=False: strategy_pi_aux(player, board, pot, actions, b_round, opponent_stack, opponent_side_pot, pi, blinds=blinds,
+                                                                                                                                          verbose=verbose, rng=player.rng)
 
 
 class StrategyNFSP():
-    def __init__(self, Q, pi, eta, eps, is_greedy=True, verbose=False, cuda=False):
+    def __init__(self, Q, pi, eta, eps, is_greedy=True, target_Q_tau=None, verbose=False, cuda=False, rng=None):
+        """
+        :param target_Q_tau: weight of Q in the soft updates of the target network after each learning step.
+        None to only synchronize it periodically (see sync_target_network)
+        :param rng: numpy Generator of the choices between Q and pi, and of the exploration (see game.rng)
+        """
         self._Q = Q
         self._pi = pi
-        self._target_Q = Q
+        self._target_Q = TargetNetwork(Q, tau=target_Q_tau)
+        self.target_Q_tau = target_Q_tau
         self.eps = eps
         self.eta = eta
         self.is_Q_used = False
         self.is_greedy = is_greedy
         self.verbose = verbose
         self.cuda = cuda
+        self.rng = get_rng(rng)
         self.is_graph_created = False
+        self.legal_mask = None
 
     def choose_action(self, player, board, pot, actions, b_round, opponent_stack, opponent_side_pot,
-                      blinds, episode_idx, for_play=False):
+                      blinds, episode_idx, for_play=False, state=None):
         # decay epsilon in the same way in the paper (NFSP, 2016)
         # we use number of episodes as n
         # the exact decay schedule was not specified but alluded to slower than sqrt
@@ -180,7 +207,10 @@ class StrategyNFSP():
             assert player.stack == 0
             return Action('null'), False
 
-        if self.eta >= np.random.rand():
+        # computed once, it is used to choose the action and it is stored in the replay memories
+        self.legal_mask = legal_actions_mask(player, actions, b_round, opponent_side_pot)
+
+        if self.eta >= self.rng.random():
             # use epsilon-greedy policy
             if self.verbose:
                 start = timer()
@@ -190,7 +220,8 @@ class StrategyNFSP():
                                      opponent_side_pot, self._Q,
                                      greedy=self.is_greedy,
                                      blinds=blinds, verbose=self.verbose,
-                                     eps=self.eps, cuda=self.cuda, for_play=for_play)
+                                     eps=self.eps, cuda=self.cuda, for_play=for_play,
+                                     legal_mask=self.legal_mask, state=state, rng=self.rng)
 
             if self.verbose:
                 print('forward pass of Q took', timer() - start)
@@ -198,8 +229,9 @@ class StrategyNFSP():
             self.is_Q_used = True
         else:
             # use average policy
-            state = build_state(player, board, pot, actions, opponent_stack, blinds[1],
-                                as_variable=False)
+            if state is None:
+                state = build_state(player, board, pot, actions, opponent_stack, blinds[1],
+                                    as_variable=False)
             state = [variable(s, cuda=self.cuda) for s in state]
             state.append(for_play)
             if self.verbose:
@@ -209,38 +241,22 @@ class StrategyNFSP():
 
             if self.verbose:
                 print('forward pass of pi took', timer() - start)
-            possible_actions = authorized_actions_buckets(player, actions, b_round, opponent_side_pot)
-            # @hack
-            # add some heuristics
-            # if check is possible
-            if 0 in possible_actions and -1 in possible_actions:
-                # one should not fold
-                del possible_actions[possible_actions.index(-1)]
-            # @hack: remove high roller actions
-            #try:
-            #    # anything betting above 20 should be discouraged
-            #    # when initial money is only 100
-            #    high_bet_i = possible_actions.index(8)
-            #    # but allow all-in
-            #    possible_actions = possible_actions[:high_bet_i] + [possible_actions[-1]]
-            #except ValueError:
-            #    pass
-
-            idx = [idx_to_bucket(k) for k, _ in enumerate(action_probs) if idx_to_bucket(k) in possible_actions]
-            valid_action_probs = t.stack([p for k, p in enumerate(action_probs) if idx_to_bucket(k) in possible_actions])
-
-            valid_action_probs /= t.sum(valid_action_probs)
-
-            action = bucket_to_action(sample_action(idx, valid_action_probs.data.cpu().numpy()), actions, b_round, player, opponent_side_pot)
+
+            # the probabilities of the unauthorized actions are zeroed before sampling
+            action_idx = sample_masked_action(action_probs.data.cpu().numpy(), self.legal_mask, self.rng)
+            action = bucket_to_action(idx_to_bucket(action_idx), actions, b_round, player, opponent_side_pot)
             self.is_Q_used = False
         return action, self.is_Q_used
 
     def sync_target_network(self):
         """
-        create a fixed target network
-        copy weights and memorys
+        copy the weights of Q to the fixed target network
+        """
+        self._target_Q.hard_update()
+
+    def update_target_network(self):
+        """
+        soft update of the target network after a learning step (nothing to do without target_Q_tau)
         """
-        try:
-            self._target_Q.load_state_dict(self._Q.state_dict())
-        except:
-            raise Exception('failed to synchronize traget network')
+        if self.target_Q_tau is not None:
+            self._target_Q.soft_update()
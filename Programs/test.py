@@ -1,9 +1,37 @@
-from game.game_utils import blinds, bucket_to_action, Card, authorized_actions_buckets, get_min_raise_bucket, get_max_bet_bucket, get_call_bucket, get_raise_from_bucket, Action
-from players.strategies import strategy_RL, strategy_random
-from players.player import Player, NeuralFictitiousPlayer
+from game.game_utils import blinds, bucket_to_action, Card, authorized_actions_buckets, get_min_raise_bucket, get_max_bet_bucket, get_call_bucket, get_raise_from_bucket, Action, action_to_array, action_to_bucket_idx, bucket_encode_actions, authorized_actions_mask, pack_action_mask, unpack_action_masks, sample_masked_action, greedy_masked_action, idx_to_bucket, Deck, deal, deal_card_indexes, CARDS, card_index, agreement, LegalActionTable, LegalActionArrays, BUCKETS, legal_actions_key, _authorized_actions_buckets, _bucket_to_action
+from game.utils import variable, masked_max
+from players.strategies import strategy_RL, strategy_random, strategy_mirror
+from players.player import Player, NeuralFictitiousPlayer, split_minibatches
+from game.state import build_state, EpisodeState
+from game import betting, game_utils
+from game.rng import RNGStreams
+from game.runtime import RuntimeConfig
+from game.profiling import PhaseProfiler
+from game.metrics import MetricsWriter, load_scalar
+from game.statistics import StatisticsAggregator, Histogram
+from game.hand_history import HandHistoryWriter, HandHistoryReader, INDEX_FILENAME, ACTION_TYPES
+from evaluation.hand_history_analysis import moving_average, StreamingMovingAverage, HandHistoryAnalyzer
+from benchmarks import harness
+from benchmarks.suite import simulator
+from game.checkpoint import latest_checkpoint
+from evaluation.evaluation_worker import EvaluationWorker, build_networks, evaluate_networks, load_snapshot, snapshot
+from evaluation.exploitability import PreflopGame, NetworkPolicy, uniform_policy
+from experience_replay.experience_replay import ReplayBufferManager
+from experience_replay.prefetch import ReplayPrefetcher
 from models.q_network import QNetwork, PiNetwork, CardFeaturizer1
+from models.target_network import TargetNetwork
+from models.flat_parameters import FlatParameters, WeightBroadcaster
 from nose.tools import *
-from odds.evaluation import evaluate_hand
+from odds.evaluation import evaluate_hand, evaluate_hands_batch
+from game.fast_engine import BaselineEngine, VectorizedEngine
+from odds.equity import all_in_equity
+import numpy as np
+import os
+import tempfile
+import threading
+import time
+import zipfile
+import torch as t
 
 
 def get_actions():
@@ -810,3 +838,772 @@ def test_all_actions_preflop():
     possible_actions = authorized_actions_buckets(players[0], actions, 0, players[1].side_pot)
     assert possible_actions == [-1] + list(range(8, 14)), possible_actions
 
+
+def test_action_to_bucket_idx():
+    actions = [Action('fold'), Action('check'), Action('call', 1), Action('bet', 2), Action('bet', 5),
+               Action('call', 18), Action('raise', 10, total=27), Action('bet', 81), Action('all in', 97)]
+    idxs = [action_to_bucket_idx(action_to_array(a)) for a in actions]
+    assert idxs == [0, 1, 2, 3, 5, 8, 10, 14, 15], idxs
+
+    # the batch encoding gives the same buckets
+    batch = variable(np.stack([action_to_array(a) for a in actions]))
+    buckets = bucket_encode_actions(batch).data.cpu().numpy()
+    assert list(buckets + 1) == idxs, buckets
+
+
+
+def test_authorized_actions_mask():
+    players = [Player(0, strategy_random, 100, name='SB'), Player(1, strategy_random, 100, name='DH')]
+    players[0].is_dealer = True
+    blinds(players)
+    actions = get_actions()
+    possible_actions = authorized_actions_buckets(players[0], actions, 0, players[1].side_pot)
+    mask = authorized_actions_mask(players[0], actions, 0, players[1].side_pot)
+    assert [idx_to_bucket(k) for k in np.flatnonzero(mask)] == possible_actions, (mask, possible_actions)
+
+    packed = pack_action_mask(mask)
+    assert (unpack_action_masks(packed) == mask).all()
+    assert (unpack_action_masks([packed, 0]) == np.stack([mask, np.zeros_like(mask)])).all()
+
+    # only authorized actions are sampled, even if they have a tiny probability
+    probabilities = np.ones(len(mask)) * (1 - mask) + 1e-6 * mask
+    for _ in range(100):
+        assert mask[sample_masked_action(probabilities, mask)]
+    values = np.arange(len(mask))[::-1].astype(float)
+    assert greedy_masked_action(values, mask) == np.flatnonzero(mask)[0]
+
+
+def test_masked_max():
+    values = variable(np.array([[1., 5., 3.], [-4., -2., 7.], [2., 2., 2.]]))
+    mask = variable(np.array([[1., 0., 1.], [1., 1., 0.], [0., 0., 0.]]))
+    # the last row is a terminal state: nothing is authorized and nothing is bootstrapped
+    assert list(masked_max(values, mask).data.cpu().numpy()) == [3., -2., 0.]
+
+
+def test_split_minibatches():
+    batch = {'state_vars': [variable(np.arange(6).reshape(6, 1)), variable(np.arange(12).reshape(6, 2))],
+             'action_idxs': np.arange(6),
+             'ids': list(range(6))}
+    minibatches = split_minibatches(batch, 3)
+    assert len(minibatches) == 3
+    assert list(minibatches[1]['action_idxs']) == [2, 3]
+    assert minibatches[2]['ids'] == [4, 5]
+    assert minibatches[1]['state_vars'][1].data.cpu().numpy().tolist() == [[4., 5.], [6., 7.]]
+    assert split_minibatches(batch, 1)[0] is batch
+
+
+def test_target_network():
+    f = CardFeaturizer1(10, 5)
+    for param in f.parameters():
+        param.requires_grad = False
+    Q = QNetwork(16, 10, f, {}, 0, 1e-3, 'adam', False, None)
+    target = TargetNetwork(Q, tau=.5)
+    # the frozen featurizer is shared, the trainable weights are copied
+    assert target.network.featurizer is f
+    assert target.network.fc27.weight is not Q.fc27.weight
+    assert (target.network.fc27.weight.data == Q.fc27.weight.data).all()
+    assert not target.network.fc27.weight.requires_grad
+
+    old = target.network.fc27.weight.data.clone()
+    Q.fc27.weight.data += 1
+    target.soft_update()
+    # lerp_ rounds differently from the addition: weights close to 0 need an absolute tolerance
+    assert t.allclose(target.network.fc27.weight.data, old + .5, atol=1e-6)
+    target.hard_update()
+    assert (target.network.fc27.weight.data == Q.fc27.weight.data).all()
+    assert (target.network.fc19.weight.data == Q.fc19.weight.data).all()
+
+
+def test_flat_parameters():
+    f = CardFeaturizer1(10, 5)
+    for param in f.parameters():
+        param.requires_grad = False
+    Q = QNetwork(16, 10, f, {}, 0, 1e-3, 'adam', False, None)
+    pi = PiNetwork(16, 10, f, {}, 0, 1e-3, 'adam', None, q_network=Q)
+    flat = FlatParameters([Q, pi])
+    n_trainable = sum(p.numel() for p in set(Q.parameters()) | set(pi.parameters()) if p.requires_grad)
+    assert len(flat) == n_trainable
+    # the weights of Q are a prefix of the buffer, and the parameters are views of it
+    Q_weights = flat.segment(Q)
+    assert Q_weights is not None and Q_weights.data_ptr() == flat.flat.data_ptr()
+    flat.flat.zero_()
+    assert (Q.fc27.weight.data == 0).all() and (pi.fc19.weight.data == 0).all()
+    # the target network reads Q's weights directly from the buffer
+    assert TargetNetwork(Q)._online_flat is not None
+
+    broadcaster = WeightBroadcaster(flat)
+    Q_replica = QNetwork(16, 10, f, {}, 0, 1e-3, 'adam', False, None)
+    replica = FlatParameters([Q_replica, PiNetwork(16, 10, f, {}, 0, 1e-3, 'adam', None, q_network=Q_replica)])
+    Q.fc27.weight.data += 1
+    flat.bump()
+    broadcaster.publish()
+    assert broadcaster.pull(replica) == 1
+    assert (Q_replica.fc27.weight.data == 1).all()
+
+
+def test_episode_state():
+    np.random.seed(0)
+    players = [Player(0, strategy_random, 100, name='SB'), Player(1, strategy_random, 100, name='DH')]
+    players[1].is_dealer = True
+    deck = Deck()
+    deck.populate()
+    deck.shuffle()
+    board = []
+    actions = get_actions()
+    state = EpisodeState()
+    plays = [Action('check'), Action('bet', 4), Action('call', 2), Action('raise', 6, total=10), Action('all in', 90)]
+    for b_round in range(4):
+        deal(deck, players, board, b_round)
+        state.deal(players, board)
+        for k in range(3):
+            for p_id in range(2):
+                action = plays[np.random.randint(len(plays))]
+                actions[b_round][p_id].append(action)
+                state.add_action(b_round, p_id, k, action)
+                for player in players:
+                    pot, opponent_stack = np.random.randint(200), np.random.randint(100)
+                    expected = build_state(player, board, pot, actions, opponent_stack, 2)
+                    snapshot = state.snapshot(player, pot, opponent_stack, 2)
+                    assert all(np.array_equal(s, e) for s, e in zip(snapshot, expected))
+    # the snapshots are copies
+    snapshot[0][:] = 0
+    assert state.snapshot(players[1], 0, 0, 2)[0].sum() == 2
+
+
+def legacy_agreement(actions, betting_round):
+    """
+    The if-chain agreement was implemented with before game.betting (kept as a reference)
+    Verify whether two players came to an agreement, meaning that the betting round can end now
+    :param actions: a dict {betting_round: {player_id: [actions]}}
+    :param betting_round: the id of the betting round (0:preflop, 1:flop,...)
+    :return: True/False
+    """
+    if len(actions[betting_round][0]) == 0 or len(actions[betting_round][1]) == 0:
+        return False
+    # 1 raise 1 call
+    dealer = 0 if actions[-1][0] == 1 else 1
+    if betting_round > 0:  # after preflop, any call/raise situation leads to the end of the betting round
+        if (actions[betting_round][0][-1].type == 'raise' and actions[betting_round][1][-1].type == 'call') or (actions[betting_round][0][-1].type == 'call' and actions[betting_round][1][-1].type == 'raise'):
+            return True
+    else:
+        # at preflop, if the SB called and the BB raised, it continues playing. If the SB raised and the BB called, it ends the preflop
+        if len(actions[0][0]) == len(actions[0][1]) == 1:
+            if actions[betting_round][dealer][-1].type == 'raise' and actions[betting_round][1-dealer][-1].type == 'call':
+                return True
+        # at preflop, if the BB raised the call of the SB, then there is no more special situation
+        else:
+            if (actions[betting_round][0][-1].type == 'raise' and actions[betting_round][1][-1].type == 'call') or (actions[betting_round][0][-1].type == 'call' and actions[betting_round][1][-1].type == 'raise'):
+                return True
+    # 1 fold
+    if actions[betting_round][0][-1].type == 'fold' or actions[betting_round][1][-1].type == 'fold':
+        return True
+    # 1 check 1 call
+    if (actions[betting_round][0][-1].type == 'check' and actions[betting_round][1][-1].type == 'call') or (actions[betting_round][0][-1].type == 'call' and actions[betting_round][1][-1].type == 'check'):
+        return True
+    # 1 check 1 bet
+    if (actions[betting_round][0][-1].type == 'check' and actions[betting_round][1][-1].type == 'bet') or (actions[betting_round][0][-1].type == 'bet' and actions[betting_round][1][-1].type == 'check'):
+        return False
+    # 2 checks
+    if actions[betting_round][0][-1].type == 'check' and actions[betting_round][1][-1].type == 'check':
+        return True
+    # 1 bet 1 call
+    if (actions[betting_round][0][-1].type == 'bet' and actions[betting_round][1][-1].type == 'call') or (
+            actions[betting_round][0][-1].type == 'call' and actions[betting_round][1][-1].type == 'bet'):
+        return True
+    # 1 all-in and 1 call
+    if (actions[betting_round][0][-1].type == 'all in' and actions[betting_round][1][-1].type == 'call') or (
+                    actions[betting_round][0][-1].type == 'call' and actions[betting_round][1][-1].type == 'all in'):
+        return True
+    # 2 all-in
+    if actions[betting_round][0][-1].type == 'all in' and actions[betting_round][1][-1].type == 'all in':
+        return True
+    return False
+
+
+def random_betting_rounds(n, seed=0):
+    """random sequences of actions (not necessarily legal), as dicts {b_round: {player: [actions]}}"""
+    rng = np.random.RandomState(seed)
+    types = ['check', 'bet', 'call', 'raise', 'all in', 'fold']
+    for _ in range(n):
+        dealer = rng.randint(2)
+        b_round = rng.randint(4)
+        actions = get_actions()
+        actions[-1] = {dealer: 1, 1 - dealer: 2}
+        to_play = dealer if b_round == 0 else 1 - dealer
+        sequence = []
+        for _ in range(rng.randint(9)):
+            action = Action(types[rng.randint(len(types))])
+            actions[b_round][to_play].append(action)
+            sequence.append((to_play, action))
+            to_play = 1 - to_play
+        yield actions, b_round, dealer, sequence
+
+
+def test_betting_state_machine():
+    for actions, b_round, dealer, sequence in random_betting_rounds(20000):
+        assert agreement(actions, b_round) == legacy_agreement(actions, b_round), (actions, b_round)
+        # applying the actions one by one leads to the same state
+        state = betting.initial_state(b_round)
+        for player_id, action in sequence:
+            position = betting.SB if player_id == dealer else betting.BB
+            state = betting.step(state, position, betting.TYPE_TO_IDX[action.type])
+        assert state == betting.state_from_actions(actions, b_round)
+
+    # several tables at once
+    states = np.array([betting.initial_state(0), betting.initial_state(1)])
+    states = betting.step(states, np.array([betting.SB, betting.BB]), np.array([betting.TYPE_TO_IDX['call'], betting.TYPE_TO_IDX['check']]))
+    states = betting.step(states, np.array([betting.BB, betting.SB]), np.array([betting.TYPE_TO_IDX['check'], betting.TYPE_TO_IDX['check']]))
+    assert list(betting.is_over(states)) == [True, True]
+
+
+def test_legal_action_table():
+    table = LegalActionTable()
+    players = [Player(0, strategy_random, 100, name='SB'), Player(1, strategy_random, 100, name='DH')]
+    players[0].is_dealer = True
+    blinds(players)
+    actions = get_actions()
+    for _ in range(2):
+        assert table.buckets(players[0], actions, 0, players[1].side_pot) == _authorized_actions_buckets(players[0], actions, 0, players[1].side_pot)
+    # the second lookup was served by the table
+    assert len(table) == 1
+    mask = table.mask(players[0], actions, 0, players[1].side_pot)
+    mask[:] = False
+    assert table.mask(players[0], actions, 0, players[1].side_pot).any()
+
+    # the SB raises, the BB can call, raise or go all-in
+    raise_ = table.action(4, players[0], actions, 0, players[1].side_pot)
+    expected = _bucket_to_action(4, actions, 0, players[0], players[1].side_pot)
+    assert (raise_.type, raise_.value, raise_.total) == (expected.type, expected.value, expected.total)
+    # the actions are not shared between lookups
+    assert table.action(4, players[0], actions, 0, players[1].side_pot) is not raise_
+    actions[0][0].append(raise_)
+    players[0].side_pot += raise_.total
+    players[0].stack -= raise_.total
+    assert table.buckets(players[1], actions, 0, players[0].side_pot) == _authorized_actions_buckets(players[1], actions, 0, players[0].side_pot)
+
+
+class CheckedLegalActionTable(LegalActionTable):
+    """compares each lookup with the uncached functions, and with LegalActionArrays"""
+
+    def __init__(self, max_size):
+        super().__init__(max_size)
+        self.n_lookups = 0
+
+    def _entry(self, key, player, actions, b_round, opponent_side_pot):
+        entry = super()._entry(key, player, actions, b_round, opponent_side_pot)
+        assert list(entry[0]) == _authorized_actions_buckets(player, actions, b_round, opponent_side_pot)
+        assert (LegalActionArrays(*[0 if x is None else x for x in key]).masks()[0] == entry[1]).all()
+        self.n_lookups += 1
+        return entry
+
+    def action(self, bucket, player, actions, b_round, opponent_side_pot):
+        action = super().action(bucket, player, actions, b_round, opponent_side_pot)
+        expected = _bucket_to_action(bucket, actions, b_round, player, opponent_side_pot)
+        assert (action.type, action.value, action.min_raise, action.total) == \
+            (expected.type, expected.value, expected.min_raise, expected.total)
+        key = legal_actions_key(player, actions, b_round, opponent_side_pot)
+        types, values, totals, min_raises = LegalActionArrays(*[0 if x is None else x for x in key]).actions(BUCKETS[None, :])
+        # min_raise is only defined for the raises
+        array_action = (betting.ACTION_TYPES[types[0, bucket + 1]], values[0, bucket + 1], totals[0, bucket + 1],
+                        bool(min_raises[0, bucket + 1]) if action.type == 'raise' else action.min_raise)
+        assert array_action == (action.type, action.value, action.total, action.min_raise)
+        self.n_lookups += 1
+        return action
+
+
+def test_legal_action_table_decisions():
+    # small enough to be emptied during the games
+    table = CheckedLegalActionTable(max_size=64)
+    legal_actions = game_utils.LEGAL_ACTIONS
+    game_utils.LEGAL_ACTIONS = table
+    try:
+        for strategies, n_games in [(('random', 'random'), 100), (('mirror', 'random'), 100), (('NFSP', 'random'), 10)]:
+            sim = simulator(*strategies)
+            sim.start(n_games)
+            sim.close()
+    finally:
+        game_utils.LEGAL_ACTIONS = legal_actions
+    assert table.n_lookups > 1000
+    assert len(table) <= 64 and len(table._actions) <= 64
+
+
+def test_evaluate_hands_batch():
+    rng = np.random.RandomState(0)
+    n = 2000
+    cards = np.argsort(rng.rand(n, 52), axis=1)[:, :9]
+    hands_0 = np.concatenate([cards[:, :2], cards[:, 4:]], axis=1)
+    hands_1 = cards[:, 2:]
+    scores_0 = evaluate_hands_batch(hands_0 // 4 + 1, hands_0 % 4)
+    scores_1 = evaluate_hands_batch(hands_1 // 4 + 1, hands_1 % 4)
+    for i in range(n):
+        hand_0 = evaluate_hand([Card(Card.RANKS[c // 4], Card.SUITS[c % 4]) for c in hands_0[i]])
+        hand_1 = evaluate_hand([Card(Card.RANKS[c // 4], Card.SUITS[c % 4]) for c in hands_1[i]])
+        # same comparison as in Simulator._showdown
+        expected = (hand_0[1], hand_0[2]) > (hand_1[1], hand_1[2]), (hand_0[1], hand_0[2]) == (hand_1[1], hand_1[2])
+        assert (scores_0[i] > scores_1[i], scores_0[i] == scores_1[i]) == expected, (hand_0, hand_1)
+
+
+def test_baseline_engine():
+    engine = BaselineEngine(strategy_random, strategy_random, n_tables=8, seed=0)
+    results = engine.run(20)
+    assert len(results['winners']) == 20
+    assert set(results['winners']) <= {0, 1}
+    assert (results['episodes'] >= 1).all()
+    for table in engine.tables:
+        assert table.players[0].stack + table.players[1].stack == 2 * 100
+
+    # the simulator plays as many games with the engine as with its own loop (the last one is not over with the loop)
+    for fast_baselines in (False, True):
+        sim = simulator('random', 'random', fast_baselines=fast_baselines)
+        sim.start(5)
+        assert sim.games['n'] == 6
+        assert len(sim.games['winnings']) == (6 if fast_baselines else 5)
+        sim.close()
+
+
+def test_vectorized_engine():
+    engine = VectorizedEngine(strategy_random, strategy_mirror, n_tables=16, seed=0)
+    results = engine.run(40)
+    assert len(results['winners']) == 40
+    assert set(results['winners']) <= {0, 1}
+    assert (results['episodes'] >= 1).all()
+    assert (engine.stacks.sum(axis=1) == 2 * 100).all()
+    rewards = engine.run_episodes(500)
+    assert rewards.shape == (500, 2)
+    assert (rewards.sum(axis=1) == 0).all()
+    # the mirror player only checks, calls and bets the blind: each player wins or loses the BB
+    rewards = VectorizedEngine(strategy_mirror, strategy_mirror, n_tables=16, seed=0).run_episodes(200)
+    assert set(np.abs(rewards).ravel()) <= {0, 2}
+    runs = [VectorizedEngine(strategy_random, strategy_random, n_tables=4, seed=7).run(10) for _ in range(2)]
+    assert (runs[0]['winners'] == runs[1]['winners']).all() and (runs[0]['episodes'] == runs[1]['episodes']).all()
+    assert_raises(ValueError, VectorizedEngine, strategy_RL, strategy_random)
+
+
+def test_runtime_config():
+    default = t.get_num_threads()
+    runtime = RuntimeConfig(num_threads_act=1, num_threads_learn=2)
+    try:
+        runtime.acting()
+        assert t.get_num_threads() == 1
+        runtime.learning()
+        assert t.get_num_threads() == 2
+        runtime.acting()
+        assert t.get_num_threads() == 1
+    finally:
+        t.set_num_threads(default)
+    # None leaves torch's default
+    RuntimeConfig().learning()
+    assert t.get_num_threads() == default
+
+    runtime.count('episodes', 10)
+    runtime.count('decisions', 40)
+    runtime._last_report_time = time.time() - 2.
+    rates = runtime.throughput()
+    assert np.isclose(rates['episodes_per_sec'], 5., rtol=0.05)
+    assert np.isclose(rates['decisions_per_sec'], 20., rtol=0.05)
+    assert rates['updates_per_sec'] == 0
+    # the rates are measured since the last call
+    assert runtime.throughput()['episodes_per_sec'] == 0
+    runtime.report_freq = 5
+    assert runtime.should_report()
+    runtime.count('episodes')
+    assert not runtime.should_report()
+
+
+def test_rng_streams():
+    streams, same = RNGStreams(42), RNGStreams(42)
+    # a stream only depends on the seed and on its key, not on the order of creation
+    actor = streams.actor(1).random(5)
+    same.buffer(1, 'rl')
+    assert (same.actor(1).random(5) == actor).all()
+    assert not (streams.actor(0).random(5) == RNGStreams(42).actor(1).random(5)).any()
+    children = streams.spawn(2)
+    assert not (children[0].table().random(5) == children[1].table().random(5)).any()
+    # the streams of the children differ from every stream of the parent
+    parent_draws = [RNGStreams(42).table(0), RNGStreams(42).table(1), RNGStreams(42).actor(0), RNGStreams(42).actor(1),
+                    RNGStreams(42).buffer(0, 'rl'), RNGStreams(42).buffer(1, 'sl'), RNGStreams(42).equity(),
+                    RNGStreams(42).evaluation(0).table()]
+    parent_draws = [g.random(5) for g in parent_draws]
+    for child in RNGStreams(42).spawn(4):
+        for g in [child.table(0), child.table(1), child.actor(0), child.actor(1), child.buffer(0, 'rl')]:
+            draws = g.random(5)
+            assert not any((draws == other).any() for other in parent_draws)
+    assert not (RNGStreams(42).equity().random(5) == RNGStreams(42).table().random(5)).any()
+    # the generators are restored from a state_dict, including the ones not created yet by the restored streams
+    state = streams.state_dict()
+    restored = RNGStreams(42)
+    restored.load_state_dict(state)
+    assert (restored.actor(1).random(5) == streams.actor(1).random(5)).all()
+    assert (restored.table().random(5) == streams.table().random(5)).all()
+    # the runouts sampled for the all-in equities don't change the cards dealt
+    winnings = []
+    for all_in_equity in (False, True):
+        sim = simulator('random', 'random', all_in_equity=all_in_equity)
+        sim.start(3)
+        winnings.append(sim.games['winnings'])
+        sim.close()
+    assert winnings[0] == winnings[1]
+
+    decks = [Deck(), Deck()]
+    decks[0].shuffle(RNGStreams(0).table())
+    decks[1].shuffle(RNGStreams(0).table())
+    assert [decks[0].draw() for _ in range(9)] == [decks[1].draw() for _ in range(9)]
+
+    runs = [BaselineEngine(strategy_random, strategy_random, n_tables=4, seed=7).run(10) for _ in range(2)]
+    assert (runs[0]['episodes'] == runs[1]['episodes']).all()
+
+
+def test_replay_nbytes():
+    memory = ReplayBufferManager('sl', {'size': 4, 'batch_size': 2}, 2)
+    state = [np.zeros(10), np.zeros((2, 5))]
+    memory.store((state, np.zeros(6)))
+    # the arrays of the state are shared: counted once
+    memory.store((state, np.zeros(6)))
+    assert memory.nbytes == 2 * 80 + 2 * 48
+
+
+class PrefetchedMemory:
+    target = 'rl'
+
+    def __init__(self):
+        self.n_samples = 0
+        self.error = None
+        self.update_threads = []
+        self.updated = threading.Event()
+        self.update_error = None
+
+    def sample(self, global_step, n_batches=1):
+        if self.error is not None:
+            raise self.error
+        self.n_samples += 1
+        return self.n_samples
+
+    def update(self, exp_ids, deltas):
+        if self.update_error is not None:
+            raise self.update_error
+        self.update_threads.append(threading.current_thread().name)
+        self.updated.set()
+
+
+def test_replay_prefetcher():
+    memory, ready = PrefetchedMemory(), threading.Event()
+    prefetcher = ReplayPrefetcher(memory, 2, is_ready=ready.is_set, transform=lambda batch: -batch)
+    try:
+        # nothing is sampled until the memory is ready
+        time.sleep(.05)
+        assert memory.n_samples == 0
+        ready.set()
+        prefetcher.notify()
+        assert prefetcher.get(0) == -1
+        assert prefetcher.get(1) == -2
+        # the priority updates are applied by the background thread
+        prefetcher.update([0], [1.])
+        assert memory.updated.wait(5.)
+        assert memory.update_threads == ['rl_prefetcher']
+        # the exceptions of the sampling are raised by get, once the batches sampled before are used
+        while prefetcher._batches.qsize() < 2:
+            time.sleep(.01)
+        memory.error = ValueError('sampling failed')
+        prefetcher.get(2)
+        prefetcher.get(3)
+        assert_raises(ValueError, prefetcher.get, 4)
+    finally:
+        prefetcher.close()
+    assert not prefetcher._thread.is_alive()
+
+    # the errors of the priority updates are raised by get as well, even when the minibatches are ready
+    memory = PrefetchedMemory()
+    prefetcher = ReplayPrefetcher(memory, 1, is_ready=lambda: True)
+    try:
+        assert prefetcher.get(0) == 1
+        while prefetcher._batches.qsize() < 1:
+            time.sleep(.01)
+        memory.update_error = KeyError('unknown experience')
+        prefetcher.update([0], [1.])
+        assert prefetcher.get(1) == 2
+        assert_raises(KeyError, prefetcher.get, 2)
+        assert prefetcher._thread.is_alive()
+    finally:
+        prefetcher.close()
+
+
+def test_deck():
+    assert [card_index(c) for c in CARDS] == list(range(52))
+    deck = Deck()
+    for _ in range(3):
+        deck.shuffle(np.random.default_rng(0))
+        # more cards than the shuffled ones can be drawn
+        drawn = [deck.draw() for _ in range(20)]
+        assert len({repr(c) for c in drawn + deck.cards}) == 52
+        assert sorted(deck.order) == list(range(52))
+    indexes = deal_card_indexes(1000, rng=np.random.default_rng(0))
+    assert indexes.shape == (1000, 9)
+    assert all(len(set(row)) == 9 for row in indexes)
+    # the cards are uniformly distributed
+    counts = np.bincount(indexes.ravel(), minlength=52)
+    assert counts.min() > 100 and counts.max() < 250
+
+
+def test_all_in_equity():
+    aces = [Card('A', 'h'), Card('A', 'c')]
+    kings = [Card('K', 's'), Card('K', 'd')]
+    board = [Card('2', 'h'), Card('7', 'c'), Card('9', 's'), Card('K', 'h')]
+    # the 44 rivers are enumerated
+    wins = [0, 0, 0]
+    for river in CARDS:
+        if river in aces + kings + board:
+            continue
+        hand_0, hand_1 = evaluate_hand(aces + board + [river]), evaluate_hand(kings + board + [river])
+        if (hand_0[1], hand_0[2]) == (hand_1[1], hand_1[2]):
+            wins[2] += 1
+        else:
+            wins[int((hand_1[1], hand_1[2]) > (hand_0[1], hand_0[2]))] += 1
+    assert np.allclose(all_in_equity(aces, kings, board), np.array(wins) / 44)
+    assert np.isclose(all_in_equity(aces, kings, board[:3]).sum(), 1)
+    # preflop, the runouts are sampled
+    assert abs(all_in_equity(aces, kings, [], rng=np.random.default_rng(0))[0] - 0.82) < 0.04
+
+
+def test_phase_profiler():
+    profiler = PhaseProfiler()
+    for _ in range(2):
+        with profiler.phase('learn'):
+            with profiler.phase('forward'):
+                pass
+            profiler.add('backward', 0.5)
+        profiler.count_episode()
+    # only the thread that created the profiler is timed
+    thread = threading.Thread(target=lambda: profiler.phase('other').__enter__())
+    thread.start()
+    thread.join()
+    record = profiler.record()
+    assert set(record['phases']) == {'learn', 'learn/forward', 'learn/backward'}
+    assert record['episodes'] == 2
+    assert record['phases']['learn/forward']['calls'] == 2
+    assert record['phases']['learn/backward']['ms_per_episode'] == 500
+    assert profiler.record()['phases'] == {}
+
+    disabled = PhaseProfiler(enabled=False)
+    with disabled.phase('learn'):
+        disabled.add('backward', 1)
+    assert disabled.record()['phases'] == {}
+
+
+def test_metrics_writer():
+    with tempfile.TemporaryDirectory() as path:
+        writer = MetricsWriter(os.path.join(path, 'run'), flush_interval=60)
+        writer.add_scalar_value('p1_q_loss', .5)
+        writer.add_scalar_dict({'p1_q_loss': [.25, .125], 'ms_per_episode/learn': 3})
+        assert writer.get_scalar_names() == ['ms_per_episode/learn', 'p1_q_loss']
+        assert [v[1:] for v in writer.get_scalar_values('p1_q_loss')] == [[0, .5], [1, .25], [2, .125]]
+        writer.add_scalar_value('p1_q_loss', 1., step=10)
+        writer.close()
+        assert list(load_scalar(writer.path, 'p1_q_loss')['step']) == [0, 1, 2, 10]
+        archive = writer.to_zip(os.path.join(path, 'run.zip'))
+        assert len(zipfile.ZipFile(archive).namelist()) == 2 * 3
+        # the points are rejected once the writer is closed
+        assert_raises(ValueError, writer.add_scalar_value, 'p1_q_loss', 2.)
+
+        # the errors of the background thread are raised by the next flush, and the thread goes on
+        writer = MetricsWriter(os.path.join(path, 'failing'), flush_interval=60, max_pending=1)
+        # the directory of the scalar cannot be created
+        open(os.path.join(writer.path, 'blocked'), 'w').close()
+        writer.add_scalar_value('blocked', 1.)
+        start = time.time()
+        while writer._error is None and time.time() - start < 5:
+            time.sleep(.01)
+        assert_raises(OSError, writer.flush)
+        writer.add_scalar_value('p1_q_loss', 1.)
+        writer.close()
+        assert list(load_scalar(writer.path, 'p1_q_loss')['value']) == [1.]
+
+
+def test_statistics_aggregator():
+    stats = StatisticsAggregator()
+    rewards = np.random.RandomState(0).normal(size=100)
+    # merged batch by batch
+    for batch in np.split(rewards, [10, 11, 60]):
+        stats.moments('rewards', batch)
+    stats.histogram('actions', [-1, 0, 0, 14, 20], Histogram.integers(-1, 14).edges)
+    stats.count('folds', 2)
+    summary = stats.summary()
+    assert summary['folds'] == 2
+    assert summary['rewards/count'] == 100
+    assert np.isclose(summary['rewards/mean'], rewards.mean())
+    assert np.isclose(summary['rewards/std'], rewards.std())
+    assert summary['rewards/max'] == rewards.max()
+    assert (summary['actions/-1'], summary['actions/0'], summary['actions/14'], summary['actions/out']) == (1, 2, 1, 1)
+    assert len(stats.summary()) == 0
+
+
+def test_hand_history():
+    hands = [[Card('A', 's'), Card('K', 's')], [Card('2', 'h'), Card('7', 'd')]]
+    board = [Card('10', 'c'), Card('J', 'c'), Card('Q', 'c')]
+    # the dealer (player 1) plays first preflop, second on the flop
+    actions = {b_round: {0: [], 1: []} for b_round in range(4)}
+    actions[0][1] = [Action('call', 1)]
+    actions[0][0] = [Action('check')]
+    actions[1][0] = [Action('bet', 4)]
+    actions[1][1] = [Action('fold')]
+    with tempfile.TemporaryDirectory() as path:
+        writer = HandHistoryWriter(path, chunk_size=2)
+        for episode in range(1, 6):
+            writer.record(episode, 1, 1, hands, board, (100, 100), (2, -2), actions, False)
+        writer.close()
+        # episodes are appended to an existing history, and a partial index record is ignored
+        writer = HandHistoryWriter(path, chunk_size=2)
+        writer.record(6, 2, 0, hands, [], (100, 100), (-1, 1), {b_round: {0: [], 1: []} for b_round in range(4)}, False)
+        writer.close()
+        with open(os.path.join(path, INDEX_FILENAME), 'ab') as f:
+            f.write(b'torn')
+
+        reader = HandHistoryReader(path)
+        assert len(reader) == 6
+        assert [len(e) for e, _ in reader.chunks()] == [2, 2, 1, 1]
+        episode, episode_actions = reader[3]
+        assert episode['episode'] == 4 and list(episode['rewards']) == [2, -2]
+        assert list(episode['hands'][0]) == [4 * 12 + Card.SUITS.index('s'), 4 * 11 + Card.SUITS.index('s')]
+        assert list(episode['board'][3:]) == [255, 255]
+        assert [(a['street'], a['player'], ACTION_TYPES[a['type']], a['value']) for a in episode_actions] == \
+            [(0, 1, 'call', 1), (0, 0, 'check', 0), (1, 0, 'bet', 4), (1, 1, 'fold', 0)]
+        episode, episode_actions = reader[-1]
+        assert episode['game'] == 2 and len(episode_actions) == 0
+
+
+def test_hand_history_analysis():
+    x = np.random.RandomState(0).normal(size=50)
+    expected = [np.mean(x[k:k + 7]) for k in range(len(x) - 7 + 1)]
+    assert np.allclose(moving_average(x, 7), expected)
+    streaming = StreamingMovingAverage(7, stride=3)
+    for chunk in np.split(x, [2, 3, 20, 21]):
+        streaming.add(chunk)
+    positions, averages = streaming.result()
+    assert list(positions) == list(range(9, 51, 3))
+    assert np.allclose(averages, [expected[p - 7] for p in positions])
+
+    actions = np.array([(0, 0, 2, 1), (0, 1, 1, 0), (1, 1, 3, 4), (1, 0, 0, 0)],
+                       dtype=[('street', 'i1'), ('player', 'i1'), ('type', 'i1'), ('value', '<i4')])
+    episodes = np.zeros(4, dtype=[('rewards', '<i4', (2,)), ('showdown', '?')])
+    episodes['rewards'] = [(2, -2), (-2, 2), (4, -4), (0, 0)]
+    analyzer = HandHistoryAnalyzer(player=0, window=2)
+    analyzer.update(episodes[:1], actions[:0])
+    analyzer.update(episodes[1:], actions)
+    report = analyzer.report()
+    assert report['n_hands'] == 4 and np.isclose(report['mbb_per_hand'], 1000 * 1 / 2)
+    assert report['ci95'][0] < report['mbb_per_hand'] < report['ci95'][1]
+    assert np.allclose(report['moving_average'][1], [0, 1000])
+    assert report['action_frequencies'][1, 1, 3] == 1 and report['action_frequencies'][0, 0, 2] == 1
+
+
+def test_checkpoint():
+    with tempfile.TemporaryDirectory() as path:
+        reference = simulator('NFSP', 'random')
+        reference.start(term_episode_count=40)
+        interrupted = simulator('NFSP', 'random', checkpoint_path=path, checkpoint_freq=20, checkpoint_memories=True)
+        interrupted.start(term_episode_count=30)
+        interrupted.checkpointer.wait()
+        assert latest_checkpoint(path).endswith('checkpoint_000000000020.pt')
+        # resumed from the 20th episode: the 20 next ones are the same as in the reference
+        resumed = simulator('NFSP', 'random', checkpoint_path=path, checkpoint_freq=20, checkpoint_memories=True)
+        assert resumed.games['#episodes'] == 20
+        resumed.start(term_episode_count=40)
+        resumed.checkpointer.wait()
+        assert resumed.global_step == reference.global_step
+        assert [p.stack for p in resumed.players] == [p.stack for p in reference.players]
+        assert resumed.players[0].memory_rl.size == reference.players[0].memory_rl.size
+        assert resumed.players[0].strategy.eps == reference.players[0].strategy.eps
+
+
+def test_evaluation_worker():
+    # the cards are dealt first: the rewards of an episode are a transfer between the players
+    engine = BaselineEngine(strategy_random, strategy_random, n_tables=4, seed=0, deal_first=True)
+    rewards = engine.run_episodes(30)
+    assert rewards.shape == (30, 2)
+    assert (rewards.sum(axis=1) == 0).all()
+    assert all(len(table.players[0].cards) == 2 for table in engine.tables)
+
+    sim = simulator('NFSP', 'random')
+    Q, pi = sim.players[0].strategy._Q, sim.players[0].strategy._pi
+    # the frozen copies are in eval mode (no dropout): an evaluation only depends on its random streams
+    frozen_Q, frozen_pi = build_networks()
+    load_snapshot(frozen_Q, snapshot(Q))
+    load_snapshot(frozen_pi, snapshot(pi))
+    assert (frozen_pi.fc28.weight.data == pi.fc28.weight.data).all()
+    results = [evaluate_networks(frozen_Q, frozen_pi, n_hands=20, n_tables=4,
+                                 rng_streams=RNGStreams(0).evaluation(10)) for _ in range(2)]
+    assert results[0] == results[1]
+    assert set(results[0]['pi']) == {'random', 'mirror'}
+    assert results[0]['pi']['random']['n_hands'] == 20
+    # pi and Q play the same cards
+    draw_cards, dealt = BaselineEngine.draw_cards, []
+
+    def recording_draw_cards(engine, n):
+        dealt.append(draw_cards(engine, n))
+        return dealt[-1]
+    BaselineEngine.draw_cards = recording_draw_cards
+    try:
+        evaluate_networks(frozen_Q, frozen_pi, policies=('pi', 'Q'), n_hands=20, n_tables=4,
+                          rng_streams=RNGStreams(0).evaluation(10))
+    finally:
+        BaselineEngine.draw_cards = draw_cards
+    assert len(dealt) % 2 == 0
+    for pi_cards, Q_cards in zip(dealt[:len(dealt) // 2], dealt[len(dealt) // 2:]):
+        assert (pi_cards == Q_cards).all()
+
+    worker = EvaluationWorker(n_hands=20, n_tables=4, max_pending=1)
+    assert worker.submit(10, 0, Q, pi, RNGStreams(0).evaluation(10))
+    # the previous snapshot is still waiting
+    assert not worker.submit(11, 0, Q, pi)
+    evaluations = worker.close()
+    assert [(e['episode'], e['player']) for e in evaluations] == [(10, 0)]
+    assert np.isfinite(evaluations[0]['results']['pi']['mirror']['mbb_per_hand'])
+
+    # the weights stored in a flat buffer are broadcast instead of being pickled, the evaluation is the same
+    sim = simulator('NFSP', 'random', flat_parameters=True)
+    player = sim.players[0]
+    Q, pi = player.strategy._Q, player.strategy._pi
+    worker = EvaluationWorker(n_hands=20, n_tables=4, max_pending=3)
+    assert worker.submit(10, 0, Q, pi, RNGStreams(0).evaluation(10))
+    assert worker.submit(10, 1, Q, pi, RNGStreams(0).evaluation(10), flat_parameters=player.flat_parameters)
+    # the broadcast weights were not read yet
+    assert not worker.submit(11, 1, Q, pi, flat_parameters=player.flat_parameters)
+    evaluations = worker.close()
+    assert [e['player'] for e in evaluations] == [0, 1]
+    assert evaluations[0]['results'] == evaluations[1]['results']
+
+
+def test_exploitability():
+    game = PreflopGame(stack=6, n_boards=20)
+    for tree in game.trees:
+        for node in tree.nodes():
+            # every action leads somewhere, and the chips only move from a player to the other
+            assert node.is_terminal == (len(node.children) == 0)
+            if node.is_terminal:
+                assert all(abs(payoff) <= 6 for payoff in node.payoffs)
+                assert node.showdown or node.payoffs[0] == node.payoffs[1]
+
+    def fold_or_check(node):
+        weights = np.zeros(16)
+        weights[:2] = 1
+        return weights
+    # against a player who always folds (or checks), the dealer raises and wins the big blind, the other player wins
+    # the small blind
+    report = game.exploitability(fold_or_check)
+    assert np.isclose(report['exploitability'], 1000 * (2 + 1) / 2 / 2)
+    assert game.exploitability(uniform_policy)['exploitability'] > 0
+
+    _, pi = build_networks()
+    report = game.exploitability(NetworkPolicy(pi))
+    assert report['exploitability'] >= 0
+    assert np.allclose(report['best_response'], game.exploitability((NetworkPolicy(pi), NetworkPolicy(pi)))['best_response'])
+
+
+def test_benchmark_comparison():
+    baseline = {'results': {'a': {'rate': 100., 'unit': 'hands'}, 'b': {'rate': 100., 'unit': 'hands'}}}
+    results = {'results': {'a': {'rate': 90., 'unit': 'hands'}, 'b': {'rate': 50., 'unit': 'hands'},
+                           'c': {'rate': 1., 'unit': 'hands'}}}
+    comparison = harness.compare(results, baseline, tolerance=0.2)
+    assert [(name, is_regression) for name, *_, is_regression in comparison] == [('a', False), ('b', True)]
+    assert harness.measure(lambda: None, units_per_call=10, min_time=0.01, repeat=1) > 0
+    # f returns the number of units it processed
+    assert harness.measure(lambda: 10, units_per_call=None, min_time=0.01, repeat=2) > 0
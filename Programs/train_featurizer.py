@@ -1,6 +1,7 @@
 from models.featurizer import FeaturizerManager
+from game.metrics import MetricsWriter
 
-from pycrayon import CrayonClient
+import atexit
 import time
 
 FEATURIZER_NAME = 'chs_h50xf10_model_e9b22079_best'
@@ -8,6 +9,7 @@ SAVED_FEATURIZER_PATH = 'data/hand_eval/2017_11_30/saved_models/' + FEATURIZER_N
 
 
 def setup_tensorboard(exp_id, cur_t, hostname, port):
+    from pycrayon import CrayonClient
     exp_filename = '{}_{}'.format(cur_t, exp_id)
     tb = CrayonClient(hostname=hostname, port=port)
     try:
@@ -25,7 +27,12 @@ if __name__ == '__main__':
     exp_id = 'featurizer1_train'
     plot_freq = 100
     checkpoint_freq = 1000
-    tb_experiment, _ = setup_tensorboard(exp_id, time.time(), 'localhost', '8889')
+    use_crayon = False
+    if use_crayon:
+        tb_experiment, _ = setup_tensorboard(exp_id, time.time(), 'localhost', '8889')
+    else:
+        tb_experiment = MetricsWriter('data/hand_eval/metrics/{}_{}'.format(time.time(), exp_id))
+        atexit.register(tb_experiment.close)
 
     fm = FeaturizerManager(hdim=50,
                            n_filters=10,